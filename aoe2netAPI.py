@@ -25,12 +25,49 @@
 # Project Website:
 # https://github.com/Heistergand/elobot
 
+import asyncio
+import copy
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Iterator
+
 import requests
 from requests import Response
-import logging
+# 'gzip,deflate', plus 'br' if one of the optional brotli modules is installed and urllib3 can decode it
+from urllib3.util.request import ACCEPT_ENCODING
+
+# aiohttp is only needed by Aoe2netAsyncAPI. It is installed together with discord.py anyway,
+# but the blocking client should keep working without it.
+try:
+    import aiohttp
+    import multidict
+    import yarl
+except ImportError:
+    aiohttp = None
+
+from aoe2netCache import ResponseCache
+from metrics import Metrics
+from rateLimit import RateLimiter
+from resilience import Resilience
+import aoe2netModels
 
 logger = logging.getLogger(__name__)
 
+# Number of response body bytes written to the debug log, leaderboard pages can be megabytes
+LOG_BODY_LIMIT = 200
+
+# Names of the leaderboards by leaderboard_id
+LEADERBOARDS = {
+    0: 'Unranked',
+    1: '1v1 Deathmatch',
+    2: 'Team Deathmatch',
+    3: '1v1 Random Map',
+    4: 'Team Random Map',
+}
+
 
 class Aoe2netAPI(object):
     """
@@ -40,8 +77,10 @@ class Aoe2netAPI(object):
     ----------
     protocol : str
         The protocol part of the URL used to connect to the API (default 'https')
+        This value can be overwritten when creating a new instance.
     host : str
         The hostname used to connect to the API (default 'aoe2.net')
+        This value can be overwritten when creating a new instance, e.g. to use a local test server.
     language : str
         Returns the language that is used as argument for the API (default 'en')
         This value can be overwritten when creating a new instance.
@@ -51,11 +90,40 @@ class Aoe2netAPI(object):
         Returns the URL parameters used in the last request
     URL : str
         The composed URL that was used in the last request
+    cache : ResponseCache
+        Optional response cache. If set, successful responses are cached and identical concurrent
+        requests are coalesced into a single request to the API (default None)
+    rate_limiter : RateLimiter
+        Optional rate limiter. If set, requests to the API wait until the limiter lets them
+        through. Cached responses are not limited (default None)
+    metrics : Metrics
+        Optional metrics collector. If set, every request to the API is recorded with its
+        endpoint, status, duration and size (default None)
+    validator_size : int
+        Number of responses with an ETag or Last-Modified header that are kept to revalidate them
+        with a conditional request. A 304 answer returns the kept response without downloading
+        the body again. 0 disables revalidation (default 128)
+    validator_bytes : int
+        Most bytes of response bodies that are kept for revalidation. Larger responses are not kept
+        at all (default 16 MB)
+    timeout : float
+        Seconds a single request may take (default 10)
+    resilience : Resilience
+        Optional. If set, requests get deadlines, retries, hedged requests and a circuit breaker,
+        and when aoe2.net fails, fetch() returns the last good response flagged as stale
+        (default None)
+    stale_served : int
+        Number of stale responses returned because aoe2.net failed
+
+    All requests go through one requests.Session, so connections are kept alive and reused, and
+    compressed responses are negotiated.
 
     Methods
     -------
-    fetch(endpoint: str, query: str = None, protocol: str = protocol, host: str = host)
+    fetch(endpoint: str, query: str = None, protocol: str = None, host: str = None)
         Sends a get request to the eo2.net API and returns a Response object.
+    close()
+        Closes the session and its keep-alive connections.
     """
 
     # instance variables
@@ -65,12 +133,132 @@ class Aoe2netAPI(object):
     endpoint: str = None
     query: str = None
     URL: str = None
+    cache: ResponseCache = None
+    rate_limiter: RateLimiter = None
+    metrics: Metrics = None
+    validator_size: int = 128
+    validator_bytes: int = 16 * 1024 * 1024
+    timeout: float = 10.0
+    resilience: Resilience = None
 
-    def __init__(self, language: str = language) -> None:
+    def __init__(self, language: str = language, cache: ResponseCache = None,
+                 rate_limiter: RateLimiter = None, protocol: str = protocol, host: str = host,
+                 metrics: Metrics = None, validator_size: int = validator_size, timeout: float = timeout,
+                 resilience: Resilience = None, validator_bytes: int = validator_bytes) -> None:
         self.language = language
+        self.protocol = protocol
+        self.host = host
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics
+        self.validator_size = validator_size
+        self.validator_bytes = validator_bytes
+        self.timeout = timeout
+        self.resilience = resilience
+
+        self.stale_served = 0
+        self._stale_served_at = None
+
+        # requests that are currently running, by cache key
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+        # created on first use
+        self._session = None
+        self._session_lock = threading.Lock()
+
+        # last response with validators, by URL, least recently used first
+        self._validated = OrderedDict()
+        self._validated_bytes = 0
+        self._validated_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def _get_session(self) -> requests.Session:
+        with self._session_lock:
+            if self._session is None:
+                self._session = requests.Session()
+                self._session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+            return self._session
+
+    def close(self) -> None:
+        """Closes the session and its keep-alive connections."""
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
 
-    def fetch(self, endpoint: str, query: str = None, protocol: str = protocol,
-              host: str = host) -> Response:
+    def _conditional_headers(self, url: str) -> dict:
+        # If-None-Match/If-Modified-Since for the response we kept for this URL, if any
+        with self._validated_lock:
+            kept = self._validated.get(url)
+        if kept is None:
+            return {}
+        headers = {}
+        if kept.headers.get('ETag'):
+            headers['If-None-Match'] = kept.headers['ETag']
+        if kept.headers.get('Last-Modified'):
+            headers['If-Modified-Since'] = kept.headers['Last-Modified']
+        return headers
+
+    def _revalidated(self, url: str, ret):
+        # Swaps a 304 for the kept response, and keeps fresh responses that carry validators.
+        if ret.status_code == 304:
+            with self._validated_lock:
+                kept = self._validated.get(url)
+                if kept is not None:
+                    self._validated.move_to_end(url)
+            return kept if kept is not None else ret
+
+        if ret.ok and self.validator_size > 0 and len(ret.content) <= self.validator_bytes and \
+                (ret.headers.get('ETag') or ret.headers.get('Last-Modified')):
+            with self._validated_lock:
+                old = self._validated.pop(url, None)
+                if old is not None:
+                    self._validated_bytes -= len(old.content)
+                self._validated[url] = ret
+                self._validated_bytes += len(ret.content)
+                while len(self._validated) > self.validator_size or self._validated_bytes > self.validator_bytes:
+                    _, dropped = self._validated.popitem(last=False)
+                    self._validated_bytes -= len(dropped.content)
+        return ret
+
+    def degraded(self, window: float = 60) -> bool:
+        """True if aoe2.net is failing: the circuit is open or stale responses were returned lately."""
+        if self.resilience is not None and self.resilience.breaker.state != self.resilience.breaker.CLOSED:
+            return True
+        return self._stale_served_at is not None and time.monotonic() - self._stale_served_at < window
+
+    def _fallback(self, key: str, url: str):
+        # The last good response for a request, flagged as stale, or None if there is none.
+        ret = self.cache.last_good(key) if self.cache is not None and key is not None else None
+        if ret is None:
+            with self._validated_lock:
+                ret = self._validated.get(url)
+        if ret is None:
+            return None
+        self.stale_served += 1
+        self._stale_served_at = time.monotonic()
+        logger.debug(f'aoe2.net is failing, answering {url} with the last good response')
+        # a copy, the cached response is shared with other callers
+        ret = copy.copy(ret)
+        ret.stale = True
+        return ret
+
+    @staticmethod
+    def _describe(ret) -> str:
+        # a short description of a response for the debug log
+        content = ret.content
+        if len(content) > LOG_BODY_LIMIT:
+            return f'{ret} {len(content)} bytes: {content[:LOG_BODY_LIMIT]!r}...'
+        return f'{ret} {content!r}'
+
+    def fetch(self, endpoint: str, query: str = None, protocol: str = None,
+              host: str = None, fresh: bool = False) -> Response:
         """
         Sends a get request to the eo2.net API and returns a Response object.
 
@@ -88,31 +276,166 @@ class Aoe2netAPI(object):
             the query parameters as string (default is None)
 
         :param protocol:
-            the protocol used to create the URL (default is 'https')
+            the protocol used to create the URL (default is the protocol attribute, 'https')
 
         :param host:
-            the host used to create the URL (default is 'aoe2.net)
+            the host used to create the URL (default is the host attribute, 'aoe2.net')
             Note that the port is set dynamically. If you need to set a custom port, attach it to the host name.
 
+        :param fresh:
+            if True, a cached response is not used and the response is requested from aoe2.net. It
+            still updates the cache, and requests that are already on their way are shared (default False)
+
         :returns:
             A Response object containing the http response from the API.
+            If a cache is set, this may be a cached Response object shared with other callers.
+            If resilience is set and aoe2.net fails, this may be the last good response, a copy with
+            the attribute `stale` set to True.
 
         """
 
         # overwrite the class attributes to custom values provided by the method's arguments
         self.endpoint = endpoint
         self.query = query
-        self.protocol = protocol
-        self.host = host
+        self.protocol = protocol = protocol or self.protocol
+        self.host = host = host or self.host
 
         # concatenate arguments to URL and save as attribute
-        self.URL = f'{protocol}://{host}{endpoint}{query}'
+        self.URL = url = f'{protocol}://{host}{endpoint}{query or ""}'
+
+        key = None
+        try:
+            if self.cache is None:
+                ret = self._resilient_request(url, endpoint)
+            else:
+                key = self.cache.key(endpoint, query)
+                cached = None if fresh else self.cache.get(key)
+                if cached is not None:
+                    ret, current = cached
+                    if not current:
+                        self._refresh_in_background(key, endpoint, url)
+                    return ret
+                ret = self._coalesced(key, endpoint, url)
+        except requests.RequestException:
+            stale = self._fallback(key, url) if self.resilience is not None else None
+            if stale is None:
+                raise
+            return stale
 
-        logger.debug(f'Fetching from API: {self.URL}')
-        ret = requests.get(self.URL)
-        logger.debug(f'Returning from API: {ret} {ret.content}')
+        if self.resilience is not None and ret.status_code in self.resilience.retry_statuses:
+            return self._fallback(key, url) or ret
         return ret
 
+    def _resilient_request(self, url: str, endpoint: str) -> Response:
+        # _request with the deadline, retries and circuit breaker of self.resilience, see Resilience
+        policy = self.resilience
+        if policy is None:
+            self._acquire(endpoint)
+            return self._request(url, endpoint)
+
+        deadline = None
+        attempt = 0
+        ret = error = None
+        while True:
+            if not policy.breaker.allow():
+                raise requests.ConnectionError(f'Not sending {url}, aoe2.net is failing (circuit open)')
+            # The deadline and the breaker judge aoe2.net, so the wait for our own rate limiter is
+            # not part of them. Only a retry that waited past the deadline gives up here.
+            self._acquire(endpoint)
+            now = time.monotonic()
+            if deadline is None:
+                deadline = now + policy.deadline_for(endpoint)
+            elif now >= deadline:
+                if error is not None:
+                    raise error
+                return ret
+            ret = error = None
+            try:
+                ret = self._request(url, endpoint, timeout=deadline - now)
+            except requests.RequestException as e:
+                error = e
+            if error is None and ret.status_code not in policy.retry_statuses:
+                policy.breaker.success()
+                return ret
+
+            policy.breaker.failure()
+            delay = policy.backoff_delay(attempt)
+            attempt += 1
+            if attempt > policy.retries or time.monotonic() + delay >= deadline:
+                if error is not None:
+                    raise error
+                return ret
+            policy.retried += 1
+            logger.debug(f'Retrying {url} in {delay:.2f}s after {error!r}' if error is not None else
+                         f'Retrying {url} in {delay:.2f}s after status {ret.status_code}')
+            time.sleep(delay)
+
+    def _acquire(self, endpoint: str) -> None:
+        # waits for the rate limiter, before _request
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire_blocking(endpoint)
+
+    def _request(self, url: str, endpoint: str, timeout: float = None) -> Response:
+        logger.debug(f'Fetching from API: {url}')
+        began = time.perf_counter()
+        try:
+            ret = self._get_session().get(url, headers=self._conditional_headers(url),
+                                          timeout=min(timeout or self.timeout, self.timeout))
+        except Exception as e:
+            self._record(endpoint, began, error=e)
+            raise
+        self._record(endpoint, began, ret.status_code, len(ret.content))
+        logger.debug(f'Returning from API: {self._describe(ret)}')
+        return self._revalidated(url, ret)
+
+    def _record(self, endpoint: str, began: float, status: int = None, size: int = 0,
+                error: BaseException = None) -> None:
+        duration = time.perf_counter() - began
+        if self.resilience is not None and error is None:
+            self.resilience.latency.add(endpoint, duration)
+        if self.metrics is None:
+            return
+        if error is not None:
+            self.metrics.api_error(endpoint, error, duration)
+        else:
+            self.metrics.api_request(endpoint, status, size, duration)
+
+    def _coalesced(self, key: str, endpoint: str, url: str) -> Response:
+        # The first caller for a key sends the request, everybody else waits for its result.
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            ret = self._resilient_request(url, endpoint)
+            if ret.ok:
+                self.cache.put(key, ret, endpoint)
+            future.set_result(ret)
+            return ret
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+
+    def _refresh_in_background(self, key: str, endpoint: str, url: str) -> None:
+        if key in self._inflight:
+            return
+
+        def refresh():
+            try:
+                self._coalesced(key, endpoint, url)
+            except Exception as e:
+                logger.warning(f'Background refresh of {url} failed: {e}')
+
+        threading.Thread(target=refresh, daemon=True).start()
+
     def strings(self, game: str, language: str = language) -> Response:
         """Request a list of strings used by the API.
 
@@ -172,7 +495,7 @@ class Aoe2netAPI(object):
 
         return self.fetch(endpoint, query)
 
-    def lobbies(self, game: str = None) -> Response:
+    def lobbies(self, game: str = None, fresh: bool = False) -> Response:
         """Request all open lobbies
 
         **Endpoint**
@@ -182,6 +505,7 @@ class Aoe2netAPI(object):
         ------------------
         :param game:
                     (Required) Game (Age of Empires 2:Definitive Edition=aoe2de)
+        :param fresh: Don't answer from the cache, see fetch()
         :return: A Response object containing the http response from the API.
         """
 
@@ -191,9 +515,10 @@ class Aoe2netAPI(object):
         else:
             query = None
 
-        return self.fetch(endpoint, query)
+        return self.fetch(endpoint, query, fresh=fresh)
 
-    def lastmatch(self, game: str = 'aoe2de', steam_id: int = None, profile_id: str = None) -> Response:
+    def lastmatch(self, game: str = 'aoe2de', steam_id: int = None, profile_id: str = None,
+                  fresh: bool = False) -> Response:
         """
         Request the last match the player started playing.
         This will be the current match if they are still in game.
@@ -209,12 +534,19 @@ class Aoe2netAPI(object):
         :param game: Game (Age of Empires 2:Definitive Edition=aoe2de)
         :param steam_id: steamID64 (ex: 76561199003184910)
         :param profile_id: Profile ID (ex: 459658)
+        :param fresh: Don't answer from the cache, see fetch()
         :returns: A Response object containing the http response from the API.
         """
 
         endpoint = '/api/lastmatch'
-        query = f'?game={game}&steam_id={steam_id}&profile_id={profile_id}'
-        return self.fetch(endpoint, query)
+        query = f'?game={game}'
+
+        if not (steam_id is None):
+            query += f'&steam_id={steam_id}'
+        if not (profile_id is None):
+            query += f'&profile_id={profile_id}'
+
+        return self.fetch(endpoint, query, fresh=fresh)
 
     def matches(self, game: str = 'aoe2de', start: int = 0, count: int = 1,
                 steam_id: int = None, profile_id: str = None) -> Response:
@@ -244,7 +576,7 @@ class Aoe2netAPI(object):
         return self.fetch(endpoint, query)
 
     def ratinghistory(self, game: str = 'aoe2de', leaderboard_id: int = 3, start: int = 0, count: int = 1,
-                      steam_id: int = None, profile_id: str = None) -> Response:
+                      steam_id: int = None, profile_id: str = None, fresh: bool = False) -> Response:
         """Request the rating history for a player
 
         **Endpoint**
@@ -266,6 +598,7 @@ class Aoe2netAPI(object):
         :param count: Number of matches to get (Must be 1000 or less))
         :param steam_id: steamID64
         :param profile_id: Profile ID
+        :param fresh: Don't answer from the cache, see fetch()
         :returns: A Response object containing the http response from the API.
         """
 
@@ -277,7 +610,7 @@ class Aoe2netAPI(object):
         if not (profile_id is None):
             query += f'&profile_id={profile_id}'
 
-        return self.fetch(endpoint, query)
+        return self.fetch(endpoint, query, fresh=fresh)
 
     def players(self, game: str) -> Response:
         """Number of Players Online
@@ -294,3 +627,423 @@ class Aoe2netAPI(object):
         endpoint = '/api/players'
         query = f'?game={game}'
         return self.fetch(endpoint, query)
+
+    def iter_matches(self, game: str = 'aoe2de', steam_id: int = None, profile_id: str = None,
+                     page_size: int = 1000, since: int = None, until_match_id: str = None) -> Iterator:
+        """Iterate over the complete match history of a player, most recent match first.
+
+        Pages are requested with /api/matches as needed. The next page is already fetched in the
+        background while the caller works through the current one.
+
+        Request Parameters
+        ------------------
+        :param game: Game (Age of Empires 2:Definitive Edition=aoe2de)
+        :param steam_id: steamID64
+        :param profile_id: Profile ID
+        :param page_size: Number of matches per request (Must be 1000 or less)
+        :param since: Stop at the first match started before this unix timestamp
+        :param until_match_id: Stop at this match, e.g. the newest match you already know
+            (it's not returned)
+        :returns: A generator yielding one Match record at a time.
+        """
+
+        def page(start, count):
+            return self.matches(game=game, start=start, count=count, steam_id=steam_id, profile_id=profile_id)
+
+        return self._paginate(page, aoe2netModels.matches, page_size,
+                              self._cutoff('started', since, until_match_id))
+
+    def iter_ratinghistory(self, game: str = 'aoe2de', leaderboard_id: int = 3, steam_id: int = None,
+                           profile_id: str = None, page_size: int = 1000, since: int = None,
+                           fresh: bool = False) -> Iterator:
+        """Iterate over the complete rating history of a player, most recent rating first.
+
+        Pages are requested with /api/ratinghistory as needed. The next page is already fetched in
+        the background while the caller works through the current one.
+
+        Request Parameters
+        ------------------
+        :param game: Game (Age of Empires 2:Definitive Edition=aoe2de)
+        :param leaderboard_id: Leaderboard ID
+        :param steam_id: steamID64
+        :param profile_id: Profile ID
+        :param page_size: Number of ratings per request (Must be 1000 or less)
+        :param since: Stop at the first rating older than this unix timestamp
+        :param fresh: Don't answer from the cache, see fetch()
+        :returns: A generator yielding one RatingPoint record at a time.
+        """
+
+        def page(start, count):
+            return self.ratinghistory(game=game, leaderboard_id=leaderboard_id, start=start, count=count,
+                                      steam_id=steam_id, profile_id=profile_id, fresh=fresh)
+
+        return self._paginate(page, aoe2netModels.ratinghistory, page_size, self._cutoff('timestamp', since))
+
+    @staticmethod
+    def _cutoff(time_key: str, since: int = None, until_match_id: str = None) -> Callable:
+        # returns a function telling whether a record is past the point the caller asked for
+        def stop(record):
+            if since is not None and (record.get(time_key) or 0) < since:
+                return True
+            return until_match_id is not None and str(record.get('match_id')) == str(until_match_id)
+        return stop
+
+    def _paginate(self, page: Callable, decode: Callable, page_size: int, stop: Callable) -> Iterator:
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            start = 0
+            future = executor.submit(page, start, page_size)
+            while future is not None:
+                response = future.result()
+                response.raise_for_status()
+                records = decode(response.content)
+                start += len(records)
+
+                # prefetch, unless this was the last page or the cutoff is already in this page
+                future = None
+                if len(records) >= page_size and not stop(records[-1]):
+                    future = executor.submit(page, start, page_size)
+
+                for record in records:
+                    if stop(record):
+                        return
+                    yield record
+        finally:
+            # the caller may stop early, don't wait for a prefetch nobody needs anymore
+            executor.shutdown(wait=False)
+
+
+class APIResponse(object):
+    """
+    A fully read http response returned by Aoe2netAsyncAPI.
+
+    It mimics the parts of requests.Response that are used by the bot, so calling code can work with
+    both clients the same way.
+
+    Attributes
+    ----------
+    url : str
+        The URL that was requested
+    status_code : int
+        The http status code
+    reason : str
+        The http reason phrase
+    headers : Mapping
+        The response headers, case-insensitive like in requests.Response
+    content : bytes
+        The raw response body
+    stale : bool
+        True if aoe2.net failed and this is the last good response, see Aoe2netAPI.fetch
+    """
+
+    stale: bool = False
+
+    def __init__(self, url: str, status_code: int, reason: str, headers, content: bytes) -> None:
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    def __repr__(self) -> str:
+        return f'<APIResponse [{self.status_code}]>'
+
+    @property
+    def ok(self) -> bool:
+        """True if the status code is less than 400, just like requests.Response.ok"""
+        return self.status_code < 400
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return aoe2netModels.loads(self.content)
+
+    def raise_for_status(self) -> None:
+        """Raises aiohttp.ClientResponseError if the status code is 400 or above."""
+        if not self.ok:
+            url = yarl.URL(self.url)
+            request_info = aiohttp.RequestInfo(url, 'GET', multidict.CIMultiDictProxy(multidict.CIMultiDict()), url)
+            raise aiohttp.ClientResponseError(request_info, (), status=self.status_code, message=self.reason)
+
+
+class Aoe2netAsyncAPI(Aoe2netAPI):
+    """
+    Class Aoe2netAsyncAPI is the asyncio counterpart of Aoe2netAPI.
+
+    All endpoint methods (leaderboard, matches, ratinghistory, lastmatch, lobbies, strings, players)
+    are inherited from Aoe2netAPI, but here they return a coroutine that has to be awaited and
+    resolves to an APIResponse object.
+
+    One instance holds a single aiohttp session, so all requests share a keep-alive connection pool.
+    Create it once and reuse it; call close() when you are done. Responses with validators are
+    revalidated with conditional requests, just like in Aoe2netAPI. With resilience set, slow
+    requests can also be hedged, see Resilience.
+
+    Attributes
+    ----------
+    concurrency : int
+        Maximum number of requests that are in flight at the same time (default 10)
+    connection_limit : int
+        Maximum number of pooled connections (default 20)
+    keepalive_timeout : float
+        Seconds an idle connection is kept open for reuse (default 30)
+
+    Methods
+    -------
+    fetch(endpoint: str, query: str = None, protocol: str = None, host: str = None)
+        Sends a get request to the aoe2.net API and returns an APIResponse object.
+    close()
+        Closes the session and its connection pool.
+    """
+
+    concurrency: int = 10
+    connection_limit: int = 20
+    keepalive_timeout: float = 30.0
+
+    def __init__(self, language: str = Aoe2netAPI.language, cache: ResponseCache = None,
+                 rate_limiter: RateLimiter = None, protocol: str = Aoe2netAPI.protocol,
+                 host: str = Aoe2netAPI.host, metrics: Metrics = None, concurrency: int = concurrency,
+                 connection_limit: int = connection_limit, timeout: float = Aoe2netAPI.timeout,
+                 keepalive_timeout: float = keepalive_timeout,
+                 validator_size: int = Aoe2netAPI.validator_size, resilience: Resilience = None,
+                 validator_bytes: int = Aoe2netAPI.validator_bytes) -> None:
+        if aiohttp is None:
+            raise RuntimeError('Aoe2netAsyncAPI requires the aiohttp module')
+
+        super().__init__(language, cache, rate_limiter, protocol, host, metrics, validator_size, timeout, resilience,
+                         validator_bytes)
+        self.concurrency = concurrency
+        self.connection_limit = connection_limit
+        self.keepalive_timeout = keepalive_timeout
+
+        # both are bound to the running event loop, so they are created on first use
+        self._session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.close()
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.connection_limit,
+                                             keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._session
+
+    async def close(self) -> None:
+        """Closes the session and its connection pool."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._semaphore = None
+
+    async def fetch(self, endpoint: str, query: str = None, protocol: str = None,
+                    host: str = None, fresh: bool = False) -> APIResponse:
+        """
+        Sends a get request to the aoe2.net API and returns an APIResponse object.
+
+        Parameters are the same as in Aoe2netAPI.fetch.
+
+        :raises aiohttp.ClientError: if the connection fails
+        :raises asyncio.TimeoutError: if the request takes longer than the configured timeout
+
+        :returns:
+            An APIResponse object containing the http response from the API. Its attribute stale
+            is True if aoe2.net failed and it is the last good response.
+        """
+
+        self.endpoint = endpoint
+        self.query = query
+        self.protocol = protocol = protocol or self.protocol
+        self.host = host = host or self.host
+
+        url = f'{protocol}://{host}{endpoint}{query or ""}'
+        self.URL = url
+
+        key = None
+        try:
+            if self.cache is None:
+                ret = await self._resilient_request(url, endpoint)
+            else:
+                key = self.cache.key(endpoint, query)
+                cached = None if fresh else self.cache.get(key)
+                if cached is not None:
+                    ret, current = cached
+                    if not current:
+                        self._refresh_in_background(key, endpoint, url)
+                    return ret
+                ret = await self._coalesced(key, endpoint, url)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            stale = self._fallback(key, url) if self.resilience is not None else None
+            if stale is None:
+                raise
+            return stale
+
+        if self.resilience is not None and ret.status_code in self.resilience.retry_statuses:
+            return self._fallback(key, url) or ret
+        return ret
+
+    async def _resilient_request(self, url: str, endpoint: str) -> APIResponse:
+        # Same as Aoe2netAPI._resilient_request, plus hedged requests
+        policy = self.resilience
+        if policy is None:
+            await self._acquire(endpoint)
+            return await self._request(url, endpoint)
+
+        deadline = None
+        attempt = 0
+        ret = error = None
+        while True:
+            if not policy.breaker.allow():
+                raise aiohttp.ClientConnectionError(f'Not sending {url}, aoe2.net is failing (circuit open)')
+            await self._acquire(endpoint)
+            now = time.monotonic()
+            if deadline is None:
+                deadline = now + policy.deadline_for(endpoint)
+            elif now >= deadline:
+                if error is not None:
+                    raise error
+                return ret
+            ret = error = None
+            try:
+                ret = await asyncio.wait_for(self._hedged(url, endpoint), deadline - now)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            if error is None and ret.status_code not in policy.retry_statuses:
+                policy.breaker.success()
+                return ret
+
+            policy.breaker.failure()
+            delay = policy.backoff_delay(attempt)
+            attempt += 1
+            if attempt > policy.retries or time.monotonic() + delay >= deadline:
+                if error is not None:
+                    raise error
+                return ret
+            policy.retried += 1
+            logger.debug(f'Retrying {url} in {delay:.2f}s after {error!r}' if error is not None else
+                         f'Retrying {url} in {delay:.2f}s after status {ret.status_code}')
+            await asyncio.sleep(delay)
+
+    async def _hedged(self, url: str, endpoint: str) -> APIResponse:
+        # Sends a second request if the first one takes longer than usual, the first answer wins.
+        delay = self.resilience.hedge_delay(endpoint)
+        first = asyncio.ensure_future(self._request(url, endpoint))
+        if delay is None:
+            return await first
+
+        pending = {first}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            # a hedge is only sent if the rate limiter has a token to spare right now
+            if not done and (self.rate_limiter is None or self.rate_limiter.try_acquire(endpoint)):
+                self.resilience.hedged += 1
+                logger.debug(f'Hedging {url} after {delay:.3f}s')
+                pending.add(asyncio.ensure_future(self._request(url, endpoint)))
+            while True:
+                for task in done:
+                    # a failed request only counts if there is no other one left
+                    if task.exception() is None or not pending:
+                        return task.result()
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _acquire(self, endpoint: str) -> None:
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire(endpoint)
+
+    async def _request(self, url: str, endpoint: str) -> APIResponse:
+        session = self._get_session()
+        logger.debug(f'Fetching from API: {url}')
+        async with self._semaphore:
+            began = time.perf_counter()
+            try:
+                async with session.get(url, headers=self._conditional_headers(url)) as resp:
+                    content = await resp.read()
+                    ret = APIResponse(url, resp.status, resp.reason, multidict.CIMultiDict(resp.headers), content)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self._record(endpoint, began, error=e)
+                raise
+            self._record(endpoint, began, ret.status_code, len(content))
+        logger.debug(f'Returning from API: {self._describe(ret)}')
+        return self._revalidated(url, ret)
+
+    async def _request_and_store(self, key: str, endpoint: str, url: str) -> APIResponse:
+        ret = await self._resilient_request(url, endpoint)
+        if ret.ok:
+            self.cache.put(key, ret, endpoint)
+        return ret
+
+    async def _coalesced(self, key: str, endpoint: str, url: str) -> APIResponse:
+        # The first caller for a key starts the request, everybody else awaits the same task.
+        # shield() keeps the request running for the others if one of the callers is cancelled.
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._request_and_store(key, endpoint, url))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    def _refresh_in_background(self, key: str, endpoint: str, url: str) -> None:
+        if key in self._inflight:
+            return
+
+        def done(task):
+            if not task.cancelled() and task.exception() is not None:
+                logger.warning(f'Background refresh of {url} failed: {task.exception()}')
+
+        asyncio.ensure_future(self._coalesced(key, endpoint, url)).add_done_callback(done)
+
+    def iter_matches(self, game: str = 'aoe2de', steam_id: int = None, profile_id: str = None,
+                     page_size: int = 1000, since: int = None, until_match_id: str = None) -> AsyncIterator:
+        """Same as Aoe2netAPI.iter_matches, but returns an async generator. Use it with `async for`."""
+
+        def page(start, count):
+            return self.matches(game=game, start=start, count=count, steam_id=steam_id, profile_id=profile_id)
+
+        return self._paginate(page, aoe2netModels.matches, page_size,
+                              self._cutoff('started', since, until_match_id))
+
+    def iter_ratinghistory(self, game: str = 'aoe2de', leaderboard_id: int = 3, steam_id: int = None,
+                           profile_id: str = None, page_size: int = 1000, since: int = None,
+                           fresh: bool = False) -> AsyncIterator:
+        """Same as Aoe2netAPI.iter_ratinghistory, but returns an async generator. Use it with `async for`."""
+
+        def page(start, count):
+            return self.ratinghistory(game=game, leaderboard_id=leaderboard_id, start=start, count=count,
+                                      steam_id=steam_id, profile_id=profile_id, fresh=fresh)
+
+        return self._paginate(page, aoe2netModels.ratinghistory, page_size, self._cutoff('timestamp', since))
+
+    async def _paginate(self, page: Callable, decode: Callable, page_size: int, stop: Callable) -> AsyncIterator:
+        start = 0
+        task = asyncio.ensure_future(page(start, page_size))
+        try:
+            while task is not None:
+                response = await task
+                response.raise_for_status()
+                records = decode(response.content)
+                start += len(records)
+
+                # prefetch, unless this was the last page or the cutoff is already in this page
+                task = None
+                if len(records) >= page_size and not stop(records[-1]):
+                    task = asyncio.ensure_future(page(start, page_size))
+
+                for record in records:
+                    if stop(record):
+                        return
+                    yield record
+        finally:
+            # the caller stopped early, don't leave the prefetch running
+            if task is not None and not task.done():
+                task.cancel()
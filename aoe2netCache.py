@@ -0,0 +1,169 @@
+# aoe2netCache.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qsl, urlencode
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CacheEntry(object):
+    """A single cached value and the points in time at which it turns stale and then unusable."""
+
+    __slots__ = ('value', 'stored_at', 'expires_at', 'stale_until')
+
+    def __init__(self, value, stored_at: float, expires_at: float, stale_until: float) -> None:
+        self.value = value
+        self.stored_at = stored_at
+        self.expires_at = expires_at
+        self.stale_until = stale_until
+
+
+class ResponseCache(object):
+    """
+    Class ResponseCache is a bounded in-process cache for API responses.
+
+    Entries are keyed on the endpoint and the normalized query string. Every endpoint has its own
+    time to live. After that time an entry is stale: it may still be returned for `stale_ttl` more
+    seconds while the caller refreshes it in the background (stale-while-revalidate). After that,
+    get() doesn't return it anymore, but it is kept as the last good response for last_good(). When
+    the cache holds more than `max_entries` entries, the least recently used one is evicted.
+
+    The cache itself never talks to the API, see Aoe2netAPI.fetch for how it is used.
+
+    Attributes
+    ----------
+    ttl : dict
+        Time to live in seconds per endpoint path
+    default_ttl : float
+        Time to live for endpoints that are not listed in ttl (default 60)
+    stale_ttl : float
+        Seconds an expired entry may still be served while it is being refreshed (default 300)
+    max_entries : int
+        Maximum number of cached responses (default 1024)
+    """
+
+    ttl: dict = {
+        '/api/lobbies': 5,
+        '/api/lastmatch': 15,
+        '/api/players': 30,
+        '/api/leaderboard': 60,
+        '/api/matches': 60,
+        '/api/ratinghistory': 60,
+        '/api/strings': 24 * 60 * 60,
+    }
+    default_ttl: float = 60
+    stale_ttl: float = 300
+    max_entries: int = 1024
+
+    def __init__(self, ttl: dict = None, default_ttl: float = default_ttl, stale_ttl: float = stale_ttl,
+                 max_entries: int = max_entries) -> None:
+        self.ttl = dict(self.ttl)
+        if ttl:
+            self.ttl.update(ttl)
+        self.default_ttl = default_ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def key(endpoint: str, query: str = None) -> str:
+        """
+        Returns the cache key for a request.
+
+        The query parameters are sorted and parameters with the value 'None' are dropped, so
+        '?b=1&a=2' and '?a=2&b=1&profile_id=None' share the same key.
+        """
+        if not query:
+            return endpoint
+        params = [(k, v) for k, v in parse_qsl(query.lstrip('?'), keep_blank_values=True) if v != 'None']
+        return f'{endpoint}?{urlencode(sorted(params))}'
+
+    def ttl_for(self, endpoint: str) -> float:
+        return self.ttl.get(endpoint, self.default_ttl)
+
+    def get(self, key: str):
+        """
+        Looks up a key.
+
+        :returns: A tuple (value, fresh) or None if there is no usable entry.
+            fresh is False if the entry is past its time to live but may still be served stale.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if now >= entry.stale_until:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            if now < entry.expires_at:
+                self.hits += 1
+                return entry.value, True
+            self.stale_hits += 1
+            return entry.value, False
+
+    def put(self, key: str, value, endpoint: str) -> None:
+        """Stores a value using the time to live of the given endpoint."""
+        now = time.monotonic()
+        expires_at = now + self.ttl_for(endpoint)
+        with self._lock:
+            self._entries[key] = CacheEntry(value, now, expires_at, expires_at + self.stale_ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def last_good(self, key: str):
+        """Returns the cached value of a key however old it is, or None. For when the API is failing."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry.value if entry is not None else None
+
+    def invalidate(self, key: str = None) -> None:
+        """Removes a single key, or everything if no key is given."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
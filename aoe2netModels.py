@@ -0,0 +1,185 @@
+# aoe2netModels.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+
+import json
+
+# orjson is optional. It decodes large leaderboard pages several times faster than the json module.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(content):
+    """Decodes JSON from bytes or str, using orjson if it is installed."""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+class Record(object):
+    """
+    Base class of the typed API records.
+
+    Records store their fields in __slots__, which takes a fraction of the memory of the dicts
+    returned by the JSON decoder. Fields missing in the API data are None.
+
+    For convenience, records also support read access like a dict (record['name'], record.get('name')),
+    so code written for the raw API dicts keeps working.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, **fields) -> None:
+        for field in self.__slots__:
+            setattr(self, field, fields.get(field))
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        record = cls.__new__(cls)
+        get = data.get
+        for field in cls.__slots__:
+            setattr(record, field, get(field))
+        return record
+
+    @classmethod
+    def from_list(cls, items: list) -> list:
+        from_dict = cls.from_dict
+        return [from_dict(item) for item in items]
+
+    @classmethod
+    def from_tuple(cls, values) -> 'Record':
+        record = cls.__new__(cls)
+        for field, value in zip(cls.__slots__, values):
+            setattr(record, field, value)
+        return record
+
+    def to_tuple(self) -> tuple:
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __getitem__(self, field: str):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field) from None
+
+    def get(self, field: str, default=None):
+        value = getattr(self, field, None)
+        return default if value is None else value
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and self.to_tuple() == other.to_tuple()
+
+    def __repr__(self) -> str:
+        fields = ', '.join(f'{field}={getattr(self, field)!r}' for field in self.__slots__[:3])
+        return f'{type(self).__name__}({fields}, ...)'
+
+
+class LeaderboardRow(Record):
+    """A player's entry in a leaderboard, see Aoe2netAPI.leaderboard"""
+
+    __slots__ = ('profile_id', 'rank', 'rating', 'steam_id', 'icon', 'name', 'clan', 'country',
+                 'previous_rating', 'highest_rating', 'streak', 'lowest_streak', 'highest_streak',
+                 'games', 'wins', 'losses', 'drops', 'last_match', 'last_match_time')
+
+
+class RatingPoint(Record):
+    """A single entry of a player's rating history, see Aoe2netAPI.ratinghistory"""
+
+    __slots__ = ('rating', 'num_wins', 'num_losses', 'streak', 'drops', 'timestamp')
+
+
+class Player(Record):
+    """A player slot in a match or lobby"""
+
+    __slots__ = ('profile_id', 'steam_id', 'name', 'clan', 'country', 'slot', 'slot_type', 'rating',
+                 'rating_change', 'games', 'wins', 'streak', 'drops', 'color', 'team', 'civ', 'won')
+
+
+class Match(Record):
+    """A match or an open lobby, see Aoe2netAPI.matches, Aoe2netAPI.lastmatch and Aoe2netAPI.lobbies"""
+
+    __slots__ = ('match_id', 'lobby_id', 'match_uuid', 'version', 'name', 'num_players', 'num_slots',
+                 'average_rating', 'cheats', 'full_tech_tree', 'ending_age', 'expansion', 'game_type',
+                 'has_custom_content', 'has_password', 'lock_speed', 'lock_teams', 'map_size', 'map_type',
+                 'pop', 'ranked', 'leaderboard_id', 'rating_type', 'resources', 'rms', 'scenario', 'server',
+                 'shared_exploration', 'speed', 'starting_age', 'team_together', 'team_positions',
+                 'treaty_length', 'turbo', 'victory', 'victory_time', 'visibility', 'opened', 'started',
+                 'finished', 'players')
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Match':
+        match = super().from_dict(data)
+        match.players = Player.from_list(match.players or [])
+        return match
+
+    def to_dict(self) -> dict:
+        data = super().to_dict()
+        data['players'] = [player.to_dict() for player in self.players]
+        return data
+
+
+def leaderboard(content) -> tuple:
+    """
+    Decodes the body of a /api/leaderboard response.
+
+    :returns: A tuple (total, rows) with the total number of players in the leaderboard and a list
+        of LeaderboardRow records.
+    """
+    data = loads(content)
+    return data.get('total'), LeaderboardRow.from_list(data.get('leaderboard') or [])
+
+
+def matches(content) -> list:
+    """Decodes the body of a /api/matches response into a list of Match records."""
+    return Match.from_list(loads(content))
+
+
+def lastmatch(content) -> tuple:
+    """
+    Decodes the body of a /api/lastmatch response.
+
+    :returns: A tuple (player, match) with the player's name, profile_id and steam_id as a dict,
+        and the last match as a Match record.
+    """
+    data = loads(content)
+    last_match = data.pop('last_match', None)
+    return data, Match.from_dict(last_match) if last_match else None
+
+
+def lobbies(content) -> list:
+    """Decodes the body of a /api/lobbies response into a list of Match records."""
+    return Match.from_list(loads(content))
+
+
+def ratinghistory(content) -> list:
+    """Decodes the body of a /api/ratinghistory response into a list of RatingPoint records."""
+    return RatingPoint.from_list(loads(content))
@@ -0,0 +1,219 @@
+# benchmark.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+
+"""
+End-to-end benchmark of the bot.
+
+Starts a FakeAoe2net server, imports elobot with its config pointed at that server, and drives
+elobot.on_message with synthetic messages at the given concurrency. Reports the latency from
+receiving a message to sending the reply, the throughput and the number of upstream requests.
+Neither Discord nor aoe2.net are contacted.
+
+    python3 benchmark.py --messages 2000 --concurrency 50 --latency 0.08
+    python3 benchmark.py --mirror --players 50000
+"""
+
+import argparse
+import asyncio
+import random
+import sys
+import time
+import types
+
+from fakeAoe2net import FakeAoe2net
+from rateLimit import RateLimiter
+
+
+class SyntheticUser(object):
+    """Stands in for discord.User, with just the attributes the bot uses."""
+
+    bot = False
+
+    def __init__(self, user_id: int, name: str) -> None:
+        self.id = user_id
+        self.name = name
+
+    def __str__(self) -> str:
+        return f'{self.name}#0000'
+
+
+class SyntheticChannel(object):
+    """Stands in for discord.TextChannel and records the time of the last reply."""
+
+    def __init__(self, channel_id: int) -> None:
+        self.id = channel_id
+        self.replies = []
+        self.replied_at = None
+
+    async def send(self, content: str) -> None:
+        self.replies.append(content)
+        self.replied_at = time.perf_counter()
+
+
+class SyntheticMessage(object):
+    """Stands in for discord.Message, with just the attributes the bot uses."""
+
+    jump_url = None
+
+    def __init__(self, content: str, author: SyntheticUser, channel: SyntheticChannel) -> None:
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = types.SimpleNamespace(name='Benchmark', owner=None)
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def load_config(args, host: str):
+    try:
+        import config
+    except ImportError:
+        # no config.py yet, the template has all settings
+        config = types.ModuleType('config')
+        with open('config.py.template', encoding='utf-8') as f:
+            exec(f.read(), config.__dict__)
+        sys.modules['config'] = config
+
+    config.LOGLEVEL = 'warning'
+    config.AOE2NET_PROTOCOL = 'http'
+    config.AOE2NET_HOST = host
+    config.LEADERBOARD_MIRROR = args.mirror
+    config.LEADERBOARD_SNAPSHOT = None
+    config.PROFILE_LINKS = None
+    config.USER_COOLDOWN = 0
+    config.CHANNEL_COOLDOWN = 0
+    config.API_RATE_LIMIT = args.rate_limit
+    config.API_RATE_BURST = args.rate_limit
+    config.API_ENDPOINT_RATE_LIMITS = {endpoint: (args.rate_limit, args.rate_limit)
+                                       for endpoint in RateLimiter.endpoint_rates}
+    return config
+
+
+def make_queries(args, names: list) -> list:
+    rnd = random.Random(args.seed)
+    # a few names are looked up far more often than the rest, just like on a real server
+    popular = names[:args.distinct_names]
+    weights = [1 / (i + 1) for i in range(len(popular))]
+    queries = []
+    for _ in range(args.messages):
+        kind = rnd.random()
+        if kind < args.multi_share:
+            query = ', '.join(rnd.choices(popular, weights, k=3))
+        elif kind < args.multi_share + args.all_share:
+            query = '-all ' + rnd.choices(popular, weights)[0]
+        else:
+            query = rnd.choices(popular, weights)[0]
+        queries.append(query)
+    return queries
+
+
+async def run(args) -> None:
+    fake = FakeAoe2net(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                       hang_rate=args.hang_rate, players=args.players, seed=args.seed)
+    host = await fake.start()
+    config = load_config(args, host)
+
+    sys.argv = sys.argv[:1]
+    import elobot
+
+    if elobot.mirror is not None:
+        began = time.perf_counter()
+        await elobot.mirror.sync()
+        print(f'Mirror synced {len(elobot.mirror)} rows in {time.perf_counter() - began:.2f}s')
+        fake.calls.clear()
+        fake.not_modified = 0
+        fake.bytes_sent = 0
+
+    queries = make_queries(args, [row['name'] for row in fake.leaderboard])
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(i, query):
+        nonlocal errors
+        channel = SyntheticChannel(i)
+        message = SyntheticMessage(f'{config.DISCORD_TRIGGER} {query}', SyntheticUser(i, f'user{i}'), channel)
+        async with semaphore:
+            began = time.perf_counter()
+            await elobot.on_message(message)
+        if channel.replied_at is not None:
+            latencies.append(channel.replied_at - began)
+        if not channel.replies or any('error occured' in reply or 'busy' in reply for reply in channel.replies):
+            errors += 1
+
+    began = time.perf_counter()
+    await asyncio.gather(*[one(i, query) for i, query in enumerate(queries)])
+    elapsed = time.perf_counter() - began
+
+    print(f'Messages:     {len(queries)} at concurrency {args.concurrency} in {elapsed:.2f}s')
+    print(f'Throughput:   {len(queries) / elapsed:.1f} messages/s')
+    print('Latency (ms): p50 {:.1f}  p95 {:.1f}  p99 {:.1f}  max {:.1f}'.format(
+        *(1000 * percentile(latencies, p) for p in (50, 95, 99, 100))))
+    print(f'Failed:       {errors}')
+    print(f'Upstream:     {sum(fake.calls.values())} requests, {fake.not_modified} not modified, '
+          f'{fake.bytes_sent} bytes')
+    for endpoint, calls in sorted(fake.calls.items()):
+        print(f'  {endpoint:20} {calls}')
+    cache = elobot.api.cache
+    if cache is not None:
+        print(f'Cache:        {cache.hits} hits, {cache.stale_hits} stale, {cache.misses} misses, '
+              f'{cache.evictions} evictions')
+
+    await elobot.api.close()
+    if elobot.mirror is not None:
+        await elobot.mirror.api.close()
+    await fake.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of elobot against a fake aoe2.net')
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--distinct-names', type=int, default=40, help='number of different players searched')
+    parser.add_argument('--multi-share', type=float, default=0.1, help="share of 'a, b, c' queries")
+    parser.add_argument('--all-share', type=float, default=0.1, help="share of '-all' queries")
+    parser.add_argument('--mirror', action='store_true', help='answer from the leaderboard mirror')
+    parser.add_argument('--players', type=int, default=0, help='pad the fake leaderboard with made up players')
+    parser.add_argument('--latency', type=float, default=0.05, help='upstream latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--hang-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=float, default=1000, help='upstream requests per second')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
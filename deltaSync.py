@@ -0,0 +1,163 @@
+# deltaSync.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+
+import math
+
+
+class DeltaScheduler(object):
+    """
+    Class DeltaScheduler decides which rank ranges of a mirrored leaderboard are downloaded again
+    between two full syncs, see LeaderboardMirror.sync_deltas().
+
+    The leaderboard is cut into blocks of `block_size` ranks. A block becomes hot after a full sync
+    if one of its players finished a match within `active_window`, when somebody played in it since
+    its last download, or when somebody asks for one of its players (touch()). Hot blocks are
+    downloaded again after `hot_interval` seconds. Each download without changes doubles the
+    interval of a block, up to `max_interval` for cold blocks. Cold blocks are spread evenly over
+    that interval, so they are swept a few at a time and players who start playing in them are
+    found. Due blocks next to each other are merged into a single request of up to
+    `blocks_per_request` blocks.
+
+    Attributes
+    ----------
+    block_size : int
+        Ranks per block (default 100)
+    blocks_per_request : int
+        Most blocks downloaded with a single request (default 10)
+    hot_interval : float
+        Seconds between two downloads of a hot block (default 30)
+    max_interval : float
+        Seconds between two downloads of a cold block (default 7200)
+    active_window : float
+        Seconds since the last match for a player to count as active (default 3600)
+    """
+
+    block_size: int = 100
+    blocks_per_request: int = 10
+    hot_interval: float = 30
+    max_interval: float = 2 * 60 * 60
+    active_window: float = 60 * 60
+
+    def __init__(self, block_size: int = block_size, blocks_per_request: int = blocks_per_request,
+                 hot_interval: float = hot_interval, max_interval: float = max_interval,
+                 active_window: float = active_window) -> None:
+        self.block_size = block_size
+        self.blocks_per_request = blocks_per_request
+        self.hot_interval = hot_interval
+        self.max_interval = max_interval
+        self.active_window = active_window
+
+        self.blocks = 0
+        self._interval = {}  # block -> seconds between downloads
+        self._due = {}       # block -> time.time() of the next download
+
+    def hot_blocks(self) -> int:
+        """Returns the number of blocks that are downloaded more often than cold ones."""
+        return sum(1 for interval in self._interval.values() if interval < self.max_interval)
+
+    def block_of(self, rank: int) -> int:
+        return (rank - 1) // self.block_size
+
+    def ranks(self, first_block: int, last_block: int) -> tuple:
+        """Returns (start, count) of the ranks from the first to the last block."""
+        return first_block * self.block_size + 1, (last_block - first_block + 1) * self.block_size
+
+    def _activity_by_block(self, rows) -> dict:
+        # the most recent last_match_time per block
+        latest = {}
+        for row in rows:
+            if row.rank is not None and row.last_match_time:
+                block = self.block_of(row.rank)
+                if row.last_match_time > latest.get(block, 0):
+                    latest[block] = row.last_match_time
+        return latest
+
+    def _resize(self, total: int, now: float) -> None:
+        blocks = math.ceil((total or 0) / self.block_size)
+        for block in range(blocks, self.blocks):
+            self._interval.pop(block, None)
+            self._due.pop(block, None)
+        for block in range(self.blocks, blocks):
+            self._interval[block] = self.max_interval
+            self._due[block] = now + self.max_interval
+        self.blocks = blocks
+
+    def reset(self, rows, total: int, now: float) -> None:
+        """Starts over after a full sync: blocks with active players are hot, the others are swept slowly."""
+        self.blocks = math.ceil((total or 0) / self.block_size)
+        chunks = math.ceil(self.blocks / self.blocks_per_request) or 1
+        latest = self._activity_by_block(rows)
+        self._interval = {}
+        self._due = {}
+        for block in range(self.blocks):
+            if latest.get(block, 0) >= now - self.active_window:
+                self._interval[block] = self.hot_interval
+                self._due[block] = now + self.hot_interval
+            else:
+                self._interval[block] = self.max_interval
+                self._due[block] = now + self.max_interval * (block // self.blocks_per_request + 1) / chunks
+
+    def refreshed(self, first_block: int, last_block: int, changed: set, total: int, now: float) -> None:
+        """
+        Reschedules blocks after they were downloaded.
+
+        :param changed: the blocks in which players played since the last download
+        :param total: the number of players in the leaderboard, as reported with the rows
+        """
+        self._resize(total, now)
+        for block in range(first_block, min(last_block + 1, self.blocks)):
+            if block in changed:
+                interval = self.hot_interval
+            else:
+                interval = min(2 * self._interval.get(block, self.hot_interval), self.max_interval)
+            self._interval[block] = interval
+            self._due[block] = now + interval
+
+    def touch(self, rank: int, now: float) -> None:
+        """Makes the block of a rank hot and due, e.g. because somebody asked for a player in it."""
+        block = self.block_of(rank)
+        if block < self.blocks:
+            self._interval[block] = self.hot_interval
+            self._due[block] = min(self._due.get(block, now), now)
+
+    def due(self, now: float, max_requests: int) -> list:
+        """
+        Returns the rank ranges to download now, the most overdue first.
+
+        :param max_requests: the most ranges to return
+        :returns: A list of (first block, last block)
+        """
+        blocks = sorted(block for block, due in self._due.items() if due <= now)
+        runs = []
+        for block in blocks:
+            if runs and block == runs[-1][1] + 1 and block - runs[-1][0] < self.blocks_per_request:
+                runs[-1][1] = block
+            else:
+                runs.append([block, block])
+        runs.sort(key=lambda run: min(self._due[block] for block in range(run[0], run[1] + 1)))
+        return [tuple(run) for run in runs[:max_requests]]
@@ -24,13 +24,27 @@
 
 
 # IMPORTS
-from aoe2netAPI import Aoe2netAPI
+from aoe2netAPI import Aoe2netAsyncAPI, LEADERBOARDS
+from aoe2netCache import ResponseCache
+import aoe2netModels
+from leaderboardMirror import LeaderboardMirror
+from leaderboardSnapshot import LeaderboardSnapshot
+from rateLimit import Cooldown, QueueFull, RateLimiter, RequestQueue
+from metrics import Metrics
+from stringsRegistry import StringsRegistry
+from logQueue import SamplingFilter, start_logging
+from lobbyWatcher import LobbyWatcher, WatchEvent
+from ratingTrend import RatingHistoryCache, trend
+from sharding import APIServer, SharedAoe2netAPI, ShardSupervisor, default_address
+from resilience import CircuitBreaker, Resilience
+from profileLinks import ProfileLinks
 import sys
 import os
+import asyncio
 import logging
+import math
+import time
 from datetime import datetime
-from requests import Response
-from requests.exceptions import RequestException
 
 # this is the config.py file. You have to edit it to set your secret discord token
 import config
@@ -38,6 +52,7 @@ import config
 # third party modules
 import discord
 import timeago
+import aiohttp
 
 python_requires = '>=3.5'
 
@@ -46,28 +61,168 @@ python_requires = '>=3.5'
 # If at some point in the future this bot reaches a level in which it offers great functions that are unique,
 # you can think about a Twitch integration.
 
-client = discord.Client()
+# Sharded mode, see SHARD_PROCESSES in config.py. The main process starts the worker processes and answers
+# their API requests, the workers connect to discord. Workers find their shards in the environment.
+worker = os.environ.get('ELOBOT_WORKER')
+shard_processes = getattr(config, 'SHARD_PROCESSES', 1)
+shard_count = getattr(config, 'SHARD_COUNT', None) or (shard_processes if shard_processes > 1 else None)
+
+if worker is not None:
+    client = discord.AutoShardedClient(shard_ids=[int(i) for i in os.environ['ELOBOT_SHARD_IDS'].split(',')],
+                                       shard_count=int(os.environ['ELOBOT_SHARD_COUNT']))
+elif shard_count and shard_processes <= 1:
+    client = discord.AutoShardedClient(shard_count=shard_count)
+else:
+    client = discord.Client()
+
+# Runtime metrics, see -sys stats and the METRICS_PORT setting
+metrics = Metrics()
+
+# All requests to aoe2.net pass the same rate limiter, no matter which client sends them.
+rate_limiter = RateLimiter(rate=getattr(config, 'API_RATE_LIMIT', RateLimiter.rate),
+                           burst=getattr(config, 'API_RATE_BURST', RateLimiter.burst),
+                           endpoint_rates=getattr(config, 'API_ENDPOINT_RATE_LIMITS', None))
+
+# Where the API is found. Only change this to test the bot against a local server, see fakeAoe2net.py
+aoe2net = dict(protocol=getattr(config, 'AOE2NET_PROTOCOL', Aoe2netAsyncAPI.protocol),
+               host=getattr(config, 'AOE2NET_HOST', Aoe2netAsyncAPI.host))
+
+# One API client for the whole bot, so all queries share the same connection pool and response cache.
+# Workers in sharded mode send their requests to the main process instead, so they share its cache and rate limit.
+if worker is not None:
+    api = SharedAoe2netAPI(os.environ['ELOBOT_API_ADDRESS'], metrics=metrics)
+else:
+    # When aoe2.net is slow or down, queries are answered within a deadline, from stale data if need be.
+    resilience = Resilience(deadlines=getattr(config, 'API_DEADLINES', None),
+                            retries=getattr(config, 'API_RETRIES', Resilience.retries),
+                            hedge_percentile=getattr(config, 'API_HEDGE_PERCENTILE', Resilience.hedge_percentile),
+                            breaker=CircuitBreaker(getattr(config, 'CIRCUIT_FAILURE_THRESHOLD',
+                                                           CircuitBreaker.failure_threshold),
+                                                   getattr(config, 'CIRCUIT_RESET_TIMEOUT',
+                                                           CircuitBreaker.reset_timeout)))
+    api = Aoe2netAsyncAPI(cache=ResponseCache(), rate_limiter=rate_limiter, metrics=metrics, resilience=resilience,
+                          **aoe2net)
+
+# Flood protection: users and channels have to wait a bit between two queries, and if too many
+# queries are waiting already, new ones are turned down instead of being answered minutes later.
+user_cooldown = Cooldown(getattr(config, 'USER_COOLDOWN', 5))
+channel_cooldown = Cooldown(getattr(config, 'CHANNEL_COOLDOWN', 1))
+cooldown_notice = Cooldown(getattr(config, 'USER_COOLDOWN', 5))
+queries = RequestQueue(concurrency=getattr(config, 'MAX_CONCURRENT_QUERIES', 20),
+                       max_waiting=getattr(config, 'MAX_WAITING_QUERIES', 100))
+
+# Local copy of the leaderboards, kept up to date by a background job that is started in on_ready.
+# The sync job gets its own client without a cache, there's no point in caching pages of 10000 rows.
+# Pages that big take a while to download, so its timeout is a lot longer than the one for queries.
+# Nor does it keep them for conditional requests, the mirror holds the rows already.
+# In sharded mode only the main process syncs, the workers reload the rows from its snapshot.
+snapshot_path = getattr(config, 'LEADERBOARD_SNAPSHOT', 'leaderboard.sqlite')
+if getattr(config, 'LEADERBOARD_MIRROR', True) and worker is not None:
+    mirror = LeaderboardMirror(api, snapshot=LeaderboardSnapshot(snapshot_path)) if snapshot_path else None
+elif getattr(config, 'LEADERBOARD_MIRROR', True):
+    mirror = LeaderboardMirror(Aoe2netAsyncAPI(rate_limiter=rate_limiter, metrics=metrics, validator_size=0,
+                                               timeout=getattr(config, 'LEADERBOARD_SYNC_TIMEOUT', 120), **aoe2net),
+                               sync_interval=getattr(config, 'LEADERBOARD_SYNC_INTERVAL',
+                                                     LeaderboardMirror.sync_interval),
+                               delta_interval=getattr(config, 'LEADERBOARD_DELTA_INTERVAL',
+                                                      LeaderboardMirror.delta_interval),
+                               snapshot=LeaderboardSnapshot(snapshot_path) if snapshot_path else None)
+else:
+    mirror = None
+mirror_task = None
+metrics_task = None
+
+# Names of civs, maps etc. by id, loaded once in the background, so match details need no extra requests
+strings = StringsRegistry(api)
+strings_task = None
+
+# Rating histories of recently asked for players, see '-trend'. Repeat queries only download the newest ratings.
+histories = RatingHistoryCache(api, max_players=getattr(config, 'TREND_MAX_PLAYERS', RatingHistoryCache.max_players))
+
+# Tells channels when the players they watch join or start a lobby, see '-watch'
+watcher_task = None
+
+if api.cache is not None:
+    metrics.gauge('cache_entries', 'Cached API responses', lambda: len(api.cache))
+    metrics.counter('cache_requests_total', 'Cache lookups by result',
+                    lambda: {('hit',): api.cache.hits, ('stale',): api.cache.stale_hits, ('miss',): api.cache.misses},
+                    labels=('result',))
+    metrics.counter('cache_evictions_total', 'Cached API responses evicted', lambda: api.cache.evictions)
+if api.resilience is not None:
+    metrics.counter('api_retries_total', 'API requests sent again after a failure', lambda: api.resilience.retried)
+    metrics.counter('api_hedged_total', 'Second API requests sent because the first one was slow',
+                    lambda: api.resilience.hedged)
+    metrics.gauge('api_circuit_open', '1 while requests to aoe2.net are stopped because it keeps failing',
+                  lambda: int(api.resilience.breaker.state != CircuitBreaker.CLOSED))
+    metrics.counter('api_circuit_opened_total', 'Times requests to aoe2.net were stopped',
+                    lambda: api.resilience.breaker.opened)
+metrics.counter('api_stale_responses_total', 'Last good responses returned because aoe2.net failed',
+                lambda: api.stale_served)
+metrics.gauge('queries_running', 'Queries being processed', lambda: queries.running)
+metrics.gauge('queries_waiting', 'Queries waiting for their turn', lambda: queries.waiting)
+metrics.counter('queries_shed_total', 'Queries turned down because too many were waiting', lambda: queries.shed)
+if mirror is not None:
+    metrics.gauge('mirror_rows', 'Leaderboard rows in the local mirror', lambda: len(mirror))
+    metrics.gauge('mirror_hot_blocks', 'Rank ranges of the mirror with active players',
+                  lambda: sum(scheduler.hot_blocks() for scheduler in mirror.schedulers.values()))
+    metrics.counter('mirror_delta_requests_total', 'Requests sent by delta syncs of the mirror',
+                    lambda: mirror.delta_requests)
+
+# the most players that can be searched with a single query
+MAX_SEARCHES = 5
+
+# steamID64s start here, profile_ids are much smaller
+STEAM_ID_BASE = 76561197960265728
+
+USAGE = F"`{config.DISCORD_TRIGGER} [<search string>[, <search string>...] | -help | -invite | -about ]`\n" \
+    F"`{config.DISCORD_TRIGGER} -all <search string>` search all leaderboards\n" \
+    F"`{config.DISCORD_TRIGGER} -last <search string>` show the current or last match\n" \
+    F"`{config.DISCORD_TRIGGER} -trend <search string>` show peak, streaks and recent rating changes\n" \
+    F"`{config.DISCORD_TRIGGER} -near <search string>` show the percentile and the players rated around\n" \
+    F"`{config.DISCORD_TRIGGER} -watch <search string>` tell this channel when the player joins or starts a game\n" \
+    F"`{config.DISCORD_TRIGGER} -unwatch <search string>` stop watching the player\n" \
+    F"`{config.DISCORD_TRIGGER} -link <profile id or steam id>` make `{config.DISCORD_TRIGGER}` without a name " \
+    F"show this player, `-unlink` to undo"
 
 # LOGGING
 
+# Log calls only queue the record, a background thread writes it, so the event loop never waits for the disk.
 logformat = '%(asctime)-19s %(name)s %(lineno)-3s %(levelname)-8s: %(message)s'
-logfilename = 'elobot.log'
+# in sharded mode every process writes its own file, so they don't rotate each other's files
+logfilename = 'elobot.log' if worker is None else F'elobot.worker{worker}.log'
+logfile_max_bytes = getattr(config, 'LOGFILE_MAX_BYTES', 10 * 1024 * 1024)
+logfile_backups = getattr(config, 'LOGFILE_BACKUPS', 5)
 
 if len(sys.argv) > 1 and sys.argv[1] in ['-d', '--debug'] or config.LOGLEVEL == 'debug':
-    logging.basicConfig(format=logformat, level=logging.DEBUG)
+    logfilename = None
+    log_handler = start_logging(logging.DEBUG, logformat)
 
 elif len(sys.argv) > 1 and sys.argv[1] in ['-i', '--info'] or config.LOGLEVEL == 'info':
-    logging.basicConfig(filename=logfilename, format=logformat, level=logging.INFO)
+    log_handler = start_logging(logging.INFO, logformat, logfilename, logfile_max_bytes, logfile_backups)
 
 else:
-    logging.basicConfig(filename=logfilename, format=logformat, level=logging.WARN)
+    log_handler = start_logging(logging.WARN, logformat, logfilename, logfile_max_bytes, logfile_backups)
 
 log = logging.getLogger(__name__)
+# one line per query, only a share of them is logged if QUERY_LOG_SAMPLE_RATE < 1
+query_log = logging.getLogger(F'{__name__}.queries')
+query_log_sampler = SamplingFilter(getattr(config, 'QUERY_LOG_SAMPLE_RATE', SamplingFilter.rate))
+query_log.addFilter(query_log_sampler)
+metrics.counter('log_records_dropped_total', 'Log records dropped because the log queue was full',
+                lambda: log_handler.dropped)
+metrics.counter('query_log_sampled_out_total', 'Query log lines left out by QUERY_LOG_SAMPLE_RATE',
+                lambda: query_log_sampler.dropped)
 logging.getLogger('discord.gateway').setLevel(logging.WARNING)
 logging.getLogger('discord.client').setLevel(logging.WARNING)
 logging.getLogger('websockets.protocol').setLevel(logging.WARN)
 log.debug('Log Level is DEBUG, therefore writing all log to standard output (and not to logfile).')
 
+# Which aoe2.net profile belongs to which discord user, see '-link'. A bare '!elo' shows the linked player.
+# In sharded mode all workers share the file and reload it when another worker changed it.
+links = ProfileLinks(getattr(config, 'PROFILE_LINKS', 'links.sqlite'))
+links.load()
+links_task = None
+
 
 @client.event
 async def on_ready():
@@ -77,11 +232,27 @@ async def on_ready():
     log.info(f'We have logged in as {client.user}')
     log.info(f'PID: {os.getpid()}')
 
+    # on_ready is called again after reconnects, make sure the mirror is only synced by one task
+    global mirror_task, metrics_task, strings_task, watcher_task, links_task
+    if mirror is not None and mirror_task is None:
+        mirror_task = client.loop.create_task(mirror.follow() if worker is not None else mirror.run())
+    if worker is not None and links_task is None:
+        links_task = client.loop.create_task(links.follow())
+    if strings_task is None:
+        strings_task = client.loop.create_task(strings.run())
+    if watcher_task is None:
+        watcher_task = client.loop.create_task(watcher.run())
+    if metrics_task is None:
+        metrics_task = client.loop.create_task(metrics.monitor_event_loop())
+        if getattr(config, 'METRICS_PORT', None):
+            # in sharded mode the main process uses METRICS_PORT, the workers the ports after it
+            port = config.METRICS_PORT + (1 + int(worker) if worker is not None else 0)
+            await metrics.serve(getattr(config, 'METRICS_HOST', '127.0.0.1'), port)
+
     # If the logging level is DEBUG, we have not set a logfile, so all logs are written to the console.
     # Otherwise, we print the information about the logfile to the console, so we can find it.
-    if not (log.root.level == logging.DEBUG):
-        logfile_handler = log.root.handlers[0]
-        print(F'The bot logging to "{logfile_handler.baseFilename}"')
+    if logfilename is not None:
+        print(F'The bot logging to "{os.path.abspath(logfilename)}"')
         print(F'We have logged in as {client.user}')
         print(F'PID: {os.getpid()}')
 
@@ -99,15 +270,15 @@ async def on_message(message: discord.Message):
     if message.content.startswith(config.DISCORD_TRIGGER):
         # print('message.channel object: ', message.channel)
 
-        # todo: implement logging to file
-        s = f'Query by {message.author}: {message.content} : '
-        if not (message.guild.name is None):
-            s += f'GuildName: {message.guild.name} '
-        if not (message.guild.owner is None):
-            s += f'GuildOwner: {message.guild.owner} '
-        if not (message.jump_url is None):
-            f'JumpURL {message.jump_url}'
-        log.info(s)
+        if query_log.isEnabledFor(logging.INFO):
+            s = f'Query by {message.author}: {message.content} : '
+            if not (message.guild.name is None):
+                s += f'GuildName: {message.guild.name} '
+            if not (message.guild.owner is None):
+                s += f'GuildOwner: {message.guild.owner} '
+            if not (message.jump_url is None):
+                s += f'JumpURL {message.jump_url}'
+            query_log.info(s)
 
         # read arguments
         args = message.content.split(' ', 1)
@@ -127,14 +298,11 @@ async def on_message(message: discord.Message):
                                                F"https://steamcommunity.com/groups/elostatsbot/ \n\n"
                                                F"**Github Project**\n"
                                                F"https://github.com/Heistergand/elobot \n\n"
-                                               F"**Usage** \n`{config.DISCORD_TRIGGER} "
-                                               F"[<search string> | -help | -invite | -about ]`")
+                                               F"**Usage** \n{USAGE}")
                     return
 
                 elif args[1] == '-help':
-                    await message.channel.send(F"<@{message.author.id}> \n"
-                                               F"`{config.DISCORD_TRIGGER} "
-                                               F"[<search string> | -help | -invite | -about ]`")
+                    await message.channel.send(F"<@{message.author.id}> \n{USAGE}")
                     return
                 elif args[1] == '-invite':
                     await message.channel.send(F"<@{message.author.id}> \n"
@@ -149,9 +317,21 @@ async def on_message(message: discord.Message):
                                                    F'meaning that you are actually running this bot. '
                                                    F'System commands affect the whole bot instance, not '
                                                    F'only this channel. Your available system commands are:\n\n'
+                                                   F"**show runtime statistics**\n"
+                                                   F"`{config.DISCORD_TRIGGER} -sys stats` \n"
                                                    F"**stop the bot instance**\n"
-                                                   F"`{config.DISCORD_TRIGGER} -sys quit` \n"
-                                                   F"(well... yes, that's the only one so far)")
+                                                   F"`{config.DISCORD_TRIGGER} -sys quit` \n")
+                    return
+
+                elif args[1] == '-sys stats' and message.author.__str__() == config.DISCORD_BOT_OWNER:
+                    message_text = F"```\n{metrics.summary()}\n```"
+                    if worker is not None:
+                        try:
+                            message_text = F"**Worker {worker}**{message_text}" \
+                                F"**Main process**```\n{await api.summary()}\n```"
+                        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                            log.warning(F'Reading the metrics of the main process failed: {e!r}')
+                    await message.channel.send(message_text[:2000])
                     return
 
                 # remember: args cannot have more than two elements, just like we split it.
@@ -162,74 +342,557 @@ async def on_message(message: discord.Message):
                                                    F"I can feel it, I can feel it, I can feel it, I'm afraid...*\n")
                     log.info(F'Bot is shutting down as requested by discord user {message.author}')
 
+                    await api.close()
+                    await metrics.close()
+                    await links.close()
+                    # workers don't write the snapshot, it belongs to the main process
+                    if mirror is not None and worker is None:
+                        await mirror.save_snapshot()
+                        await mirror.api.close()
                     quit()
                     return
 
             # done: call API, write results to chat
-            # todo: channel cool down
-            # todo: user cool down
+            # done: channel cool down
+            # done: user cool down
 
             # pdb.set_trace()
 
-            api = Aoe2netAPI()
             # search = None
 
             if args.__len__() == 1:
                 # await message.channel.send(F'<@{message.author.id}> \nDEBUG your message started with "{words[0]}", '
                 #                            F'you did not provide any parameters, so I will '
                 #                            F'search for your Name "{message.author.name}".')
-                search = message.author.name
+                search = ''
             else:
                 # await message.channel.send(F'<@{message.author.id}> \nDEBUG your message started with "{words[0]}", '
                 #                            F'search parameter was "{words[1]}"')
                 search = args[1]
 
-            # Query the leaderboard API
-            try:
-                api_response: Response = api.leaderboard(search=search, count=20)
-            except RequestException as e:
-                log.error(F'Internal error while trying to fetch data from ae2.net API. Exception was: {e}')
-                await message.channel.send(F"*<@{message.author.id}> "
-                                           F'An error occured while trying to query the API. Please try again later.*')
+            # Options taking a player, like '-all <player>'. Without a player, the author is used: their linked
+            # profile_id if they used '-link', their name otherwise.
+            # '-all' searches all leaderboards instead of 1v1 Random Map only
+            # '-last' shows the current or last match of a player
+            # '-trend' shows statistics of the rating history of a player
+            # '-near' shows the percentile of a player and the players around them
+            # '-watch' and '-unwatch' subscribe the channel to news about a player
+            # '-link' and '-unlink' set the player of the author
+            command = 'search'
+            for option in ('-all', '-last', '-trend', '-near', '-watch', '-unwatch', '-link', '-unlink'):
+                if search == option or search.startswith(option + ' '):
+                    command = option[1:]
+                    search = search[len(option):].strip()
+
+            # several players can be searched at once, separated by commas
+            searches = [s.strip() for s in search.split(',') if s.strip()][:MAX_SEARCHES] or \
+                [links.get(message.author.id) or message.author.name]
+            if command == 'search' and len(searches) > 1:
+                command = 'multi'
+
+            # cool downs: users and channels have to wait a bit between two queries
+            wait = max(user_cooldown.remaining(message.author.id), channel_cooldown.remaining(message.channel.id))
+            if wait > 0:
+                query_log.info(F'Ignoring query by {message.author}, cool down for another {wait:.1f}s')
+                # tell the user only once per cool down, not for every message they send meanwhile
+                if not cooldown_notice.hit(message.author.id):
+                    await message.channel.send(F"<@{message.author.id}> "
+                                               F"Easy there, please wait {math.ceil(wait)} more second(s).")
                 return
+            user_cooldown.hit(message.author.id)
+            channel_cooldown.hit(message.channel.id)
 
-            if not api_response.ok:
+            began = time.perf_counter()
+            try:
+                async with queries:
+                    if command == 'last':
+                        await send_last_match(message, searches[0])
+                    elif command == 'trend':
+                        await send_trend(message, searches[0])
+                    elif command == 'near':
+                        await send_near(message, searches[0])
+                    elif command in ('watch', 'unwatch'):
+                        await send_watch(message, searches[0], command == 'watch')
+                    elif command == 'link':
+                        await send_link(message, search)
+                    elif command == 'unlink':
+                        await send_unlink(message)
+                    else:
+                        await send_leaderboard(message, searches, list(LEADERBOARDS) if command == 'all' else [3])
+                    metrics.commands.observe(time.perf_counter() - began, command)
+            except QueueFull:
+                log.warning(F'Too many queries waiting, turning down the query by {message.author}')
                 await message.channel.send(F"*<@{message.author.id}> "
-                                           F'An error occured while trying to query the API. Please try again later. '
-                                           F'(It''s not your fault.)*')
-                log.warning(f'API Response was not OK. {api_response}')
+                                           F"I'm very busy right now. Please try again in a minute.*")
+
+
+async def lookup(search, leaderboard_id: int, count: int) -> list:
+    """
+    Returns the leaderboard rows matching the search, from the mirror if it's loaded, otherwise from the API.
+    The search is a player name, or the profile_id (int) of a linked player, which is looked up exactly.
+    """
+    if isinstance(search, int):
+        return await lookup_exact(leaderboard_id, profile_id=search)
+
+    if mirror is not None and mirror.ready(leaderboard_id):
+        rows = mirror.search(leaderboard_id, search, count=count)
+        if rows:
+            touch(leaderboard_id, rows[0].profile_id)
+        return rows
+
+    api_response = await api.leaderboard(leaderboard_id=leaderboard_id, search=search, count=count)
+    api_response.raise_for_status()
+    total, rows = aoe2netModels.leaderboard(api_response.content)
+    return rows
+
+
+def touch(leaderboard_id: int, profile_id: int) -> None:
+    """Marks a player people are interested in, so the mirror keeps their part of the leaderboard fresh."""
+    if worker is not None:
+        # the main process syncs the mirror
+        api.touch(leaderboard_id, profile_id)
+    else:
+        mirror.touch(leaderboard_id, profile_id)
+
+
+async def lookup_exact(leaderboard_id: int, profile_id: int = None, steam_id: int = None) -> list:
+    """Returns the leaderboard row of a player by profile_id or steam_id, as a list of one row or none."""
+    if mirror is not None and mirror.ready(leaderboard_id):
+        if profile_id is not None:
+            row = mirror.by_profile_id(leaderboard_id, profile_id)
+        else:
+            row = mirror.by_steam_id(leaderboard_id, steam_id)
+        if row is None:
+            return []
+        touch(leaderboard_id, row.profile_id)
+        return [row]
+
+    api_response = await api.leaderboard(leaderboard_id=leaderboard_id, profile_id=profile_id, steam_id=steam_id)
+    api_response.raise_for_status()
+    total, rows = aoe2netModels.leaderboard(api_response.content)
+    return rows[:1]
+
+
+def stale_notice() -> str:
+    """A line for replies while aoe2.net is failing, because they may be answered from old data."""
+    if api.degraded():
+        return '\n*aoe2.net is not answering right now, this may be out of date.*'
+    return ''
+
+
+def format_row(row) -> str:
+    last_match_time = int(row.last_match_time)
+    # last_match_time_str =
+    # datetime.utcfromtimestamp(last_match_time).strftime('%Y-%m-%d %H:%M:%S UTC')
+    last_seen = timeago.format(datetime.utcfromtimestamp(last_match_time),
+                               datetime.utcnow(),
+                               locale='en_EN')
+    return F'\n**{row.name}** ' \
+        F'#{row.rank}, ' \
+        F'Rating: **{row.rating}**, ' \
+        F'Last match: **{last_seen}**'
+
+
+async def find_leaderboard(search, leaderboard_ids: tuple = (3, 4, 0)) -> tuple:
+    """
+    Returns the first of the leaderboards a player is found in and the row of the best match, as a tuple
+    (leaderboard_id, row), or (None, None).
+    """
+    for leaderboard_id in leaderboard_ids:
+        rows = await lookup(search, leaderboard_id, count=1)
+        if rows:
+            return leaderboard_id, rows[0]
+    return None, None
+
+
+async def find_player(search):
+    """Returns the leaderboard row of the best match for a player name, or None."""
+    leaderboard_id, player = await find_leaderboard(search)
+    return player
+
+
+def search_name(search) -> str:
+    """How a search is called in replies. Linked players are searched by profile_id, their name is unknown then."""
+    if isinstance(search, int):
+        return F'your linked player (profile id {search})'
+    return search
+
+
+def format_match(match) -> str:
+    """Describes a match with map, civs and players, using the preloaded strings."""
+    if match.leaderboard_id is not None:
+        kind = strings.leaderboard(match.leaderboard_id)
+    else:
+        kind = strings.game_type(match.game_type)
+    started = match.started or match.opened
+    text = F"*{kind}* on **{strings.map_type(match.map_type)}**"
+    if started:
+        text += F", started {timeago.format(datetime.utcfromtimestamp(started), datetime.utcnow(), locale='en_EN')}"
+
+    teams = {}
+    for player in match.players:
+        teams.setdefault(player.team, []).append(player)
+    for team, players in sorted(teams.items(), key=lambda item: (item[0] is None, item[0] or 0)):
+        text += F"\nTeam {team if team is not None and team > 0 else '-'}: "
+        text += ', '.join(F"**{player.name}**{F' ({player.rating})' if player.rating else ''} "
+                          F"as *{strings.civ(player.civ)}*{' (won)' if player.won else ''}"
+                          for player in players)
+    return text
+
+
+async def send_last_match(message: discord.Message, search: str):
+    try:
+        player = await find_player(search)
+        if player is None:
+            await message.channel.send(F"<@{message.author.id}> "
+                                       F"Sorry, there was no result for *{search_name(search)}*.")
+            return
+
+        api_response = await api.lastmatch(profile_id=player.profile_id)
+        api_response.raise_for_status()
+        _, match = aoe2netModels.lastmatch(api_response.content)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        log.error(F'Internal error while trying to fetch data from ae2.net API. Exception was: {e!r}')
+        await message.channel.send(F"*<@{message.author.id}> "
+                                   F'An error occured while trying to query the API. '
+                                   F'Please try again later.*')
+        return
+
+    if match is None:
+        await message.channel.send(F"<@{message.author.id}> "
+                                   F"Sorry, I found no match of **{player.name}**.")
+        return
+
+    await message.channel.send(F"<@{message.author.id}> \n**{player.name}** "
+                               F"{'last played' if match.finished else 'is playing'} {format_match(match)}"
+                               F"{stale_notice()}")
+
+
+def format_signed(value: int) -> str:
+    return F"{'+' if value > 0 else ''}{value}"
+
+
+def format_streak(count: int, won: bool) -> str:
+    if won:
+        return F"{count} win{'s' if count != 1 else ''}"
+    return F"{count} loss{'es' if count != 1 else ''}"
+
+
+async def send_trend(message: discord.Message, search: str):
+    try:
+        # rating histories only exist for the ranked leaderboards
+        leaderboard_id, player = await find_leaderboard(search, (3, 4, 1, 2))
+        if player is None:
+            await message.channel.send(F"<@{message.author.id}> "
+                                       F"Sorry, there was no result for *{search_name(search)}*.")
+            return
+
+        history = await histories.get(player.profile_id, leaderboard_id)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        log.error(F'Internal error while trying to fetch data from ae2.net API. Exception was: {e!r}')
+        await message.channel.send(F"*<@{message.author.id}> "
+                                   F'An error occured while trying to query the API. '
+                                   F'Please try again later.*')
+        return
+
+    result = trend(history)
+    if result is None:
+        await message.channel.send(F"<@{message.author.id}> "
+                                   F"Sorry, I found no rating history of **{player.name}**.")
+        return
+
+    now = datetime.utcnow()
+
+    def ago(timestamp):
+        return timeago.format(datetime.utcfromtimestamp(timestamp), now, locale='en_EN')
+
+    message_text = F"<@{message.author.id}> \n**{player.name}** in *{LEADERBOARDS[leaderboard_id]}*, " \
+        F"{result.games} rated games: **{result.rating}**\n" \
+        F"Peak **{result.peak}** ({ago(result.peak_at)}), low **{result.low}** ({ago(result.low_at)})\n"
+    message_text += 'Rating change ' + ', '.join(F"in the last {days} days: **{format_signed(change)}** ({games} games)"
+                                                 for days, (change, games) in result.changes.items()) + '\n'
+    message_text += 'Average rating ' + ', '.join(F"of the last {window} games: {average:.0f}"
+                                                  for window, average in result.averages.items()) + '\n'
+    if result.streak:
+        message_text += F"Streak: {format_streak(abs(result.streak), result.streak > 0)}, " \
+            F"longest {format_streak(result.longest_win_streak, True)} " \
+            F"and {format_streak(result.longest_loss_streak, False)}\n"
+    message_text += F"Volatility: ±{result.volatility:.1f} per game"
+    await message.channel.send(message_text + stale_notice())
+
+
+async def neighbors(player, leaderboard_id: int, count: int) -> tuple:
+    """
+    Returns the players rated right above and below a player, from the mirror if it's loaded, otherwise
+    with a single request for the rows around the player's rank.
+
+    :returns: A tuple (rows, i, percentile, total): the rows, the player's position in them, the share of
+        players rated lower and the number of players in the leaderboard.
+    """
+    if mirror is not None and mirror.ready(leaderboard_id):
+        ratings = mirror.ratings(leaderboard_id)
+        rows, i = ratings.neighbors(player.profile_id, count)
+        if rows is not None:
+            return rows, i, ratings.percentile(player.rating), len(ratings)
+
+    start = max(1, (player.rank or 1) - count)
+    api_response = await api.leaderboard(leaderboard_id=leaderboard_id, start=start, count=2 * count + 1)
+    api_response.raise_for_status()
+    total, rows = aoe2netModels.leaderboard(api_response.content)
+    i = next((i for i, row in enumerate(rows) if row.profile_id == player.profile_id), None)
+    percentile = 100.0 * (total - player.rank) / total if total and player.rank else 0.0
+    return rows, i, percentile, total
+
+
+async def send_near(message: discord.Message, search):
+    try:
+        if isinstance(search, int):
+            # a linked player, they may only play team games or unranked
+            leaderboard_id, player = await find_leaderboard(search)
+        else:
+            leaderboard_id, player = await find_leaderboard(search, (3,))
+        if player is None:
+            await message.channel.send(F"<@{message.author.id}> "
+                                       F"Sorry, there was no result for *{search_name(search)}*.")
+            return
+        rows, i, percentile, total = await neighbors(player, leaderboard_id, count=2)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        log.error(F'Internal error while trying to fetch data from ae2.net API. Exception was: {e!r}')
+        await message.channel.send(F"*<@{message.author.id}> "
+                                   F'An error occured while trying to query the API. '
+                                   F'Please try again later.*')
+        return
+
+    message_text = F"<@{message.author.id}> \n**{player.name}** is rated **{player.rating}**, higher than " \
+        F"{percentile:.1f}% of the {total} players in *{LEADERBOARDS[leaderboard_id]}*"
+    for j, row in enumerate(rows):
+        name = F"**{row.name}**" if j == i else row.name
+        message_text += F"\n#{row.rank} {name}: {row.rating}"
+    await message.channel.send(message_text + stale_notice())
+
+
+async def send_watch(message: discord.Message, search: str, watch: bool):
+    try:
+        player = await find_player(search)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        log.error(F'Internal error while trying to fetch data from ae2.net API. Exception was: {e!r}')
+        await message.channel.send(F"*<@{message.author.id}> "
+                                   F'An error occured while trying to query the API. '
+                                   F'Please try again later.*')
+        return
+
+    if player is None:
+        await message.channel.send(F"<@{message.author.id}> "
+                                   F"Sorry, there was no result for *{search_name(search)}*.")
+    elif not watch:
+        if watcher.unwatch(message.channel.id, player.profile_id):
+            await message.channel.send(F"<@{message.author.id}> This channel no longer watches **{player.name}**.")
+        else:
+            await message.channel.send(F"<@{message.author.id}> This channel does not watch **{player.name}**.")
+    elif watcher.watch(message.channel.id, player.profile_id, player.name):
+        await message.channel.send(F"<@{message.author.id}> I will tell this channel when **{player.name}** "
+                                   F"joins or starts a lobby.")
+    else:
+        await message.channel.send(F"<@{message.author.id}> Sorry, this channel already watches "
+                                   F"{watcher.max_per_channel} players.")
+
+
+async def send_link(message: discord.Message, text: str):
+    if not text:
+        profile_id = links.get(message.author.id)
+        if profile_id is None:
+            await message.channel.send(F"<@{message.author.id}> You have not linked a player yet. Use "
+                                       F"`{config.DISCORD_TRIGGER} -link <profile id or steam id>`.")
+        else:
+            await message.channel.send(F"<@{message.author.id}> You are linked to the profile id **{profile_id}**.")
+        return
+    if not text.isdigit():
+        await message.channel.send(F"<@{message.author.id}> Please give me your aoe2.net profile id or your "
+                                   F"steam id, like `{config.DISCORD_TRIGGER} -link 459658`.")
+        return
+
+    number = int(text)
+    try:
+        for leaderboard_id in (3, 4, 0):
+            if number >= STEAM_ID_BASE:
+                rows = await lookup_exact(leaderboard_id, steam_id=number)
             else:
-                result = api_response.json()
+                rows = await lookup_exact(leaderboard_id, profile_id=number)
+            if rows:
+                break
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        log.error(F'Internal error while trying to fetch data from ae2.net API. Exception was: {e!r}')
+        await message.channel.send(F"*<@{message.author.id}> "
+                                   F'An error occured while trying to query the API. '
+                                   F'Please try again later.*')
+        return
 
-                count = result["count"]
-                if count == 0:
-                    await message.channel.send(F"<@{message.author.id}> "
-                                               F"Sorry, there was no result for *{search}*.")
-                else:
-                    message_text = F"<@{message.author.id}> \n***" \
-                        F"Age of Empires II DE Leaderboard*** returned **{count}** "
-
-                    message_text += F"result{'s' if count > 1 else ''}: "
-
-                    for leaderboard in sorted(result["leaderboard"],
-                                              key=lambda item: item["last_match_time"],
-                                              reverse=True):
-                        name = leaderboard["name"]
-                        rank = leaderboard["rank"]
-                        rating = leaderboard["rating"]
-                        last_match_time = int(leaderboard["last_match_time"])
-                        # last_match_time_str =
-                        # datetime.utcfromtimestamp(last_match_time).strftime('%Y-%m-%d %H:%M:%S UTC')
-                        last_seen = timeago.format(datetime.utcfromtimestamp(last_match_time),
-                                                   datetime.utcnow(),
-                                                   locale='en_EN')
-                        # total = result["total"]
-                        message_text += F'\n**{name}** ' \
-                            F'#{rank}, ' \
-                            F'Rating: **{rating}**, ' \
-                            F'Last match: **{last_seen}**'
-
-                    await message.channel.send(message_text)
-
-
-client.run(config.DISCORD_TOKEN)
+    if not rows:
+        await message.channel.send(F"<@{message.author.id}> "
+                                   F"Sorry, I found no ranked player with the id *{text}*.")
+        return
+    links.link(message.author.id, rows[0].profile_id)
+    await message.channel.send(F"<@{message.author.id}> Linked you to **{rows[0].name}**. "
+                               F"`{config.DISCORD_TRIGGER}` without a name now shows this player.")
+
+
+async def send_unlink(message: discord.Message):
+    if links.unlink(message.author.id):
+        await message.channel.send(F"<@{message.author.id}> Your link is removed, "
+                                   F"`{config.DISCORD_TRIGGER}` without a name searches your name again.")
+    else:
+        await message.channel.send(F"<@{message.author.id}> You have not linked a player.")
+
+
+def format_watch_event(event: WatchEvent) -> str:
+    if event.kind == WatchEvent.STARTED:
+        return F"**{event.name}** just started a {'ranked' if event.match.ranked else 'unranked'} match: " \
+            F"{format_match(event.match)}"
+    lobby = event.lobby
+    return F"**{event.name}** joined the lobby *{lobby.name}* " \
+        F"({strings.map_type(lobby.map_type)}, {lobby.num_players}/{lobby.num_slots} players)"
+
+
+async def notify_channel(channel_id: int, events: list):
+    channel = client.get_channel(channel_id)
+    if channel is None:
+        return
+    message_text = '\n'.join(format_watch_event(event) for event in events)
+    if len(message_text) > 2000:
+        message_text = message_text[:1997] + '...'
+    await channel.send(message_text)
+
+
+watcher = LobbyWatcher(api, notify_channel, poll_interval=getattr(config, 'LOBBY_POLL_INTERVAL',
+                                                                  LobbyWatcher.poll_interval))
+
+
+async def send_leaderboard(message: discord.Message, searches: list, leaderboard_ids: list):
+    # All lookups run at the same time, so several players or leaderboards take about as long as one.
+    lookups = [(search, leaderboard_id) for search in searches for leaderboard_id in leaderboard_ids]
+    count = 20 if len(lookups) == 1 else max(1, 20 // len(lookups))
+    results = await asyncio.gather(*[lookup(search, leaderboard_id, count) for search, leaderboard_id in lookups],
+                                   return_exceptions=True)
+
+    for result in results:
+        if isinstance(result, aiohttp.ClientResponseError):
+            log.warning(f'API Response was not OK. {result.status} {result.message}')
+        elif isinstance(result, (aiohttp.ClientError, asyncio.TimeoutError)):
+            log.error(F'Internal error while trying to fetch data from ae2.net API. Exception was: {result!r}')
+        elif isinstance(result, BaseException):
+            raise result
+
+    if all(isinstance(result, BaseException) for result in results):
+        if isinstance(results[0], aiohttp.ClientResponseError):
+            await message.channel.send(F"*<@{message.author.id}> "
+                                       F'An error occured while trying to query the API. '
+                                       F'Please try again later. (It''s not your fault.)*')
+        else:
+            await message.channel.send(F"*<@{message.author.id}> "
+                                       F'An error occured while trying to query the API. '
+                                       F'Please try again later.*')
+        return
+
+    if len(lookups) == 1:
+        rows = results[0]
+        leaderboard_id = leaderboard_ids[0]
+        if not rows and isinstance(searches[0], int):
+            # a linked player may only play team games or unranked, show the first leaderboard they are in
+            try:
+                leaderboard_id, player = await find_leaderboard(searches[0])
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                log.error(F'Internal error while trying to fetch data from ae2.net API. Exception was: {e!r}')
+                await message.channel.send(F"*<@{message.author.id}> "
+                                           F'An error occured while trying to query the API. '
+                                           F'Please try again later.*')
+                return
+            rows = [player] if player is not None else []
+        count = len(rows)
+        if count == 0:
+            await message.channel.send(F"<@{message.author.id}> "
+                                       F"Sorry, there was no result for *{search_name(searches[0])}*.")
+        else:
+            message_text = F"<@{message.author.id}> \n***" \
+                F"Age of Empires II DE Leaderboard*** returned **{count}** "
+
+            message_text += F"result{'s' if count > 1 else ''}"
+            if leaderboard_id != leaderboard_ids[0]:
+                message_text += F" in *{LEADERBOARDS[leaderboard_id]}*"
+            message_text += ': '
+
+            for leaderboard in sorted(rows,
+                                      key=lambda item: item.last_match_time,
+                                      reverse=True):
+                message_text += format_row(leaderboard)
+
+            await message.channel.send(message_text + stale_notice())
+        return
+
+    # linked players are searched by profile_id, call them by the name they have where they are found
+    names = {}
+    for (search, leaderboard_id), result in zip(lookups, results):
+        if isinstance(search, int) and isinstance(result, list) and result:
+            names.setdefault(search, result[0].name)
+
+    message_text = F"<@{message.author.id}> \n***Age of Empires II DE Leaderboards***"
+    for (search, leaderboard_id), result in zip(lookups, results):
+        message_text += F"\n*{names.get(search) or search_name(search)}* in **{LEADERBOARDS[leaderboard_id]}**: "
+        if isinstance(result, BaseException):
+            message_text += 'query failed'
+        elif not result:
+            message_text += 'no result'
+        else:
+            for leaderboard in sorted(result, key=lambda item: item.last_match_time, reverse=True):
+                message_text += format_row(leaderboard)
+    message_text += stale_notice()
+
+    # Discord does not accept messages longer than 2000 characters
+    if len(message_text) > 2000:
+        message_text = message_text[:1997] + '...'
+    await message.channel.send(message_text)
+
+
+def run_shards():
+    """Runs the API service and the leaderboard sync in this process and the shards in worker processes."""
+    address = getattr(config, 'SHARED_API_ADDRESS', None) or default_address()
+    server = APIServer(api, address, metrics, mirror,
+                       fresh_age=getattr(config, 'SHARED_API_FRESH_AGE', APIServer.fresh_age))
+    supervisor = ShardSupervisor([sys.executable, os.path.abspath(__file__)] + sys.argv[1:],
+                                 shard_count, shard_processes, address)
+
+    async def main():
+        await server.start()
+        tasks = [asyncio.ensure_future(metrics.monitor_event_loop())]
+        if mirror is not None:
+            tasks.append(asyncio.ensure_future(mirror.run()))
+        if getattr(config, 'METRICS_PORT', None):
+            await metrics.serve(getattr(config, 'METRICS_HOST', '127.0.0.1'), config.METRICS_PORT)
+        try:
+            await supervisor.run()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await server.close()
+            await api.close()
+            await metrics.close()
+            if mirror is not None:
+                await mirror.save_snapshot()
+                await mirror.api.close()
+
+    log.info(F'Running {shard_count} shards in {supervisor.processes} worker processes, PID: {os.getpid()}')
+    asyncio.get_event_loop().run_until_complete(main())
+
+
+# The bot is only started when this file is run, so benchmark.py can import it and drive on_message itself.
+if __name__ == '__main__':
+    if shard_processes > 1 and worker is None:
+        run_shards()
+    else:
+        try:
+            client.run(config.DISCORD_TOKEN)
+        finally:
+            # like run_shards(), keep the rows for the next start. client.run() closes its event
+            # loop, so the snapshot is written in a new one.
+            if mirror is not None and worker is None:
+                asyncio.set_event_loop(asyncio.new_event_loop())
+                asyncio.get_event_loop().run_until_complete(mirror.save_snapshot())
@@ -0,0 +1,256 @@
+# fakeAoe2net.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+
+"""
+A local stand-in for the aoe2.net API.
+
+It serves the recorded responses in the fixtures directory for every endpoint wrapped by
+Aoe2netAPI, with configurable latency and error injection. Use it to develop and benchmark the bot
+without hitting aoe2.net (see benchmark.py), or run it on its own and point the bot at it by setting
+AOE2NET_PROTOCOL = 'http' and AOE2NET_HOST = '127.0.0.1:8080' in config.py:
+
+    python3 fakeAoe2net.py --port 8080 --latency 0.1 --error-rate 0.01
+"""
+
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import random
+from collections import Counter
+
+from aiohttp import web
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+class FakeAoe2net(object):
+    """
+    Class FakeAoe2net is an aiohttp application replaying the aoe2.net fixtures.
+
+    Attributes
+    ----------
+    latency : float
+        Seconds every response is delayed (default 0)
+    jitter : float
+        Random extra delay of up to this many seconds (default 0)
+    error_rate : float
+        Share of requests answered with http status 500 (default 0)
+    hang_rate : float
+        Share of requests that are not answered for `hang` seconds, to test timeouts (default 0)
+    hang : float
+        Seconds a hanging request waits before it is answered (default 60)
+    compress : bool
+        Gzip response bodies for clients that accept it, like aoe2.net does (default True)
+    etags : bool
+        Send an ETag with every response and answer matching If-None-Match headers with
+        304 Not Modified (default True)
+    calls : Counter
+        Number of requests per endpoint
+    not_modified : int
+        Number of requests answered with 304 Not Modified
+    bytes_sent : int
+        Total size of all response bodies as sent, after compression
+    """
+
+    def __init__(self, fixtures: str = FIXTURES, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, hang_rate: float = 0.0, hang: float = 60.0, players: int = 0,
+                 seed: int = None, compress: bool = True, etags: bool = True) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.hang = hang
+        self.compress = compress
+        self.etags = etags
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.not_modified = 0
+        self.bytes_sent = 0
+        self._runner = None
+
+        def load(name):
+            with open(os.path.join(fixtures, f'{name}.json'), encoding='utf-8') as f:
+                return json.load(f)
+
+        self.leaderboard = load('leaderboard')['leaderboard']
+        self.lastmatch = load('lastmatch')
+        self.lobbies = load('lobbies')
+        self.matches = load('matches')
+        self.ratinghistory = load('ratinghistory')
+        self.strings = load('strings')
+        self.players = load('players')
+
+        if players > len(self.leaderboard):
+            self.leaderboard.extend(self._synthetic_rows(players - len(self.leaderboard)))
+
+    def _synthetic_rows(self, count: int) -> list:
+        # made up players below the recorded ones, so large leaderboards can be tested, too
+        syllables = ['ka', 'ro', 'vi', 'per', 'he', 'ra', 'dau', 'to', 'ax', 'mo', 'li', 'ze', 'nu', 'sho', 'tek']
+        template = self.leaderboard[-1]
+        rank = template['rank']
+        rating = template['rating']
+        rows = []
+        for i in range(count):
+            rank += 1
+            rating -= self.random.random() * 0.1
+            name = ''.join(self.random.choice(syllables) for _ in range(self.random.randint(2, 4)))
+            if self.random.random() < 0.2:
+                name = f'[{self.random.choice(syllables).upper()}] {name}'
+            row = dict(template, profile_id=1000000 + i, steam_id=str(76561198000000000 + i), rank=rank,
+                       rating=int(rating), name=name.capitalize(),
+                       last_match_time=template['last_match_time'] - self.random.randint(0, 86400 * 90))
+            rows.append(row)
+        return rows
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        routes = {
+            '/api/strings': self._strings,
+            '/api/leaderboard': self._leaderboard,
+            '/api/lobbies': self._lobbies,
+            '/api/lastmatch': self._lastmatch,
+            '/api/matches': self._matches,
+            '/api/ratinghistory': self._ratinghistory,
+            '/api/players': self._players,
+            '/api/stats/players': self._players,
+        }
+        for path, handler in routes.items():
+            app.router.add_get(path, self._wrap(path, handler))
+        return app
+
+    def _wrap(self, path: str, handler):
+        async def handle(request: web.Request) -> web.Response:
+            self.calls[path] += 1
+            delay = self.latency + self.random.random() * self.jitter
+            if self.hang_rate and self.random.random() < self.hang_rate:
+                delay = self.hang
+            if delay:
+                await asyncio.sleep(delay)
+            if self.error_rate and self.random.random() < self.error_rate:
+                return web.Response(status=500, text='Internal Server Error')
+
+            body = json.dumps(handler(request.query)).encode('utf-8')
+            headers = {}
+            if self.etags:
+                headers['ETag'] = etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+                if request.headers.get('If-None-Match') == etag:
+                    self.not_modified += 1
+                    return web.Response(status=304, headers=headers)
+            if self.compress and 'gzip' in request.headers.get('Accept-Encoding', ''):
+                body = gzip.compress(body, compresslevel=1)
+                headers['Content-Encoding'] = 'gzip'
+            self.bytes_sent += len(body)
+            return web.Response(body=body, headers=headers, content_type='application/json')
+        return handle
+
+    @staticmethod
+    def _page(items: list, query, first: int = 0) -> list:
+        start = int(query.get('start', first)) - first
+        count = int(query.get('count', 1))
+        return items[max(0, start):max(0, start) + count]
+
+    def _strings(self, query) -> dict:
+        return dict(self.strings, language=query.get('language', 'en'))
+
+    def _leaderboard(self, query) -> dict:
+        rows = self.leaderboard
+        if 'search' in query:
+            search = query['search'].casefold()
+            rows = [row for row in rows if search in row['name'].casefold()]
+        if 'profile_id' in query:
+            rows = [row for row in rows if str(row['profile_id']) == query['profile_id']]
+        if 'steam_id' in query:
+            rows = [row for row in rows if row['steam_id'] == query['steam_id']]
+        if len(rows) != len(self.leaderboard):
+            # like aoe2.net, filtered results ignore start
+            page = rows[:int(query.get('count', 1))]
+            start = 1
+        else:
+            page = self._page(rows, query, first=1)
+            start = int(query.get('start', 1))
+        return {'total': len(self.leaderboard), 'leaderboard_id': int(query.get('leaderboard_id', 3)),
+                'start': start, 'count': len(page), 'leaderboard': page}
+
+    def _lobbies(self, query) -> list:
+        return self.lobbies
+
+    def _lastmatch(self, query) -> dict:
+        return self.lastmatch
+
+    def _matches(self, query) -> list:
+        return self._page(self.matches, query)
+
+    def _ratinghistory(self, query) -> list:
+        return self._page(self.ratinghistory, query)
+
+    def _players(self, query) -> dict:
+        return self.players
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """
+        Starts serving in the running event loop.
+
+        :param port: the port to listen on, 0 picks a free one
+        :returns: The 'host:port' the server listens on, ready to be used as Aoe2netAPI.host
+        """
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        address = self._runner.addresses[0]
+        return f'{address[0]}:{address[1]}'
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the aoe2.net API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--fixtures', default=FIXTURES, help='directory with the recorded responses')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every response is delayed')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra delay of up to this many seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with status 500')
+    parser.add_argument('--hang-rate', type=float, default=0.0, help='share of requests that hang for --hang seconds')
+    parser.add_argument('--hang', type=float, default=60.0)
+    parser.add_argument('--players', type=int, default=0, help='pad the leaderboard with made up players')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    fake = FakeAoe2net(args.fixtures, args.latency, args.jitter, args.error_rate, args.hang_rate, args.hang,
+                       args.players, args.seed)
+    web.run_app(fake.app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,418 @@
+# leaderboardMirror.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+import aoe2netModels
+from aoe2netModels import LeaderboardRow
+from deltaSync import DeltaScheduler
+from leaderboardSnapshot import LeaderboardSnapshot
+from nameIndex import NameIndex
+from ratingIndex import RatingIndex
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderboardMirror(object):
+    """
+    Class LeaderboardMirror keeps a local copy of the aoe2.net leaderboards.
+
+    A background job pages through /api/leaderboard in bulk and stores the player rows in memory,
+    indexed by profile_id, steam_id, rank, player name (see NameIndex) and rating (see
+    RatingIndex). Queries are then answered locally, so aoe2.net is only hit by the sync job.
+
+    Full syncs are rare. In between, the sync job downloads the rank ranges where players are active
+    often and the others rarely, looking for due ranges every `delta_interval` seconds, see
+    DeltaScheduler. Players that dropped out of such a range are looked up one by one, so they show
+    up at their new rank. touch() tells the scheduler which players people ask for.
+
+    If a LeaderboardSnapshot is given, the rows are loaded from it when the sync job starts and
+    written back after every sync, so a restarted bot can answer queries right away. Other
+    processes can share the rows by following the snapshot instead of syncing themselves, see
+    follow().
+
+    Rows are LeaderboardRow records, see aoe2netModels.
+
+    Attributes
+    ----------
+    api : Aoe2netAsyncAPI
+        The API client used for syncing. It should not have a response cache, there's no point in
+        caching pages of 10000 rows.
+    game : str
+        The game to mirror (default 'aoe2de')
+    leaderboard_ids : tuple
+        The leaderboards to mirror (default all, 0 to 4)
+    page_size : int
+        Number of rows per request (default 10000, which is the maximum the API allows)
+    sync_interval : float
+        Seconds between two full syncs (default 21600)
+    retry_interval : float
+        Seconds to wait before trying again after a failed sync (default 60)
+    snapshot : LeaderboardSnapshot
+        Optional on-disk snapshot of the rows (default None)
+    delta_interval : float
+        Seconds between two looks for due rank ranges, 0 disables the delta sync (default 20)
+    max_delta_requests : int
+        Most rank ranges per leaderboard downloaded at a time (default 5)
+    max_player_requests : int
+        Most players per leaderboard looked up one by one at a time (default 5)
+    snapshot_interval : float
+        Least seconds between two snapshots written because of delta syncs (default 300)
+    schedulers : dict
+        The DeltaScheduler of each leaderboard
+    delta_requests : int
+        Number of requests sent by delta syncs
+    """
+
+    game: str = 'aoe2de'
+    leaderboard_ids: tuple = (0, 1, 2, 3, 4)
+    page_size: int = 10000
+    sync_interval: float = 6 * 60 * 60
+    retry_interval: float = 60
+    delta_interval: float = 20
+    max_delta_requests: int = 5
+    max_player_requests: int = 5
+    snapshot_interval: float = 5 * 60
+
+    def __init__(self, api, game: str = game, leaderboard_ids: tuple = leaderboard_ids,
+                 page_size: int = page_size, sync_interval: float = sync_interval,
+                 snapshot: LeaderboardSnapshot = None, delta_interval: float = delta_interval) -> None:
+        self.api = api
+        self.snapshot = snapshot
+        self.game = game
+        self.leaderboard_ids = tuple(leaderboard_ids)
+        self.page_size = page_size
+        self.sync_interval = sync_interval
+        self.delta_interval = delta_interval
+        self.schedulers = {lid: DeltaScheduler() for lid in self.leaderboard_ids}
+        self.delta_requests = 0
+
+        # players that dropped out of a downloaded rank range, to be looked up by profile_id
+        self._moved = {lid: OrderedDict() for lid in self.leaderboard_ids}
+        # True if delta syncs changed rows since the last snapshot
+        self._dirty = False
+
+        self._by_profile_id = {lid: {} for lid in self.leaderboard_ids}
+        self._by_steam_id = {lid: {} for lid in self.leaderboard_ids}
+        self._by_rank = {lid: {} for lid in self.leaderboard_ids}
+        self._names = {lid: NameIndex() for lid in self.leaderboard_ids}
+        self._ratings = {lid: RatingIndex() for lid in self.leaderboard_ids}
+
+        # time.time() of the last completed sync per leaderboard, None if it has never been synced
+        self.synced_at = {lid: None for lid in self.leaderboard_ids}
+
+    def __len__(self) -> int:
+        return sum(len(rows) for rows in self._by_profile_id.values())
+
+    def ready(self, leaderboard_id: int) -> bool:
+        """Returns True if the leaderboard has been loaded and can answer queries."""
+        return self.synced_at.get(leaderboard_id) is not None
+
+    def rows(self, leaderboard_id: int):
+        """Returns a view of all rows of a leaderboard."""
+        return self._by_profile_id[leaderboard_id].values()
+
+    def by_profile_id(self, leaderboard_id: int, profile_id: int) -> LeaderboardRow:
+        return self._by_profile_id[leaderboard_id].get(int(profile_id))
+
+    def by_steam_id(self, leaderboard_id: int, steam_id) -> LeaderboardRow:
+        return self._by_steam_id[leaderboard_id].get(str(steam_id))
+
+    def by_rank(self, leaderboard_id: int, rank: int) -> LeaderboardRow:
+        return self._by_rank[leaderboard_id].get(int(rank))
+
+    def search(self, leaderboard_id: int, text: str, count: int = 20) -> list:
+        """
+        Searches the player names of a leaderboard, see NameIndex.search.
+
+        :returns: Up to `count` rows, best hits first.
+        """
+        return self._names[leaderboard_id].search(text, count)
+
+    def ratings(self, leaderboard_id: int) -> RatingIndex:
+        """Returns the rating index of a leaderboard, for percentiles, histograms and neighbors."""
+        return self._ratings[leaderboard_id]
+
+    @staticmethod
+    def build_indexes(rows: list) -> tuple:
+        """Returns a NameIndex and a RatingIndex of the rows, to be passed to replace()."""
+        return NameIndex(rows), RatingIndex(rows)
+
+    def replace(self, leaderboard_id: int, rows: list, names: NameIndex = None,
+                synced_at: float = None, ratings: RatingIndex = None) -> None:
+        """
+        Replaces all rows of a leaderboard at once.
+
+        :param names: a NameIndex already built from the rows. Pass it if you built it in another
+            thread; building the index for a large leaderboard takes a while.
+        :param synced_at: when the rows were downloaded (default now)
+        :param ratings: a RatingIndex already built from the rows, like names
+        """
+        by_profile_id = {}
+        by_steam_id = {}
+        by_rank = {}
+        for row in rows:
+            by_profile_id[row.profile_id] = row
+            if row.steam_id:
+                by_steam_id[str(row.steam_id)] = row
+            if row.rank is not None:
+                by_rank[row.rank] = row
+
+        if names is None:
+            names = NameIndex(by_profile_id.values())
+        if ratings is None:
+            ratings = RatingIndex(by_profile_id.values())
+
+        # swap the complete indexes, so readers never see a half built leaderboard
+        self._by_profile_id[leaderboard_id] = by_profile_id
+        self._by_steam_id[leaderboard_id] = by_steam_id
+        self._by_rank[leaderboard_id] = by_rank
+        self._names[leaderboard_id] = names
+        self._ratings[leaderboard_id] = ratings
+        self.synced_at[leaderboard_id] = time.time() if synced_at is None else synced_at
+        self.schedulers[leaderboard_id].reset(by_profile_id.values(), len(by_profile_id), time.time())
+        self._moved[leaderboard_id].clear()
+
+    def update(self, leaderboard_id: int, rows: list) -> None:
+        """Inserts or updates single rows, e.g. from a live search result."""
+        by_profile_id = self._by_profile_id[leaderboard_id]
+        by_steam_id = self._by_steam_id[leaderboard_id]
+        by_rank = self._by_rank[leaderboard_id]
+        names = self._names[leaderboard_id]
+        ratings = self._ratings[leaderboard_id]
+        for row in rows:
+            old = by_profile_id.get(row.profile_id)
+            if old is not None and by_rank.get(old.rank) is old:
+                del by_rank[old.rank]
+            by_profile_id[row.profile_id] = row
+            if row.steam_id:
+                by_steam_id[str(row.steam_id)] = row
+            if row.rank is not None:
+                by_rank[row.rank] = row
+            names.update(row)
+            ratings.update(row)
+
+    async def fetch_pages(self, leaderboard_id: int) -> list:
+        """Downloads a complete leaderboard page by page and returns all rows."""
+        rows = []
+        start = 1
+        while True:
+            response = await self.api.leaderboard(game=self.game, leaderboard_id=leaderboard_id,
+                                                  start=start, count=self.page_size)
+            if not response.ok:
+                raise RuntimeError(f'Leaderboard {leaderboard_id} page at {start} failed: {response}')
+            total, entries = aoe2netModels.leaderboard(response.content)
+            rows.extend(entries)
+            start += len(entries)
+            if len(entries) < self.page_size or start > (total or 0):
+                return rows
+
+    async def sync_leaderboard(self, leaderboard_id: int) -> None:
+        began = time.monotonic()
+        rows = await self.fetch_pages(leaderboard_id)
+        # build the indexes in a worker thread, so the event loop keeps serving queries meanwhile
+        names, ratings = await asyncio.get_event_loop().run_in_executor(None, self.build_indexes, rows)
+        self.replace(leaderboard_id, rows, names, ratings=ratings)
+        logger.info(f'Mirrored leaderboard {leaderboard_id}: {len(rows)} rows '
+                    f'in {time.monotonic() - began:.1f}s')
+
+    async def sync(self) -> None:
+        """Syncs all mirrored leaderboards one after another."""
+        for leaderboard_id in self.leaderboard_ids:
+            try:
+                await self.sync_leaderboard(leaderboard_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f'Syncing leaderboard {leaderboard_id} failed, keeping the old rows: {e}')
+
+    def touch(self, leaderboard_id: int, profile_id: int) -> None:
+        """Marks a player as wanted, so the rank range around them is downloaded again soon."""
+        row = self._by_profile_id.get(leaderboard_id, {}).get(profile_id)
+        if row is not None and row.rank is not None:
+            self.schedulers[leaderboard_id].touch(row.rank, time.time())
+
+    async def sync_range(self, leaderboard_id: int, first_block: int, last_block: int) -> None:
+        """Downloads the rank range of some blocks of a leaderboard and updates the rows in place."""
+        scheduler = self.schedulers[leaderboard_id]
+        start, count = scheduler.ranks(first_block, last_block)
+        self.delta_requests += 1
+        response = await self.api.leaderboard(game=self.game, leaderboard_id=leaderboard_id,
+                                              start=start, count=count)
+        if not response.ok:
+            raise RuntimeError(f'Leaderboard {leaderboard_id} ranks {start} to {start + count - 1} failed: {response}')
+        total, rows = aoe2netModels.leaderboard(response.content)
+
+        by_profile_id = self._by_profile_id[leaderboard_id]
+        by_rank = self._by_rank[leaderboard_id]
+        before = {by_rank[rank].profile_id for rank in range(start, start + count) if rank in by_rank}
+        # blocks in which somebody played; rows that only shifted rank don't keep a block hot
+        changed = set()
+        for row in rows:
+            old = by_profile_id.get(row.profile_id)
+            if old is None or (old.rating, old.last_match_time) != (row.rating, row.last_match_time):
+                changed.add(scheduler.block_of(row.rank or start))
+        self.update(leaderboard_id, rows)
+
+        moved = self._moved[leaderboard_id]
+        for profile_id in before - {row.profile_id for row in rows}:
+            moved[profile_id] = None
+        self._dirty = self._dirty or bool(changed)
+        scheduler.refreshed(first_block, last_block, changed, total, time.time())
+
+    async def sync_player(self, leaderboard_id: int, profile_id: int) -> None:
+        """Downloads the row of a single player and updates it in place."""
+        self.delta_requests += 1
+        response = await self.api.leaderboard(game=self.game, leaderboard_id=leaderboard_id, profile_id=profile_id)
+        if not response.ok:
+            raise RuntimeError(f'Leaderboard {leaderboard_id} player {profile_id} failed: {response}')
+        _, rows = aoe2netModels.leaderboard(response.content)
+        if rows:
+            self.update(leaderboard_id, rows)
+            self._dirty = True
+            # the player moved, so did the players at their new rank
+            if rows[0].rank is not None:
+                self.schedulers[leaderboard_id].touch(rows[0].rank, time.time())
+
+    async def sync_deltas(self) -> None:
+        """Downloads the due rank ranges and the players that moved, of all loaded leaderboards."""
+        now = time.time()
+        for leaderboard_id in self.leaderboard_ids:
+            if not self.ready(leaderboard_id):
+                continue
+            jobs = [(self.sync_range, leaderboard_id, first_block, last_block) for first_block, last_block
+                    in self.schedulers[leaderboard_id].due(now, self.max_delta_requests)]
+            moved = self._moved[leaderboard_id]
+            for _ in range(min(len(moved), self.max_player_requests)):
+                profile_id, _ = moved.popitem(last=False)
+                jobs.append((self.sync_player, leaderboard_id, profile_id))
+            for job, *args in jobs:
+                try:
+                    await job(*args)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.warning(f'Delta sync of leaderboard {leaderboard_id} failed: {e}')
+
+    def next_sync_in(self) -> float:
+        """Returns the seconds until the oldest leaderboard is due for a sync, 0 if one is overdue."""
+        oldest = min((synced_at or 0) for synced_at in self.synced_at.values())
+        return max(0.0, oldest + self.sync_interval - time.time())
+
+    async def load_snapshot(self, force: bool = False) -> None:
+        """
+        Loads the rows from the snapshot. Leaderboards that were synced later are left alone.
+
+        The leaderboards are loaded one by one, 1v1 Random Map first, and each of them can be queried
+        as soon as it's loaded.
+
+        :param force: load all leaderboards, e.g. because the snapshot has delta syncs since the last full sync
+        """
+        if self.snapshot is None:
+            return
+
+        def load(leaderboard_id):
+            # reading and indexing happen in a worker thread, both take a while for large leaderboards
+            for synced_at, rows in self.snapshot.load((leaderboard_id,)).values():
+                return synced_at, rows, self.build_indexes(rows)
+            return None
+
+        began = time.monotonic()
+        # One leaderboard at a time, each one answers queries as soon as it's indexed. 1v1 Random Map
+        # goes first, most queries are for it.
+        for leaderboard_id in sorted(self.leaderboard_ids, key=lambda lid: lid != 3):
+            loaded = await asyncio.get_event_loop().run_in_executor(None, load, leaderboard_id)
+            if loaded is None:
+                continue
+            synced_at, rows, (names, ratings) = loaded
+            if force or synced_at > (self.synced_at[leaderboard_id] or 0):
+                self.replace(leaderboard_id, rows, names, synced_at, ratings)
+        logger.info(f'Loaded {len(self)} rows from leaderboard snapshot in {time.monotonic() - began:.1f}s')
+
+    async def save_snapshot(self) -> None:
+        """Writes all loaded leaderboards to the snapshot."""
+        if self.snapshot is None:
+            return
+
+        # collect the rows here, the worker thread must not iterate dicts the event loop may change
+        leaderboards = {leaderboard_id: (synced_at, list(self.rows(leaderboard_id)))
+                        for leaderboard_id, synced_at in self.synced_at.items() if synced_at is not None}
+        self._dirty = False
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, self.snapshot.save, leaderboards)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f'Writing the leaderboard snapshot failed: {e}')
+
+    async def run(self) -> None:
+        """Loads the snapshot, then syncs forever. Start this as a background task."""
+        await self.load_snapshot()
+        saved_at = time.monotonic()
+        while True:
+            if self.next_sync_in() == 0:
+                await self.sync()
+                await self.save_snapshot()
+                saved_at = time.monotonic()
+                if self.next_sync_in() == 0:
+                    # a leaderboard failed to sync, give aoe2.net some rest before trying again
+                    await asyncio.sleep(self.retry_interval)
+                continue
+
+            if not self.delta_interval:
+                await asyncio.sleep(self.next_sync_in())
+                continue
+
+            await self.sync_deltas()
+            if self._dirty and time.monotonic() - saved_at >= self.snapshot_interval:
+                await self.save_snapshot()
+                saved_at = time.monotonic()
+            await asyncio.sleep(min(self.delta_interval, self.next_sync_in()))
+
+    async def follow(self, interval: float = 30) -> None:
+        """
+        Reloads the rows whenever the snapshot file changes, forever. Start this as a background task
+        instead of run() in processes that share the rows of another process that syncs.
+
+        :param interval: seconds between two checks of the snapshot file
+        """
+        if self.snapshot is None:
+            return
+        modified = None
+        while True:
+            try:
+                mtime = os.path.getmtime(self.snapshot.path)
+            except OSError:
+                mtime = None
+            if mtime is not None and mtime != modified:
+                modified = mtime
+                await self.load_snapshot(force=True)
+            await asyncio.sleep(interval)
@@ -0,0 +1,122 @@
+# leaderboardSnapshot.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import zlib
+
+from aoe2netModels import LeaderboardRow
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderboardSnapshot(object):
+    """
+    Class LeaderboardSnapshot stores the rows of a LeaderboardMirror on disk.
+
+    The snapshot is a small SQLite file with one record per leaderboard, holding the time of the
+    sync and all LeaderboardRow records as zlib compressed JSON arrays of their field values.
+    Writing goes to a temporary file of its own that replaces the old snapshot only when it's
+    complete, so neither a crash nor two saves at the same time leave a broken snapshot behind.
+
+    Both methods block, run them in an executor when called from the event loop.
+
+    Attributes
+    ----------
+    path : str
+        The file name of the snapshot
+    """
+
+    # bump this if the stored format changes, older snapshots are then ignored
+    version: int = 2
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def save(self, leaderboards: dict) -> None:
+        """
+        Writes a snapshot.
+
+        :param leaderboards: {leaderboard_id: (synced_at, [LeaderboardRow])}
+        """
+        # in the same directory, so it can be renamed to the snapshot
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', prefix=f'{os.path.basename(self.path)}.',
+                                   dir=os.path.dirname(self.path) or '.')
+        os.close(fd)
+        try:
+            db = sqlite3.connect(tmp)
+            try:
+                db.execute(f'PRAGMA user_version = {self.version}')
+                db.execute('CREATE TABLE leaderboard ('
+                           'leaderboard_id INTEGER PRIMARY KEY, synced_at REAL, row_count INTEGER, rows BLOB)')
+                for leaderboard_id, (synced_at, rows) in leaderboards.items():
+                    values = [row.to_tuple() for row in rows]
+                    blob = zlib.compress(json.dumps(values, separators=(',', ':')).encode('utf-8'))
+                    db.execute('INSERT INTO leaderboard VALUES (?, ?, ?, ?)',
+                               (leaderboard_id, synced_at, len(rows), blob))
+                db.commit()
+            finally:
+                db.close()
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        logger.info(f'Wrote leaderboard snapshot {self.path} ({os.path.getsize(self.path)} bytes)')
+
+    def load(self, leaderboard_ids: tuple = None) -> dict:
+        """
+        Reads the snapshot.
+
+        :param leaderboard_ids: read only these leaderboards (default all)
+        :returns: {leaderboard_id: (synced_at, [LeaderboardRow])}, empty if there is no usable snapshot.
+        """
+        if not os.path.exists(self.path):
+            return {}
+
+        try:
+            db = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+            try:
+                if db.execute('PRAGMA user_version').fetchone()[0] != self.version:
+                    logger.warning(f'Ignoring leaderboard snapshot {self.path} of another version')
+                    return {}
+                query = 'SELECT * FROM leaderboard'
+                if leaderboard_ids is not None:
+                    query += f' WHERE leaderboard_id IN ({",".join("?" * len(leaderboard_ids))})'
+                leaderboards = {}
+                for leaderboard_id, synced_at, _, blob in db.execute(query, tuple(leaderboard_ids or ())):
+                    values = json.loads(zlib.decompress(blob))
+                    leaderboards[leaderboard_id] = (synced_at, [LeaderboardRow.from_tuple(v) for v in values])
+                return leaderboards
+            finally:
+                db.close()
+        except (sqlite3.Error, zlib.error, ValueError) as e:
+            logger.warning(f'Ignoring unreadable leaderboard snapshot {self.path}: {e}')
+            return {}
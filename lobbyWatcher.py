@@ -0,0 +1,221 @@
+# lobbyWatcher.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+
+import asyncio
+import logging
+from collections import defaultdict
+
+import aoe2netModels
+
+logger = logging.getLogger(__name__)
+
+
+class WatchEvent(object):
+    """Something a watched player did, see LobbyWatcher"""
+
+    __slots__ = ('kind', 'profile_id', 'name', 'lobby', 'match')
+
+    # the player joined an open lobby
+    JOINED = 'joined'
+    # the lobby of the player is gone, and their last match is the game started from it
+    STARTED = 'started'
+
+    def __init__(self, kind: str, profile_id: int, name: str, lobby, match=None) -> None:
+        self.kind = kind
+        self.profile_id = profile_id
+        self.name = name
+        self.lobby = lobby
+        self.match = match
+
+
+class LobbyWatcher(object):
+    """
+    Class LobbyWatcher notifies channels about what the players they watch are doing.
+
+    It polls /api/lobbies and compares every snapshot with the previous one by lobby_id. Only
+    lobbies whose players changed are looked at, and only their players are looked up in the index
+    of watched profile_ids, so the work per poll grows with the number of changes, not with the
+    number of lobbies, channels or watched players. When a lobby with a watched player disappears,
+    /api/lastmatch of that player tells whether the lobby was started.
+
+    Nothing is polled while nobody watches anybody.
+
+    Attributes
+    ----------
+    api : Aoe2netAsyncAPI
+        The API client
+    notify : coroutine function
+        Called as notify(channel_id, events) with the list of WatchEvents for a channel
+    game : str
+        The game whose lobbies are watched (default 'aoe2de')
+    poll_interval : float
+        Seconds between two polls (default 30)
+    max_per_channel : int
+        Maximum number of players a channel can watch (default 20)
+    """
+
+    game: str = 'aoe2de'
+    poll_interval: float = 30
+    max_per_channel: int = 20
+
+    def __init__(self, api, notify, game: str = game, poll_interval: float = poll_interval,
+                 max_per_channel: int = max_per_channel) -> None:
+        self.api = api
+        self.notify = notify
+        self.game = game
+        self.poll_interval = poll_interval
+        self.max_per_channel = max_per_channel
+
+        # profile_id -> {channel_id}, and channel_id -> {profile_id: name}
+        self._subscribers = defaultdict(set)
+        self._watched = defaultdict(dict)
+
+        # the previous snapshot: lobby_id -> (frozenset of profile_ids, lobby)
+        self._lobbies = None
+
+    def watch(self, channel_id: int, profile_id: int, name: str) -> bool:
+        """Lets a channel watch a player. Returns False if the channel is already watching too many players."""
+        watched = self._watched[channel_id]
+        if profile_id not in watched and len(watched) >= self.max_per_channel:
+            return False
+        watched[profile_id] = name
+        self._subscribers[profile_id].add(channel_id)
+        return True
+
+    def unwatch(self, channel_id: int, profile_id: int) -> bool:
+        """Stops a channel watching a player. Returns False if it wasn't watching them."""
+        watched = self._watched.get(channel_id)
+        if not watched or profile_id not in watched:
+            return False
+        del watched[profile_id]
+        if not watched:
+            del self._watched[channel_id]
+        subscribers = self._subscribers[profile_id]
+        subscribers.discard(channel_id)
+        if not subscribers:
+            del self._subscribers[profile_id]
+        return True
+
+    def watching(self, channel_id: int) -> dict:
+        """Returns {profile_id: name} of the players a channel watches."""
+        return dict(self._watched.get(channel_id, {}))
+
+    def _name(self, player) -> str:
+        # the name in the lobby is the current one, the one given to watch() may be outdated
+        if player.name:
+            return player.name
+        channel_id = next(iter(self._subscribers[player.profile_id]))
+        return self._watched[channel_id][player.profile_id]
+
+    def diff(self, lobbies: list) -> tuple:
+        """
+        Compares a lobby snapshot with the previous one.
+
+        :returns: A tuple (events, gone) with JOINED events for watched players that showed up in a
+            lobby, and the lobbies that disappeared as a list of (lobby, [watched players]).
+        """
+        previous = self._lobbies
+        current = {}
+        events = []
+        for lobby in lobbies:
+            members = frozenset(player.profile_id for player in lobby.players if player.profile_id)
+            current[lobby.lobby_id] = (members, lobby)
+            if previous is None:
+                continue
+            old = previous.get(lobby.lobby_id)
+            old_members = old[0] if old is not None else frozenset()
+            if members == old_members:
+                continue
+            for player in lobby.players:
+                if player.profile_id in self._subscribers and player.profile_id not in old_members:
+                    events.append(WatchEvent(WatchEvent.JOINED, player.profile_id,
+                                             self._name(player), lobby))
+
+        gone = []
+        if previous is not None:
+            for lobby_id in previous.keys() - current.keys():
+                members, lobby = previous[lobby_id]
+                players = [player for player in lobby.players if player.profile_id in self._subscribers]
+                if players:
+                    gone.append((lobby, players))
+
+        self._lobbies = current
+        return events, gone
+
+    async def _started(self, lobby, player):
+        # the lobby of a watched player is gone: it was either started or closed
+        response = await self.api.lastmatch(game=self.game, profile_id=player.profile_id, fresh=True)
+        response.raise_for_status()
+        _, match = aoe2netModels.lastmatch(response.content)
+        if match is not None and str(match.lobby_id) == str(lobby.lobby_id) and match.started:
+            return WatchEvent(WatchEvent.STARTED, player.profile_id, self._name(player),
+                              lobby, match)
+        return None
+
+    async def poll(self) -> None:
+        # the cache would answer with the lobbies of the last poll
+        response = await self.api.lobbies(game=self.game, fresh=True)
+        response.raise_for_status()
+        if getattr(response, 'stale', False):
+            # old lobbies would report joins and starts again, wait for aoe2.net to answer
+            return
+        events, gone = self.diff(aoe2netModels.lobbies(response.content))
+
+        started = await asyncio.gather(*[self._started(lobby, player) for lobby, players in gone
+                                         for player in players], return_exceptions=True)
+        for event in started:
+            if isinstance(event, WatchEvent):
+                events.append(event)
+            elif isinstance(event, Exception):
+                logger.warning(f'Looking up the last match of a watched player failed: {event!r}')
+
+        by_channel = defaultdict(list)
+        for event in events:
+            for channel_id in self._subscribers.get(event.profile_id, ()):
+                by_channel[channel_id].append(event)
+        results = await asyncio.gather(*[self.notify(channel_id, channel_events)
+                                         for channel_id, channel_events in by_channel.items()],
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning(f'Notifying a channel about watched players failed: {result!r}')
+
+    async def run(self) -> None:
+        """Polls forever while anybody is watching. Start this as a background task."""
+        while True:
+            if self._subscribers:
+                try:
+                    await self.poll()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.warning(f'Polling the lobbies failed: {e!r}')
+            else:
+                # start from scratch once somebody watches again, old snapshots would report stale news
+                self._lobbies = None
+            await asyncio.sleep(self.poll_interval)
@@ -0,0 +1,131 @@
+# logQueue.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import random
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Class SamplingFilter lets through a share of the log records of a logger, e.g. of one line per query.
+
+    Warnings and errors always pass. Add it to a logger, not to a handler, so dropped records are
+    thrown away before they are queued.
+
+    Attributes
+    ----------
+    rate : float
+        Share of the records below `keep_level` that are logged, from 0 to 1 (default 1)
+    keep_level : int
+        Records of this level or higher always pass (default logging.WARNING)
+    dropped : int
+        Number of records that were left out
+    """
+
+    rate: float = 1.0
+    keep_level: int = logging.WARNING
+
+    def __init__(self, rate: float = rate, keep_level: int = keep_level) -> None:
+        super().__init__()
+        self.rate = rate
+        self.keep_level = keep_level
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= self.keep_level or self.rate >= 1 or random.random() < self.rate:
+            return True
+        self.dropped += 1
+        return False
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler that drops records when the queue is full, instead of blocking or raising.
+
+    Attributes
+    ----------
+    dropped : int
+        Number of records that did not fit into the queue
+    """
+
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def start_logging(level: int, logformat: str, filename: str = None, max_bytes: int = 10 * 1024 * 1024,
+                  backup_count: int = 5, queue_size: int = 10000) -> DroppingQueueHandler:
+    """
+    Sets up the root logger so that logging never waits for the disk.
+
+    Log calls only put the record into a queue. A background thread takes the records from the
+    queue and writes them to the log file, which is rotated when it reaches `max_bytes`, or to the
+    console if there is no file. When the process exits, the queue is emptied and the thread is
+    stopped; later records are written directly.
+
+    :param filename: the log file, None to log to the console
+    :param max_bytes: size of the log file at which it is rotated, 0 to never rotate it
+    :param backup_count: number of rotated log files that are kept
+    :param queue_size: the most records waiting to be written, further records are dropped
+    :returns: The handler of the root logger, it counts the dropped records
+    """
+    if filename:
+        handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count,
+                                                       encoding='utf-8')
+    else:
+        handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(logformat))
+
+    queue_handler = DroppingQueueHandler(queue.Queue(queue_size))
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(queue_handler.queue, handler)
+    listener.start()
+
+    def stop():
+        # nobody empties the queue anymore, records logged while the interpreter shuts down are
+        # written right away
+        listener.stop()
+        root.removeHandler(queue_handler)
+        root.addHandler(handler)
+
+    atexit.register(stop)
+    return queue_handler
@@ -0,0 +1,286 @@
+# metrics.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds, fine enough for both API requests and event loop lag
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+class Counter(object):
+    """A value that only goes up, per combination of label values."""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def samples(self):
+        for label_values, value in sorted(self.values.items()):
+            yield f'{self.name}{_labels(self.labels, label_values)} {value}'
+
+
+class Gauge(object):
+    """
+    A value that is read when the metrics are rendered.
+
+    `function` returns either a number, or a dict {label values tuple: number} if the gauge has labels.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, function, labels: tuple = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.labels = labels
+
+    def samples(self):
+        value = self.function()
+        if not self.labels:
+            yield f'{self.name} {value}'
+            return
+        for label_values, v in sorted(value.items()):
+            yield f'{self.name}{_labels(self.labels, label_values)} {v}'
+
+
+class CounterFunction(Gauge):
+    """
+    A counter that is read when the metrics are rendered, for counts that are kept elsewhere.
+
+    `function` works like the one of Gauge, but has to return values that only go up.
+    """
+
+    kind = 'counter'
+
+
+class Histogram(object):
+    """Counts observations in buckets, per combination of label values."""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # label values -> [counts per bucket (the last one is +Inf), sum]
+        self.values = {}
+
+    def observe(self, value: float, *label_values) -> None:
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def count(self, *label_values) -> int:
+        entry = self.values.get(label_values)
+        return sum(entry[0]) if entry else 0
+
+    def quantile(self, q: float, *label_values) -> float:
+        """Estimates a quantile by linear interpolation within the bucket it falls into."""
+        entry = self.values.get(label_values)
+        if not entry:
+            return 0.0
+        counts = entry[0]
+        rank = q * sum(counts)
+        seen = 0
+        for i, n in enumerate(counts):
+            if n and seen + n >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+    def samples(self):
+        for label_values, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                labels = _labels(self.labels + ('le',), label_values + (bound,))
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _labels(self.labels, label_values)
+            yield f'{self.name}_sum{labels} {total}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+class Metrics(object):
+    """
+    Class Metrics collects the runtime metrics of the bot.
+
+    The API clients record every request to aoe2.net here if they are given a Metrics instance.
+    The bot records the time it takes to handle commands, and monitor_event_loop() measures how
+    late the event loop wakes up, which shows when something blocks it.
+
+    render() returns all metrics in the Prometheus text format, serve() makes them available on
+    http://host:port/metrics, and summary() returns a short report for humans.
+
+    Attributes
+    ----------
+    prefix : str
+        Prepended to all metric names (default 'elobot')
+    """
+
+    prefix: str = 'elobot'
+
+    def __init__(self, prefix: str = prefix) -> None:
+        self.prefix = prefix
+        self.started = time.time()
+        self.metrics = []
+
+        self.api_requests = self.add(Counter(
+            f'{prefix}_api_requests_total', 'Requests sent to aoe2.net', ('endpoint', 'status')))
+        self.api_errors = self.add(Counter(
+            f'{prefix}_api_errors_total', 'Requests to aoe2.net that failed without a response',
+            ('endpoint', 'error')))
+        self.api_latency = self.add(Histogram(
+            f'{prefix}_api_request_duration_seconds', 'Duration of requests to aoe2.net', ('endpoint',)))
+        self.api_bytes = self.add(Counter(
+            f'{prefix}_api_response_bytes_total', 'Bytes received from aoe2.net', ('endpoint',)))
+        self.commands = self.add(Histogram(
+            f'{prefix}_command_duration_seconds', 'Time from receiving a command to the reply', ('command',)))
+        self.loop_lag = self.add(Histogram(
+            f'{prefix}_event_loop_lag_seconds', 'How late the event loop woke up a sleeping task'))
+        self.add(Gauge(f'{prefix}_uptime_seconds', 'Seconds since the bot started',
+                       lambda: round(time.time() - self.started, 1)))
+
+        self._runner = None
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, documentation: str, function, labels: tuple = ()) -> Gauge:
+        """Adds a gauge whose value is read from `function` whenever the metrics are rendered."""
+        return self.add(Gauge(f'{self.prefix}_{name}', documentation, function, labels))
+
+    def counter(self, name: str, documentation: str, function, labels: tuple = ()) -> CounterFunction:
+        """Adds a counter whose value is read from `function` whenever the metrics are rendered."""
+        return self.add(CounterFunction(f'{self.prefix}_{name}', documentation, function, labels))
+
+    def api_request(self, endpoint: str, status: int, size: int, duration: float) -> None:
+        self.api_requests.inc(endpoint, status)
+        self.api_latency.observe(duration, endpoint)
+        self.api_bytes.inc(endpoint, amount=size)
+
+    def api_error(self, endpoint: str, error: BaseException, duration: float) -> None:
+        self.api_errors.inc(endpoint, type(error).__name__)
+        self.api_latency.observe(duration, endpoint)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            try:
+                lines.extend(metric.samples())
+            except Exception as e:
+                logger.warning(f'Reading metric {metric.name} failed: {e}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        """Returns a short plain text report, e.g. for the -sys stats command."""
+        uptime = int(time.time() - self.started)
+        lines = [f'Uptime: {uptime // 3600}h {uptime // 60 % 60}m']
+
+        endpoints = sorted({label_values[0] for label_values in self.api_latency.values})
+        for endpoint in endpoints:
+            requests = sum(v for (e, _), v in self.api_requests.values.items() if e == endpoint)
+            failed = sum(v for (e, status), v in self.api_requests.values.items()
+                         if e == endpoint and int(status) >= 400)
+            failed += sum(v for (e, _), v in self.api_errors.values.items() if e == endpoint)
+            lines.append(f'{endpoint}: {self.api_latency.count(endpoint)} requests, {failed} failed, '
+                         f'p50 {1000 * self.api_latency.quantile(0.5, endpoint):.0f}ms, '
+                         f'p95 {1000 * self.api_latency.quantile(0.95, endpoint):.0f}ms, '
+                         f'{self.api_bytes.values.get((endpoint,), 0) / 1e6:.1f}MB')
+
+        for (command,) in sorted(self.commands.values):
+            lines.append(f'{command}: {self.commands.count(command)} commands, '
+                         f'p50 {1000 * self.commands.quantile(0.5, command):.0f}ms, '
+                         f'p95 {1000 * self.commands.quantile(0.95, command):.0f}ms')
+
+        lines.append(f'Event loop lag: p50 {1000 * self.loop_lag.quantile(0.5):.1f}ms, '
+                     f'p99 {1000 * self.loop_lag.quantile(0.99):.1f}ms')
+
+        for metric in self.metrics:
+            if isinstance(metric, Gauge) and not metric.labels and metric.name != f'{self.prefix}_uptime_seconds':
+                try:
+                    lines.append(f'{metric.documentation}: {metric.function()}')
+                except Exception as e:
+                    lines.append(f'{metric.documentation}: {e!r}')
+        return '\n'.join(lines)
+
+    async def monitor_event_loop(self, interval: float = 0.5) -> None:
+        """Measures event loop lag forever. Start this as a background task."""
+        loop = asyncio.get_event_loop()
+        while True:
+            began = loop.time()
+            await asyncio.sleep(interval)
+            self.loop_lag.observe(max(0.0, loop.time() - began - interval))
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 9108) -> None:
+        """Serves the metrics in the Prometheus text format on http://host:port/metrics"""
+        from aiohttp import web
+
+        async def handle(request):
+            return web.Response(text=self.render(), content_type='text/plain', charset='utf-8')
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f'Serving metrics on http://{host}:{port}/metrics')
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
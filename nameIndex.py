@@ -0,0 +1,347 @@
+# nameIndex.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+
+import heapq
+import math
+import re
+from bisect import bisect_left, insort
+from collections import defaultdict
+
+# Splits names like '[AoM] The_Viper' into the tokens 'aom', 'the', 'viper'
+_token_split = re.compile(r'[\W_]+')
+
+# Match quality, the lower the better. Hits of the same quality are ranked by activity and rating.
+EXACT = 0
+PREFIX = 1
+TOKEN_PREFIX = 2
+SUBSTRING = 3
+FUZZY = 4
+
+# Prefixes of more names than this get a list of their names ordered by activity, so a short prefix
+# like 'k' only looks at its most active names instead of all of them.
+HOT_PREFIX_SIZE = 128
+
+
+def fold(name: str) -> str:
+    """Returns the case folded and stripped form of a name that is used for all comparisons."""
+    return (name or '').casefold().strip()
+
+
+def trigrams(text: str) -> set:
+    """Returns the trigrams of a folded text, padded so that short names get trigrams, too."""
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex(object):
+    """
+    Class NameIndex is a local search index over player names.
+
+    It supports case insensitive prefix search on the full name and on every word of the name
+    (so clan tags like '[AoM]' don't get in the way), substring search, and trigram based fuzzy
+    search for typos. A query of several words only matches names that have a word starting with
+    each of them. Hits are ranked by match quality first, then by last activity and rating.
+
+    Prefixes shared by many names (see HOT_PREFIX_SIZE) also get a list of their names ordered by
+    activity and rating, so searching them stops after the first `count` hits instead of ranking
+    thousands. The list is made by the first search for the prefix and kept current by update().
+
+    Rows are LeaderboardRow records or the raw leaderboard dicts returned by the API. They need at
+    least the keys profile_id and name; last_match_time and rating are used for ranking.
+
+    The index can be built in bulk from leaderboard pages with build() and updated in place with
+    update() and remove() as rows change.
+
+    Attributes
+    ----------
+    min_similarity : float
+        Minimum similarity (0 to 1) of a fuzzy hit, see similarity() (default 0.4)
+    """
+
+    min_similarity: float = 0.4
+
+    def __init__(self, rows=None, min_similarity: float = min_similarity) -> None:
+        self.min_similarity = min_similarity
+
+        self._rows = {}           # profile_id -> row
+        self._folded = {}         # profile_id -> folded name
+        self._names = []          # sorted (folded name, profile_id)
+        self._tokens = []         # sorted (token, profile_id)
+        self._trigrams = defaultdict(set)  # trigram -> {profile_id}
+        self._rank = {}           # profile_id -> rank key, see _rank_key()
+        self._hot_names = {}      # prefix of many names -> sorted rank keys of these names
+        self._hot_tokens = {}     # prefix of many name tokens -> sorted rank keys of these names
+
+        if rows is not None:
+            self.build(rows)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, profile_id) -> bool:
+        return profile_id in self._rows
+
+    @staticmethod
+    def _tokens_of(folded: str) -> set:
+        return {token for token in _token_split.split(folded) if token}
+
+    @staticmethod
+    def _rank_key(row) -> tuple:
+        # sorts the most recently active players first, then the higher rated ones
+        return -(row.get('last_match_time') or 0), -(row.get('rating') or 0), row['profile_id']
+
+    def _hot_list(self, hot: dict, items: list, prefix: str) -> list:
+        # the activity ordered list of a prefix of many items, made on first use; None for the
+        # prefixes of few items
+        keys = hot.get(prefix)
+        if keys is None:
+            lo = bisect_left(items, (prefix,))
+            hi = bisect_left(items, (prefix + '\uffff',), lo)
+            if hi - lo <= HOT_PREFIX_SIZE:
+                return None
+            # a name with two words starting alike is only listed once
+            keys = hot[prefix] = sorted({self._rank[profile_id] for _, profile_id in items[lo:hi]})
+        return keys
+
+    @staticmethod
+    def _hot_prefixes(hot: dict, text: str):
+        # the prefixes of text that have an activity ordered list
+        for n in range(1, len(text) + 1):
+            keys = hot.get(text[:n])
+            if keys is not None:
+                yield keys
+
+    def _rerank(self, profile_id, folded: str, old: tuple, new: tuple) -> None:
+        # moves a name in the activity ordered lists; old or new is None to only remove or add it
+        lists = list(self._hot_prefixes(self._hot_names, folded))
+        seen = set()
+        for token in self._tokens_of(folded):
+            for keys in self._hot_prefixes(self._hot_tokens, token):
+                # two tokens of a name can share a prefix, the name is listed once anyway
+                if id(keys) not in seen:
+                    seen.add(id(keys))
+                    lists.append(keys)
+        for keys in lists:
+            if old is not None:
+                self._remove_sorted(keys, old)
+            if new is not None:
+                insort(keys, new)
+
+    def build(self, rows) -> None:
+        """Replaces the index content with the given rows. Much faster than calling update() per row."""
+        self._rows = {}
+        self._folded = {}
+        self._trigrams = defaultdict(set)
+        names = []
+        tokens = []
+        for row in rows:
+            profile_id = row['profile_id']
+            folded = fold(row.get('name'))
+            self._rows[profile_id] = row
+            self._folded[profile_id] = folded
+            names.append((folded, profile_id))
+            tokens.extend((token, profile_id) for token in self._tokens_of(folded))
+            for trigram in trigrams(folded):
+                self._trigrams[trigram].add(profile_id)
+        names.sort()
+        tokens.sort()
+        self._names = names
+        self._tokens = tokens
+
+        self._rank = {profile_id: self._rank_key(row) for profile_id, row in self._rows.items()}
+        self._hot_names = {}
+        self._hot_tokens = {}
+
+    def update(self, row: dict) -> None:
+        """Inserts a row or replaces the row with the same profile_id."""
+        profile_id = row['profile_id']
+        folded = fold(row.get('name'))
+        old = self._folded.get(profile_id)
+        self._rows[profile_id] = row
+        rank = self._rank_key(row)
+        if old == folded:
+            # same name, only the ranking data changed
+            if self._rank[profile_id] != rank:
+                self._rerank(profile_id, folded, self._rank[profile_id], rank)
+                self._rank[profile_id] = rank
+            return
+        if old is not None:
+            self._unindex(profile_id, old)
+        self._rank[profile_id] = rank
+        self._rerank(profile_id, folded, None, rank)
+        self._folded[profile_id] = folded
+        insort(self._names, (folded, profile_id))
+        for token in self._tokens_of(folded):
+            insort(self._tokens, (token, profile_id))
+        for trigram in trigrams(folded):
+            self._trigrams[trigram].add(profile_id)
+
+    def remove(self, profile_id) -> None:
+        """Removes a player from the index. Unknown profile_ids are ignored."""
+        folded = self._folded.pop(profile_id, None)
+        if folded is None:
+            return
+        del self._rows[profile_id]
+        self._unindex(profile_id, folded)
+
+    def _unindex(self, profile_id, folded: str) -> None:
+        self._rerank(profile_id, folded, self._rank.pop(profile_id), None)
+        self._remove_sorted(self._names, (folded, profile_id))
+        for token in self._tokens_of(folded):
+            self._remove_sorted(self._tokens, (token, profile_id))
+        for trigram in trigrams(folded):
+            ids = self._trigrams.get(trigram)
+            if ids is not None:
+                ids.discard(profile_id)
+                if not ids:
+                    del self._trigrams[trigram]
+
+    @staticmethod
+    def _remove_sorted(items: list, item: tuple) -> None:
+        i = bisect_left(items, item)
+        if i < len(items) and items[i] == item:
+            del items[i]
+
+    @staticmethod
+    def _prefix_range(items: list, prefix: str):
+        # every string starting with prefix sorts between (prefix,) and (prefix + '\uffff',)
+        lo = bisect_left(items, (prefix,))
+        hi = bisect_left(items, (prefix + '\uffff',), lo)
+        return items[lo:hi]
+
+    def _has_tokens(self, profile_id, tokens: list) -> bool:
+        # True if every one of the tokens is the start of a token of the name
+        name_tokens = self._tokens_of(self._folded[profile_id])
+        return all(any(name_token.startswith(token) for name_token in name_tokens) for token in tokens)
+
+    def similarity(self, shared: int, query_trigrams: int, name_trigrams: int) -> float:
+        """
+        Returns how similar a name is to the query, from 0 to 1.
+
+        It is mostly the share of the query trigrams found in the name. Trigrams of the name that
+        are not in the query only count a quarter, so '[TheViper] TheViper' is still similar to
+        'thevipr' despite the clan tag.
+        """
+        return shared / (query_trigrams + (name_trigrams - shared) / 4)
+
+    def _search_trigrams(self, query: str, quality: dict, fuzzy: bool) -> None:
+        query_trigrams = sorted(trigrams(query), key=lambda t: len(self._trigrams.get(t, ())))
+
+        # A substring hit contains every unpadded trigram of the query, so the rarest one of those
+        # already holds all candidates.
+        inner = [t for t in query_trigrams if ' ' not in t]
+        if inner:
+            for profile_id in self._trigrams.get(inner[0], ()):
+                if profile_id not in quality and query in self._folded[profile_id]:
+                    quality[profile_id] = SUBSTRING
+
+        if not fuzzy:
+            return
+
+        # A fuzzy hit shares at least `needed` trigrams with the query, so it has to show up in one
+        # of the len - needed + 1 rarest posting lists. Only those are scanned for candidates.
+        needed = max(1, math.ceil(self.min_similarity * len(query_trigrams)))
+        candidates = set()
+        for trigram in query_trigrams[:len(query_trigrams) - needed + 1]:
+            candidates.update(self._trigrams.get(trigram, ()))
+
+        postings = [self._trigrams.get(t, ()) for t in query_trigrams]
+        for profile_id in candidates:
+            if profile_id in quality:
+                continue
+            shared = sum(1 for ids in postings if profile_id in ids)
+            if shared < needed:
+                continue
+            similarity = self.similarity(shared, len(query_trigrams),
+                                         len(trigrams(self._folded[profile_id])))
+            if similarity >= self.min_similarity:
+                # better similarity ranks first within the fuzzy hits
+                quality[profile_id] = FUZZY + 1 - similarity
+
+    def search(self, text: str, count: int = 20, fuzzy: bool = True) -> list:
+        """
+        Searches the index.
+
+        :param text: the name or part of the name to search for
+        :param count: maximum number of hits to return
+        :param fuzzy: also look for similar names if there are not enough direct hits
+        :returns: Up to `count` rows, best hits first.
+        """
+        query = fold(text)
+        if not query or count <= 0:
+            return []
+
+        quality = {}
+
+        def hit(profile_id, q):
+            if quality.get(profile_id, FUZZY + 1) > q:
+                quality[profile_id] = q
+
+        hot = self._hot_list(self._hot_names, self._names, query)
+        if hot is None:
+            for folded, profile_id in self._prefix_range(self._names, query):
+                hit(profile_id, EXACT if folded == query else PREFIX)
+        else:
+            # the names equal to the query rank first, then the most active ones of the many others
+            lo = bisect_left(self._names, (query,))
+            for folded, profile_id in self._names[lo:bisect_left(self._names, (query + '\0',), lo)]:
+                hit(profile_id, EXACT)
+            for _, _, profile_id in hot[:count]:
+                hit(profile_id, PREFIX)
+
+        # every word of the query has to be the start of a word of the name
+        hot = {token: self._hot_list(self._hot_tokens, self._tokens, token) for token in self._tokens_of(query)}
+        tokens = sorted(hot, key=lambda token: len(hot[token] or ()))
+        if tokens and hot[tokens[0]] is None:
+            # a rare word: check all names that have it for the other words
+            candidates = {profile_id for _, profile_id in self._prefix_range(self._tokens, tokens[0])}
+            for profile_id in candidates:
+                if self._has_tokens(profile_id, tokens[1:]):
+                    hit(profile_id, TOKEN_PREFIX)
+        elif tokens:
+            # only common words: walk the names with the least common one by activity, until the
+            # result is full
+            found = 0
+            for _, _, profile_id in hot[tokens[0]]:
+                if self._has_tokens(profile_id, tokens[1:]):
+                    hit(profile_id, TOKEN_PREFIX)
+                    found += 1
+                    if found >= count:
+                        break
+
+        # Substring and fuzzy matches are only looked for if the cheap prefix lookups did not
+        # already fill the result. A query of three letters has too few trigrams to tell a typo
+        # from thousands of unrelated names, so it only gets substring matches.
+        if len(quality) < count and len(query) >= 3:
+            self._search_trigrams(query, quality, fuzzy and len(query) >= 4)
+
+        def rank(profile_id):
+            row = self._rows[profile_id]
+            return -quality[profile_id], row.get('last_match_time') or 0, row.get('rating') or 0
+
+        return [self._rows[profile_id] for profile_id in heapq.nlargest(count, quality, key=rank)]
@@ -0,0 +1,170 @@
+# profileLinks.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileLinks(object):
+    """
+    Class ProfileLinks remembers which aoe2.net profile belongs to which discord user, see '-link'.
+
+    All links are read from a small SQLite file by load() and then answered from memory.
+    link() and unlink() change the memory right away and queue the change; a single task writes the
+    queued changes in an executor, so the event loop never waits for the disk. Every change is
+    written as its own row, so several processes can share the file. Processes that do, run
+    follow() to see the links made by the others.
+
+    Attributes
+    ----------
+    path : str
+        The file name of the store, None to keep the links in memory only
+    """
+
+    def __init__(self, path: str = None) -> None:
+        self.path = path
+        self._links = {}      # discord user id -> profile_id
+        self._pending = {}    # discord user id -> profile_id, None to delete; not written yet
+        self._flush_task = None
+
+    def __len__(self) -> int:
+        return len(self._links)
+
+    def get(self, user_id: int) -> int:
+        """Returns the profile_id linked to a discord user, or None."""
+        return self._links.get(user_id)
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, timeout=10)
+        db.execute('CREATE TABLE IF NOT EXISTS link ('
+                   'user_id INTEGER PRIMARY KEY, profile_id INTEGER, linked_at REAL)')
+        return db
+
+    def load(self) -> None:
+        """Reads all links. Blocks, but it's meant to be called once at startup."""
+        if self.path is None:
+            return
+        try:
+            self._links = self._read()
+        except sqlite3.Error as e:
+            logger.warning(f'Ignoring unreadable profile links {self.path}: {e}')
+            return
+        logger.info(f'Loaded {len(self._links)} profile links from {self.path}')
+
+    async def follow(self, interval: float = 10) -> None:
+        """
+        Reads the links again whenever the file changes, forever. Start this as a background task in
+        processes that share the file with other processes.
+
+        :param interval: seconds between two checks of the file
+        """
+        if self.path is None:
+            return
+        modified = None
+        while True:
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                mtime = None
+            if mtime is not None and mtime != modified:
+                modified = mtime
+                try:
+                    links = await asyncio.get_event_loop().run_in_executor(None, self._read)
+                except sqlite3.Error as e:
+                    logger.warning(f'Reading the profile links {self.path} failed: {e}')
+                else:
+                    # changes of this process that are not written yet are newer than the file
+                    links.update(self._pending)
+                    self._links = {user_id: profile_id for user_id, profile_id in links.items()
+                                   if profile_id is not None}
+            await asyncio.sleep(interval)
+
+    def _read(self) -> dict:
+        db = self._connect()
+        try:
+            return dict(db.execute('SELECT user_id, profile_id FROM link'))
+        finally:
+            db.close()
+
+    def link(self, user_id: int, profile_id: int) -> None:
+        self._links[user_id] = profile_id
+        self._queue(user_id, profile_id)
+
+    def unlink(self, user_id: int) -> bool:
+        """Removes the link of a discord user. Returns False if there was none."""
+        if self._links.pop(user_id, None) is None:
+            return False
+        self._queue(user_id, None)
+        return True
+
+    def _queue(self, user_id: int, profile_id: int) -> None:
+        if self.path is None:
+            return
+        self._pending[user_id] = profile_id
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush())
+
+    async def close(self) -> None:
+        """Waits until the queued changes are written."""
+        if self._flush_task is not None:
+            await self._flush_task
+        if self._pending:
+            await self._flush()
+
+    async def _flush(self) -> None:
+        # writes the queued changes, and the ones queued meanwhile right after
+        try:
+            while self._pending:
+                changes, self._pending = self._pending, {}
+                try:
+                    await asyncio.get_event_loop().run_in_executor(None, self._write, changes)
+                except sqlite3.Error as e:
+                    logger.error(f'Writing {len(changes)} profile links to {self.path} failed: {e}')
+                    # keep them for the next try, unless they were changed again meanwhile
+                    self._pending = {**changes, **self._pending}
+                    return
+        finally:
+            self._flush_task = None
+
+    def _write(self, changes: dict) -> None:
+        db = self._connect()
+        try:
+            with db:
+                now = time.time()
+                db.executemany('INSERT OR REPLACE INTO link VALUES (?, ?, ?)',
+                               [(user_id, profile_id, now) for user_id, profile_id in changes.items()
+                                if profile_id is not None])
+                db.executemany('DELETE FROM link WHERE user_id = ?',
+                               [(user_id,) for user_id, profile_id in changes.items() if profile_id is None])
+        finally:
+            db.close()
@@ -0,0 +1,258 @@
+# rateLimit.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+
+import asyncio
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Class TokenBucket is a classic token bucket rate limiter.
+
+    The bucket holds up to `burst` tokens and is refilled with `rate` tokens per second. Every
+    request takes one token. It is thread safe, so the blocking and the asyncio API client can share
+    one bucket.
+
+    Attributes
+    ----------
+    rate : float
+        Tokens added per second
+    burst : float
+        Maximum number of tokens in the bucket
+    """
+
+    def __init__(self, rate: float, burst: float = None) -> None:
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self) -> float:
+        """
+        Takes a token, even if it is not there yet.
+
+        :returns: The seconds the caller has to wait until the token is actually available (0 if
+            it's available right now).
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def refund(self) -> None:
+        """Gives back a reserved token that was not used, e.g. because the caller gave up waiting."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self.burst, self._tokens + 1)
+
+    def try_acquire(self) -> bool:
+        """Takes a token if one is available right now, without waiting."""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+class RateLimiter(object):
+    """
+    Class RateLimiter limits the requests sent to the API.
+
+    There is one global bucket for all requests and optional buckets per endpoint, a request has to
+    pass both. Tokens are reserved in order, so waiting requests are served first come, first served.
+    A request that is cancelled while it waits gives its tokens back, so it doesn't delay the ones
+    after it.
+
+    Attributes
+    ----------
+    rate : float
+        Requests per second for all endpoints together (default 5)
+    burst : float
+        Requests that may be sent at once after a quiet period (default 10)
+    endpoint_rates : dict
+        {endpoint: (rate, burst)} for endpoints with their own limit
+    """
+
+    rate: float = 5
+    burst: float = 10
+    endpoint_rates: dict = {
+        '/api/leaderboard': (3, 5),
+        '/api/matches': (2, 4),
+        '/api/ratinghistory': (2, 4),
+    }
+
+    def __init__(self, rate: float = rate, burst: float = burst, endpoint_rates: dict = None) -> None:
+        self.bucket = TokenBucket(rate, burst)
+        rates = dict(self.endpoint_rates)
+        if endpoint_rates:
+            rates.update(endpoint_rates)
+        self.endpoint_buckets = {endpoint: TokenBucket(*rate) for endpoint, rate in rates.items()}
+
+    def reserve(self, endpoint: str) -> float:
+        """Reserves a request to the endpoint and returns the seconds to wait before sending it."""
+        wait = self.bucket.reserve()
+        endpoint_bucket = self.endpoint_buckets.get(endpoint)
+        if endpoint_bucket is not None:
+            wait = max(wait, endpoint_bucket.reserve())
+        return wait
+
+    def refund(self, endpoint: str) -> None:
+        """Gives back the tokens of a reserved request to the endpoint that is not sent after all."""
+        self.bucket.refund()
+        endpoint_bucket = self.endpoint_buckets.get(endpoint)
+        if endpoint_bucket is not None:
+            endpoint_bucket.refund()
+
+    def try_acquire(self, endpoint: str) -> bool:
+        """Takes the tokens for a request to the endpoint if they are available right now, without waiting."""
+        endpoint_bucket = self.endpoint_buckets.get(endpoint)
+        if endpoint_bucket is not None and not endpoint_bucket.try_acquire():
+            return False
+        if self.bucket.try_acquire():
+            return True
+        if endpoint_bucket is not None:
+            endpoint_bucket.refund()
+        return False
+
+    async def acquire(self, endpoint: str) -> None:
+        """Waits until a request to the endpoint may be sent."""
+        wait = self.reserve(endpoint)
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                self.refund(endpoint)
+                raise
+
+    def acquire_blocking(self, endpoint: str) -> None:
+        """Same as acquire(), for the blocking client."""
+        wait = self.reserve(endpoint)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Cooldown(object):
+    """
+    Class Cooldown remembers when a key (a user, a channel, ...) was last let through.
+
+    Attributes
+    ----------
+    seconds : float
+        The time that has to pass between two hits of the same key
+    """
+
+    def __init__(self, seconds: float) -> None:
+        self.seconds = seconds
+        self._last = {}
+
+    def remaining(self, key) -> float:
+        """Returns the seconds the key still has to wait, 0 if it may pass."""
+        last = self._last.get(key)
+        if last is None:
+            return 0.0
+        return max(0.0, last + self.seconds - time.monotonic())
+
+    def hit(self, key) -> float:
+        """
+        Lets the key pass if its cooldown is over and starts a new one.
+
+        :returns: 0 if the key passed, otherwise the seconds it still has to wait.
+        """
+        remaining = self.remaining(key)
+        if remaining > 0:
+            return remaining
+        now = time.monotonic()
+        self._last[key] = now
+        if len(self._last) > 10000:
+            # forget keys whose cooldown is over, so the dict doesn't grow forever
+            self._last = {k: t for k, t in self._last.items() if t + self.seconds > now}
+        return 0.0
+
+
+class QueueFull(Exception):
+    """Raised by RequestQueue when there are too many requests waiting already."""
+
+
+class RequestQueue(object):
+    """
+    Class RequestQueue limits the number of requests that are processed at the same time.
+
+    Up to `concurrency` requests run at once and up to `max_waiting` more wait for their turn.
+    Any request beyond that is shed right away by raising QueueFull, instead of piling up tasks
+    that would be answered much too late anyway.
+
+    Usage::
+
+        try:
+            async with queue:
+                ...
+        except QueueFull:
+            ...
+
+    Attributes
+    ----------
+    concurrency : int
+        Requests processed at the same time
+    max_waiting : int
+        Requests that may wait for their turn
+    """
+
+    def __init__(self, concurrency: int, max_waiting: int) -> None:
+        self.concurrency = concurrency
+        self.max_waiting = max_waiting
+        self.waiting = 0
+        self.running = 0
+        self.shed = 0
+        self._semaphore = None
+
+    async def __aenter__(self):
+        if self._semaphore is None:
+            # created here, so it's bound to the running event loop
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        if self._semaphore.locked() and self.waiting >= self.max_waiting:
+            self.shed += 1
+            raise QueueFull()
+
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self.running -= 1
+        self._semaphore.release()
@@ -0,0 +1,140 @@
+# ratingIndex.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+
+from bisect import bisect_left, insort
+
+
+class RatingIndex(object):
+    """
+    Class RatingIndex keeps the players of a leaderboard sorted by rating.
+
+    All queries are answered with bisect on the sorted list: the percentile of a rating, the
+    position of a player, a histogram of the ratings and the players right above and below a
+    player. Like NameIndex, it is built in bulk with build() and kept up to date with update()
+    and remove().
+
+    Rows are LeaderboardRow records or the raw leaderboard dicts returned by the API. They need the
+    keys profile_id and rating; rows without a rating are left out.
+    """
+
+    def __init__(self, rows=None) -> None:
+        self._rows = {}    # profile_id -> row
+        self._keys = []    # sorted (-rating, profile_id), the highest rating first
+
+        if rows is not None:
+            self.build(rows)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, profile_id) -> bool:
+        return profile_id in self._rows
+
+    @staticmethod
+    def _key(row) -> tuple:
+        return -int(row['rating']), row['profile_id']
+
+    def build(self, rows) -> None:
+        """Replaces the index content with the given rows. Much faster than calling update() per row."""
+        self._rows = {row['profile_id']: row for row in rows if row.get('rating') is not None}
+        self._keys = sorted(self._key(row) for row in self._rows.values())
+
+    def update(self, row) -> None:
+        """Adds a row or moves it to its new rating."""
+        old = self._rows.get(row['profile_id'])
+        if old is not None:
+            if old.get('rating') == row.get('rating'):
+                self._rows[row['profile_id']] = row
+                return
+            self.remove(row['profile_id'])
+        if row.get('rating') is not None:
+            self._rows[row['profile_id']] = row
+            insort(self._keys, self._key(row))
+
+    def remove(self, profile_id) -> None:
+        row = self._rows.pop(profile_id, None)
+        if row is not None:
+            key = self._key(row)
+            i = bisect_left(self._keys, key)
+            if i < len(self._keys) and self._keys[i] == key:
+                del self._keys[i]
+
+    def at_least(self, rating: int) -> int:
+        """Returns the number of players with this rating or higher."""
+        # ratings are integers, so (-rating + 1,) sorts right after the last key of this rating
+        return bisect_left(self._keys, (-rating + 1,))
+
+    def percentile(self, rating: int) -> float:
+        """Returns the share of players with a lower rating, from 0 to 100."""
+        if not self._keys:
+            return 0.0
+        return 100.0 * (len(self._keys) - self.at_least(rating)) / len(self._keys)
+
+    def position(self, profile_id) -> int:
+        """
+        Returns the place of a player when sorted by rating, starting at 1. Players with the same
+        rating share the place. None if the player is not in the index.
+        """
+        row = self._rows.get(profile_id)
+        if row is None:
+            return None
+        return self.at_least(int(row['rating']) + 1) + 1
+
+    def histogram(self, bucket_size: int = 100) -> list:
+        """
+        Counts the players per rating bucket.
+
+        :returns: A list of (lowest rating of the bucket, number of players), the highest bucket first.
+        """
+        if not self._keys:
+            return []
+        highest = -self._keys[0][0] // bucket_size * bucket_size
+        lowest = -self._keys[-1][0] // bucket_size * bucket_size
+        buckets = []
+        above = 0
+        for bucket in range(highest, lowest - 1, -bucket_size):
+            at_least = self.at_least(bucket)
+            buckets.append((bucket, at_least - above))
+            above = at_least
+        return buckets
+
+    def neighbors(self, profile_id, count: int = 2) -> tuple:
+        """
+        Returns the player and the players right above and below in rating.
+
+        :param count: number of players above and below
+        :returns: A tuple (rows, i): up to 2 * count + 1 rows sorted by rating, the highest first,
+            and the position of the player in that list. (None, None) if the player is not in the index.
+        """
+        row = self._rows.get(profile_id)
+        if row is None:
+            return None, None
+        i = bisect_left(self._keys, self._key(row))
+        first = max(0, i - count)
+        rows = [self._rows[key[1]] for key in self._keys[first:i + count + 1]]
+        return rows, i - first
@@ -0,0 +1,317 @@
+# ratingTrend.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+
+import array
+import asyncio
+import logging
+import statistics
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+
+# numpy is optional. With it, the statistics of long rating histories are computed in a few
+# vectorized passes instead of Python loops.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 60 * 60
+
+
+class RatingHistory(object):
+    """
+    The rating history of one player in one leaderboard, oldest rating first.
+
+    The columns are numpy arrays if numpy is installed, array.array otherwise. New ratings are
+    appended in place; the numpy arrays grow by doubling, so appending stays cheap. Only the first
+    `size` values of a column are valid, use column() to get them.
+
+    Attributes
+    ----------
+    profile_id : int
+    leaderboard_id : int
+    size : int
+        Number of ratings
+    updated_at : float
+        time.time() of the last download, None if it was never downloaded
+    """
+
+    __slots__ = ('profile_id', 'leaderboard_id', 'size', 'updated_at', 'timestamps', 'ratings', 'wins',
+                 'losses')
+
+    columns = ('timestamps', 'ratings', 'wins', 'losses')
+
+    def __init__(self, profile_id: int, leaderboard_id: int) -> None:
+        self.profile_id = profile_id
+        self.leaderboard_id = leaderboard_id
+        self.size = 0
+        self.updated_at = None
+        for name in self.columns:
+            setattr(self, name, numpy.empty(0, dtype=numpy.int64) if numpy is not None else array.array('q'))
+
+    def column(self, name: str):
+        return getattr(self, name)[:self.size]
+
+    @property
+    def last_timestamp(self) -> int:
+        return int(self.timestamps[self.size - 1]) if self.size else None
+
+    def append(self, points) -> int:
+        """
+        Appends RatingPoint records, oldest first. Points that are not newer than the last one are skipped.
+
+        :returns: The number of points appended
+        """
+        last = self.last_timestamp
+        values = [(point.timestamp, point.rating, point.num_wins or 0, point.num_losses or 0)
+                  for point in points if point.timestamp is not None and point.rating is not None
+                  and (last is None or point.timestamp > last)]
+        if not values:
+            return 0
+
+        new_columns = zip(*values)
+        if numpy is None:
+            for name, new in zip(self.columns, new_columns):
+                getattr(self, name).extend(new)
+        else:
+            size = self.size + len(values)
+            if size > len(self.timestamps):
+                capacity = max(size, 2 * len(self.timestamps), 64)
+                for name in self.columns:
+                    grown = numpy.empty(capacity, dtype=numpy.int64)
+                    grown[:self.size] = self.column(name)
+                    setattr(self, name, grown)
+            for name, new in zip(self.columns, new_columns):
+                getattr(self, name)[self.size:size] = new
+        self.size += len(values)
+        return len(values)
+
+
+class Trend(object):
+    """
+    Statistics of a RatingHistory, see trend().
+
+    Attributes
+    ----------
+    games : int
+        Number of ratings in the history
+    rating, peak, low : int
+        The current, highest and lowest rating
+    peak_at, low_at : int
+        Unix timestamps of the highest and lowest rating
+    averages : dict
+        {games: average rating over the last that many games}
+    changes : dict
+        {days: (rating change, games played) over the last that many days}
+    streak : int
+        The current streak, positive for wins and negative for losses
+    longest_win_streak, longest_loss_streak : int
+    volatility : float
+        Standard deviation of the rating change per game, over the last `volatility_games` games
+    """
+
+    __slots__ = ('games', 'rating', 'peak', 'peak_at', 'low', 'low_at', 'averages', 'changes', 'streak',
+                 'longest_win_streak', 'longest_loss_streak', 'volatility')
+
+    def __init__(self, **fields) -> None:
+        for field in self.__slots__:
+            setattr(self, field, fields.get(field))
+
+
+def trend(history: RatingHistory, now: float = None, windows: tuple = (10, 50), days: tuple = (7, 30),
+          volatility_games: int = 50) -> Trend:
+    """
+    Computes the statistics of a rating history.
+
+    :param now: the time the day ranges end (default time.time())
+    :param windows: the numbers of games to average the rating over
+    :param days: the numbers of days to report the rating change for
+    :param volatility_games: the number of games the volatility is measured over
+    :returns: A Trend, or None if the history is empty.
+    """
+    if not history.size:
+        return None
+    now = time.time() if now is None else now
+    if numpy is not None:
+        return _trend_numpy(history, now, windows, days, volatility_games)
+    return _trend_python(history, now, windows, days, volatility_games)
+
+
+def _trend_numpy(history: RatingHistory, now: float, windows: tuple, days: tuple, volatility_games: int) -> Trend:
+    timestamps = history.column('timestamps')
+    ratings = history.column('ratings')
+    size = history.size
+
+    peak = int(ratings.argmax())
+    low = int(ratings.argmin())
+    averages = {window: float(ratings[-window:].mean()) for window in windows}
+
+    changes = {}
+    for day_count in days:
+        first = int(numpy.searchsorted(timestamps, now - day_count * DAY, side='right'))
+        base = ratings[first - 1] if first > 0 else ratings[0]
+        changes[day_count] = (int(ratings[-1] - base), size - first)
+
+    # the outcome of each game by the win and loss counters, by the rating change if neither moved
+    outcomes = numpy.sign(numpy.diff(history.column('wins')) - numpy.diff(history.column('losses')))
+    outcomes = numpy.where(outcomes != 0, outcomes, numpy.sign(numpy.diff(ratings)))
+    outcomes = outcomes[outcomes != 0]
+    streak = longest_win = longest_loss = 0
+    if outcomes.size:
+        # run lengths of equal outcomes
+        starts = numpy.flatnonzero(numpy.concatenate(([True], outcomes[1:] != outcomes[:-1])))
+        lengths = numpy.diff(numpy.append(starts, outcomes.size))
+        signs = outcomes[starts]
+        streak = int(signs[-1] * lengths[-1])
+        longest_win = int(lengths[signs > 0].max(initial=0))
+        longest_loss = int(lengths[signs < 0].max(initial=0))
+
+    recent = numpy.diff(ratings[-volatility_games - 1:])
+    volatility = float(recent.std()) if recent.size else 0.0
+
+    return Trend(games=size, rating=int(ratings[-1]), peak=int(ratings[peak]), peak_at=int(timestamps[peak]),
+                 low=int(ratings[low]), low_at=int(timestamps[low]), averages=averages, changes=changes,
+                 streak=streak, longest_win_streak=longest_win, longest_loss_streak=longest_loss,
+                 volatility=volatility)
+
+
+def _trend_python(history: RatingHistory, now: float, windows: tuple, days: tuple, volatility_games: int) -> Trend:
+    timestamps = history.column('timestamps')
+    ratings = history.column('ratings')
+    wins = history.column('wins')
+    losses = history.column('losses')
+    size = history.size
+
+    peak = max(range(size), key=ratings.__getitem__)
+    low = min(range(size), key=ratings.__getitem__)
+    averages = {window: statistics.mean(ratings[-window:]) for window in windows}
+
+    changes = {}
+    for day_count in days:
+        first = bisect_right(timestamps, now - day_count * DAY)
+        base = ratings[first - 1] if first > 0 else ratings[0]
+        changes[day_count] = (ratings[-1] - base, size - first)
+
+    streak = longest_win = longest_loss = 0
+    for i in range(1, size):
+        outcome = (wins[i] - wins[i - 1]) - (losses[i] - losses[i - 1]) or ratings[i] - ratings[i - 1]
+        if outcome > 0:
+            streak = streak + 1 if streak > 0 else 1
+            longest_win = max(longest_win, streak)
+        elif outcome < 0:
+            streak = streak - 1 if streak < 0 else -1
+            longest_loss = max(longest_loss, -streak)
+
+    recent = ratings[-volatility_games - 1:]
+    volatility = statistics.pstdev([b - a for a, b in zip(recent, recent[1:])]) if len(recent) > 1 else 0.0
+
+    return Trend(games=size, rating=ratings[-1], peak=ratings[peak], peak_at=timestamps[peak], low=ratings[low],
+                 low_at=timestamps[low], averages=averages, changes=changes, streak=streak,
+                 longest_win_streak=longest_win, longest_loss_streak=longest_loss, volatility=volatility)
+
+
+class RatingHistoryCache(object):
+    """
+    Class RatingHistoryCache keeps the rating histories of recently asked for players.
+
+    The first request for a player downloads the complete history. Later requests only download
+    the ratings that are newer than the last one in the cache, in small pages, and append them.
+
+    Attributes
+    ----------
+    api : Aoe2netAsyncAPI
+        The API client used to download the histories
+    game : str
+        (default 'aoe2de')
+    max_players : int
+        Number of histories kept, the least recently used ones are dropped (default 1000)
+    refresh_interval : float
+        Seconds a history is used without checking for new ratings (default 60)
+    update_page_size : int
+        Ratings per request when looking for new ratings of a cached history (default 50)
+    """
+
+    game: str = 'aoe2de'
+    max_players: int = 1000
+    refresh_interval: float = 60
+    update_page_size: int = 50
+
+    def __init__(self, api, game: str = game, max_players: int = max_players,
+                 refresh_interval: float = refresh_interval) -> None:
+        self.api = api
+        self.game = game
+        self.max_players = max_players
+        self.refresh_interval = refresh_interval
+        self._histories = OrderedDict()
+        # downloads that are currently running, by (leaderboard_id, profile_id)
+        self._inflight = {}
+
+    def __len__(self) -> int:
+        return len(self._histories)
+
+    async def get(self, profile_id: int, leaderboard_id: int = 3) -> RatingHistory:
+        """Returns the rating history of a player, downloading what is new since the last call."""
+        key = (leaderboard_id, int(profile_id))
+        history = self._histories.get(key)
+        if history is not None:
+            self._histories.move_to_end(key)
+            if time.time() - history.updated_at < self.refresh_interval:
+                return history
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.ensure_future(self._update(key, history))
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _update(self, key: tuple, history: RatingHistory) -> RatingHistory:
+        leaderboard_id, profile_id = key
+        if history is None:
+            history = RatingHistory(profile_id, leaderboard_id)
+        since = history.last_timestamp
+
+        # the API returns the newest ratings first and has no filter by time, so page until
+        # the last known rating shows up. Updates skip the response cache, a cached page is
+        # about as old as the history already is.
+        points = [point async for point in self.api.iter_ratinghistory(
+            game=self.game, leaderboard_id=leaderboard_id, profile_id=profile_id,
+            page_size=self.update_page_size if since is not None else 1000,
+            since=since + 1 if since is not None else None, fresh=since is not None)]
+        added = history.append(reversed(points))
+        history.updated_at = time.time()
+        logger.debug(f'Rating history of {profile_id} in leaderboard {leaderboard_id}: '
+                     f'{added} new, {history.size} total')
+
+        self._histories[key] = history
+        self._histories.move_to_end(key)
+        while len(self._histories) > self.max_players:
+            self._histories.popitem(last=False)
+        return history
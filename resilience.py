@@ -0,0 +1,216 @@
+# resilience.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker(object):
+    """
+    Class CircuitBreaker stops sending requests to an API that keeps failing.
+
+    After `failure_threshold` failures in a row the circuit opens and allow() returns False, so
+    callers fail fast (and answer from stale data, see Aoe2netAPI.fetch) instead of waiting for
+    timeouts. After `reset_timeout` seconds a single probe request is let through. If it succeeds
+    the circuit closes again, otherwise it stays open for another `reset_timeout`.
+
+    It is thread safe, so the blocking and the asyncio API client can share one breaker.
+
+    Attributes
+    ----------
+    failure_threshold : int
+        Failures in a row that open the circuit (default 5)
+    reset_timeout : float
+        Seconds the circuit stays open before a probe is let through (default 30)
+    state : str
+        'closed', 'open' or 'half-open'
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    failure_threshold: int = 5
+    reset_timeout: float = 30.0
+
+    def __init__(self, failure_threshold: int = failure_threshold, reset_timeout: float = reset_timeout) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Returns True if a request may be sent now."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            # let one probe through, everybody else keeps failing fast until it's back. Another
+            # probe is let through if one got lost, e.g. because its caller was cancelled.
+            if now - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._opened_at = now
+                return True
+            return False
+
+    def success(self) -> None:
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.warning('aoe2.net answers again, closing the circuit')
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                if self.state == self.CLOSED:
+                    logger.warning(f'{self.failures} failed requests to aoe2.net in a row, opening the circuit')
+                    self.opened += 1
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class LatencyWindow(object):
+    """The durations of the last `size` successful requests per endpoint, to estimate their percentiles."""
+
+    def __init__(self, size: int = 200) -> None:
+        self.size = size
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def add(self, endpoint: str, seconds: float) -> None:
+        with self._lock:
+            samples = self._samples.get(endpoint)
+            if samples is None:
+                samples = self._samples[endpoint] = deque(maxlen=self.size)
+            samples.append(seconds)
+
+    def percentile(self, endpoint: str, q: float, min_samples: int = 1) -> float:
+        """Returns the q-th percentile (0 to 1) of the durations, or None if there are fewer than min_samples."""
+        with self._lock:
+            samples = sorted(self._samples.get(endpoint, ()))
+        if len(samples) < max(1, min_samples):
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class Resilience(object):
+    """
+    Class Resilience holds the rules the API clients follow when aoe2.net is slow or failing.
+
+    - Every request has a deadline per endpoint. It covers all retries and hedged requests, so a
+      query never waits longer than that for aoe2.net to answer. It starts once the rate limiter
+      lets the request pass: waiting for our own rate limit is no sign of trouble at aoe2.net.
+    - Connection errors, timeouts and the status codes in `retry_statuses` are retried up to
+      `retries` times. The waits between them grow exponentially and are picked at random up to
+      that size (full jitter), so many clients don't retry all at once.
+    - If `hedge_percentile` is set, the asyncio client sends a second, identical request when the
+      first one takes longer than that percentile of the recent requests to the endpoint, and uses
+      whichever answers first.
+    - A CircuitBreaker stops all requests while aoe2.net keeps failing. Only connection errors,
+      timeouts and `retry_statuses` of aoe2.net count as failures. Meanwhile fetch() answers
+      with the last good response it has, flagged as stale.
+
+    Attributes
+    ----------
+    deadlines : dict
+        Deadline in seconds per endpoint path
+    default_deadline : float
+        Deadline for endpoints that are not listed in deadlines (default 10)
+    retries : int
+        Retries after the first attempt (default 2)
+    backoff : float
+        Upper bound of the first wait between two attempts in seconds, doubled for every further
+        attempt (default 0.25)
+    max_backoff : float
+        Upper bound of any wait between two attempts in seconds (default 4)
+    retry_statuses : tuple
+        Status codes that are retried, all others are returned as they are
+    hedge_percentile : float
+        Percentile of the recent durations after which a hedged request is sent, e.g. 0.95. None
+        disables hedged requests (default None)
+    hedge_min_samples : int
+        Durations needed for an endpoint before its requests are hedged (default 20)
+    breaker : CircuitBreaker
+    latency : LatencyWindow
+        The recent durations per endpoint
+    """
+
+    deadlines: dict = {
+        '/api/lobbies': 5,
+        '/api/lastmatch': 8,
+        '/api/leaderboard': 10,
+        '/api/strings': 30,
+    }
+    default_deadline: float = 10.0
+    retries: int = 2
+    backoff: float = 0.25
+    max_backoff: float = 4.0
+    retry_statuses: tuple = (429, 500, 502, 503, 504)
+    hedge_percentile: float = None
+    hedge_min_samples: int = 20
+
+    def __init__(self, deadlines: dict = None, default_deadline: float = default_deadline, retries: int = retries,
+                 backoff: float = backoff, max_backoff: float = max_backoff, hedge_percentile: float = hedge_percentile,
+                 hedge_min_samples: int = hedge_min_samples, breaker: CircuitBreaker = None) -> None:
+        self.deadlines = dict(self.deadlines)
+        if deadlines:
+            self.deadlines.update(deadlines)
+        self.default_deadline = default_deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.latency = LatencyWindow()
+
+        self.retried = 0
+        self.hedged = 0
+
+    def deadline_for(self, endpoint: str) -> float:
+        return self.deadlines.get(endpoint, self.default_deadline)
+
+    def backoff_delay(self, attempt: int) -> float:
+        """Returns the seconds to wait before the retry after the given attempt, starting at 0."""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def hedge_delay(self, endpoint: str) -> float:
+        """Returns the seconds after which a request to the endpoint is hedged, or None to not hedge it."""
+        if self.hedge_percentile is None:
+            return None
+        return self.latency.percentile(endpoint, self.hedge_percentile, self.hedge_min_samples)
@@ -0,0 +1,432 @@
+# sharding.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+"""
+Running the bot in several processes.
+
+In sharded mode the main process does not connect to discord. It owns the only Aoe2netAsyncAPI
+with a response cache and the rate limiter, serves it to the worker processes over a local socket
+(APIServer), syncs the leaderboard mirror and writes its snapshot. The ShardSupervisor starts one
+worker process per share of the discord shards. Workers send their API requests to the main
+process (SharedAoe2netAPI) and reload the mirror rows from the snapshot whenever it changes, so
+adding workers adds CPU without adding requests to aoe2.net. They also tell the main process which
+players people ask for, so its mirror keeps their part of the leaderboard fresh.
+
+Messages on the socket are frames of two unsigned 32 bit lengths followed by a JSON header and a
+raw body.
+"""
+
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import os
+import socket
+import struct
+import tempfile
+import time
+
+import aiohttp
+import multidict
+
+from aoe2netAPI import Aoe2netAsyncAPI, APIResponse
+from metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+_FRAME = struct.Struct('!II')
+
+
+def default_address() -> str:
+    """Returns a fresh address for the API service, a unix socket if the platform has them."""
+    if hasattr(socket, 'AF_UNIX'):
+        return os.path.join(tempfile.gettempdir(), f'elobot-api-{os.getpid()}.sock')
+    return '127.0.0.1:9107'
+
+
+def _is_tcp(address: str) -> bool:
+    # 'host:port' is a TCP address, everything else a unix socket path
+    host, _, port = address.rpartition(':')
+    return bool(host) and port.isdigit()
+
+
+async def _open_connection(address: str):
+    if _is_tcp(address):
+        host, _, port = address.rpartition(':')
+        return await asyncio.open_connection(host, int(port))
+    return await asyncio.open_unix_connection(address)
+
+
+def _frame(header: dict, body: bytes = b'') -> bytes:
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    return _FRAME.pack(len(header), len(body)) + header + body
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> tuple:
+    header_size, body_size = _FRAME.unpack(await reader.readexactly(_FRAME.size))
+    header = json.loads(await reader.readexactly(header_size))
+    body = await reader.readexactly(body_size) if body_size else b''
+    return header, body
+
+
+class APIServer(object):
+    """
+    Class APIServer answers API requests of other processes with an Aoe2netAsyncAPI.
+
+    Every request is run through the API client's cache and rate limiter, so identical requests of
+    all workers are coalesced and answered from one cache. Requests that skip the cache (fresh) are
+    what the lobby watchers and rating histories of all workers poll; a response fetched for one of
+    them answers the same request of every worker for fresh_age seconds.
+
+    Attributes
+    ----------
+    api : Aoe2netAsyncAPI
+        The API client that sends the requests to aoe2.net. It should have a response cache.
+    address : str
+        A unix socket path, or 'host:port' to listen on TCP
+    metrics : Metrics
+        Optional, its summary is sent to workers asking for it, see SharedAoe2netAPI.summary()
+    mirror : LeaderboardMirror
+        Optional, the mirror that is synced in this process. Workers pass on which players people
+        ask for to it, see SharedAoe2netAPI.touch()
+    fresh_age : float
+        Seconds a response fetched for a fresh request answers the same fresh request (default 15)
+    """
+
+    fresh_age: float = 15
+
+    def __init__(self, api: Aoe2netAsyncAPI, address: str, metrics: Metrics = None, mirror=None,
+                 fresh_age: float = fresh_age) -> None:
+        self.api = api
+        self.address = address
+        self.metrics = metrics
+        self.mirror = mirror
+        self.fresh_age = fresh_age
+        self._server = None
+        # (endpoint, query) -> (time.monotonic() of the request, task) of the latest fresh requests
+        self._fresh = collections.OrderedDict()
+
+    async def start(self) -> None:
+        if _is_tcp(self.address):
+            host, _, port = self.address.rpartition(':')
+            self._server = await asyncio.start_server(self._serve, host, int(port))
+        else:
+            if os.path.exists(self.address):
+                # left behind by a process that was killed
+                os.remove(self.address)
+            self._server = await asyncio.start_unix_server(self._serve, self.address)
+            os.chmod(self.address, 0o600)
+        logger.info(f'Serving the API to worker processes on {self.address}')
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+            if not _is_tcp(self.address) and os.path.exists(self.address):
+                os.remove(self.address)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # requests on one connection are answered concurrently, in the order they complete
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                header, _ = await _read_frame(reader)
+                if header.get('op') == 'touch':
+                    # nobody waits for an answer
+                    if self.mirror is not None:
+                        self.mirror.touch(header['leaderboard_id'], header['profile_id'])
+                    continue
+                task = asyncio.ensure_future(self._answer(header, writer, lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def _answer(self, header: dict, writer: asyncio.StreamWriter, lock: asyncio.Lock) -> None:
+        reply = {'id': header.get('id')}
+        body = b''
+        try:
+            if header.get('op') == 'summary':
+                reply['status'] = 200
+                body = (self.metrics.summary() if self.metrics is not None else '').encode('utf-8')
+            else:
+                if header.get('fresh'):
+                    ret = await self._fetch_fresh(header['endpoint'], header.get('query'))
+                else:
+                    ret = await self.api.fetch(header['endpoint'], header.get('query'))
+                reply.update(url=str(ret.url), status=ret.status_code, reason=ret.reason,
+                             headers=list(ret.headers.items()), stale=getattr(ret, 'stale', False))
+                body = ret.content
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            reply.update(error=type(e).__name__, message=str(e))
+
+        async with lock:
+            writer.write(_frame(reply, body))
+            await writer.drain()
+
+    async def _fetch_fresh(self, endpoint: str, query: str) -> APIResponse:
+        key = (endpoint, query)
+        now = time.monotonic()
+        while self._fresh and now - next(iter(self._fresh.values()))[0] >= self.fresh_age:
+            self._fresh.popitem(last=False)
+
+        if key in self._fresh:
+            task = self._fresh[key][1]
+        else:
+            task = asyncio.ensure_future(self.api.fetch(endpoint, query, fresh=True))
+            self._fresh[key] = (now, task)
+
+            def forget(task):
+                # failures and stale answers are not kept, the next request tries again
+                if self._fresh.get(key, (None, None))[1] is not task:
+                    return
+                if task.cancelled() or task.exception() is not None or getattr(task.result(), 'stale', False):
+                    del self._fresh[key]
+            task.add_done_callback(forget)
+        # one worker giving up must not cancel the request the others wait for
+        return await asyncio.shield(task)
+
+
+class SharedAoe2netAPI(Aoe2netAsyncAPI):
+    """
+    Class SharedAoe2netAPI is an Aoe2netAsyncAPI that gets its responses from an APIServer.
+
+    All endpoint methods work like in Aoe2netAsyncAPI. The protocol and host are the ones of the
+    API client in the serving process; those arguments of fetch() are ignored. Upstream errors are
+    raised as aiohttp.ClientError and asyncio.TimeoutError, just like Aoe2netAsyncAPI does.
+
+    Attributes
+    ----------
+    address : str
+        The address of the APIServer
+    timeout : float
+        Seconds to wait for an answer. It includes the time a request waits for the rate limiter
+        of the serving process (default 30)
+    """
+
+    timeout: float = 30.0
+
+    def __init__(self, address: str, language: str = Aoe2netAsyncAPI.language, metrics: Metrics = None,
+                 timeout: float = timeout) -> None:
+        super().__init__(language, metrics=metrics, timeout=timeout, validator_size=0)
+        self.address = address
+        self._ids = itertools.count()
+        self._pending = {}
+        self._writer = None
+        self._reader_task = None
+        # bound to the running event loop, so it is created on first use
+        self._connect_lock = None
+
+    async def _connect(self) -> asyncio.StreamWriter:
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._writer is None:
+                try:
+                    reader, self._writer = await _open_connection(self.address)
+                except OSError as e:
+                    raise aiohttp.ClientConnectionError(f'Cannot connect to the API service on {self.address}: {e}')
+                self._reader_task = asyncio.ensure_future(self._read_replies(reader, self._writer))
+            return self._writer
+
+    async def _read_replies(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                header, body = await _read_frame(reader)
+                future = self._pending.pop(header.get('id'), None)
+                if future is not None and not future.done():
+                    future.set_result((header, body))
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            logger.warning(f'Lost the connection to the API service: {e!r}')
+        finally:
+            if self._writer is writer:
+                self._writer = None
+            writer.close()
+            # the next request connects again, the ones waiting now have to fail
+            pending, self._pending = self._pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(aiohttp.ClientConnectionError('Lost the connection to the API service'))
+
+    async def _call(self, header: dict) -> tuple:
+        writer = await self._connect()
+        header['id'] = request_id = next(self._ids)
+        future = asyncio.get_event_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            writer.write(_frame(header))
+            await writer.drain()
+            return await asyncio.wait_for(future, self.timeout)
+        except ConnectionError as e:
+            raise aiohttp.ClientConnectionError(f'Lost the connection to the API service: {e}')
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def fetch(self, endpoint: str, query: str = None, protocol: str = None,
+                    host: str = None, fresh: bool = False) -> APIResponse:
+        """
+        Asks the APIServer for a response and returns it as an APIResponse object.
+
+        :raises aiohttp.ClientError: if the API service or aoe2.net can't be reached
+        :raises asyncio.TimeoutError: if the answer takes longer than the timeout
+        """
+        self.endpoint = endpoint
+        self.query = query
+
+        began = time.perf_counter()
+        try:
+            header, body = await self._call({'endpoint': endpoint, 'query': query, 'fresh': fresh})
+            if 'error' in header:
+                if header['error'] == 'TimeoutError':
+                    raise asyncio.TimeoutError(header['message'])
+                raise aiohttp.ClientError(f"{header['error']}: {header['message']}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self._record(endpoint, began, error=e)
+            raise
+
+        ret = APIResponse(header['url'], header['status'], header['reason'],
+                          multidict.CIMultiDict(header['headers']), body)
+        self.URL = ret.url
+        self._record(endpoint, began, ret.status_code, len(body))
+        if header.get('stale'):
+            # aoe2.net is failing, the serving process answered with the last good response
+            ret.stale = True
+            self.stale_served += 1
+            self._stale_served_at = time.monotonic()
+        return ret
+
+    async def summary(self) -> str:
+        """Returns the metrics summary of the serving process, see Metrics.summary()."""
+        header, body = await self._call({'op': 'summary'})
+        return body.decode('utf-8')
+
+    def touch(self, leaderboard_id: int, profile_id: int) -> None:
+        """
+        Tells the serving process that somebody asked for a player, see LeaderboardMirror.touch().
+        Returns at once, the message is sent in the background and errors are only logged.
+        """
+        header = {'op': 'touch', 'leaderboard_id': leaderboard_id, 'profile_id': profile_id}
+        asyncio.ensure_future(self._send(header))
+
+    async def _send(self, header: dict) -> None:
+        # for messages without an answer
+        try:
+            writer = await self._connect()
+            writer.write(_frame(header))
+            await writer.drain()
+        except (aiohttp.ClientError, ConnectionError) as e:
+            logger.debug(f'Sending {header} to the API service failed: {e!r}')
+
+    async def close(self) -> None:
+        """Closes the connection to the API service."""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+
+
+class ShardSupervisor(object):
+    """
+    Class ShardSupervisor runs the bot in worker processes, each connecting some of the shards.
+
+    Worker processes are started with the same command line and learn their part from environment
+    variables: ELOBOT_WORKER (the worker number), ELOBOT_SHARD_IDS (comma separated),
+    ELOBOT_SHARD_COUNT and ELOBOT_API_ADDRESS. A worker that crashes is started again; a worker
+    that exits cleanly, e.g. after '-sys quit', stops all of them.
+
+    Attributes
+    ----------
+    command : list
+        The command line that starts a worker
+    shard_count : int
+        Total number of discord shards
+    processes : int
+        Number of worker processes, the shards are dealt out round robin
+    address : str
+        The address of the APIServer the workers should use
+    restart_delay : float
+        Seconds to wait before a crashed worker is started again (default 10)
+    """
+
+    restart_delay: float = 10.0
+
+    def __init__(self, command: list, shard_count: int, processes: int, address: str,
+                 restart_delay: float = restart_delay) -> None:
+        self.command = list(command)
+        self.shard_count = shard_count
+        self.processes = min(processes, shard_count)
+        self.address = address
+        self.restart_delay = restart_delay
+        self._running = {}
+        self._stopping = False
+
+    def shard_ids(self, worker: int) -> list:
+        return list(range(worker, self.shard_count, self.processes))
+
+    async def _run_worker(self, worker: int) -> None:
+        env = dict(os.environ, ELOBOT_WORKER=str(worker), ELOBOT_SHARD_COUNT=str(self.shard_count),
+                   ELOBOT_SHARD_IDS=','.join(str(shard_id) for shard_id in self.shard_ids(worker)),
+                   ELOBOT_API_ADDRESS=self.address)
+        while not self._stopping:
+            process = await asyncio.create_subprocess_exec(*self.command, env=env)
+            self._running[worker] = process
+            logger.info(f'Started worker {worker} (PID {process.pid}) for shards {env["ELOBOT_SHARD_IDS"]}')
+            try:
+                code = await process.wait()
+            finally:
+                del self._running[worker]
+            if code == 0 or self._stopping:
+                logger.info(f'Worker {worker} exited with code {code}')
+                return
+            logger.warning(f'Worker {worker} exited with code {code}, restarting it in {self.restart_delay}s')
+            await asyncio.sleep(self.restart_delay)
+
+    async def run(self) -> None:
+        """Runs the workers until one of them exits cleanly, then stops the others."""
+        tasks = [asyncio.ensure_future(self._run_worker(worker)) for worker in range(self.processes)]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self._stopping = True
+            for process in list(self._running.values()):
+                process.terminate()
+            for worker, task in enumerate(tasks):
+                if worker not in self._running:
+                    # waiting to restart a crashed worker
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
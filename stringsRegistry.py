@@ -0,0 +1,133 @@
+# stringsRegistry.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+
+import asyncio
+import logging
+import sys
+
+import aoe2netModels
+
+logger = logging.getLogger(__name__)
+
+
+class StringsRegistry(object):
+    """
+    Class StringsRegistry resolves the numeric ids used by the API to names.
+
+    The lists of /api/strings (civ, map_type, game_type, leaderboard, ...) are loaded once per
+    language and stored as lists indexed by id, so a lookup is a plain list access. The names are
+    interned, the same string in different languages or tables is only stored once. A background
+    job reloads the lists rarely, they hardly ever change.
+
+    Attributes
+    ----------
+    api : Aoe2netAsyncAPI
+        The API client used to load the strings
+    game : str
+        The game to load the strings for (default 'aoe2de')
+    languages : tuple
+        The languages to load (default ('en',))
+    refresh_interval : float
+        Seconds between two reloads (default one day)
+    """
+
+    game: str = 'aoe2de'
+    languages: tuple = ('en',)
+    refresh_interval: float = 24 * 60 * 60
+    retry_interval: float = 60
+
+    def __init__(self, api, game: str = game, languages: tuple = languages,
+                 refresh_interval: float = refresh_interval) -> None:
+        self.api = api
+        self.game = game
+        self.languages = tuple(languages)
+        self.refresh_interval = refresh_interval
+
+        # language -> category -> [name or None, indexed by id]
+        self._tables = {}
+
+    def ready(self, language: str = 'en') -> bool:
+        return language in self._tables
+
+    def get(self, category: str, id: int, language: str = 'en', default: str = None) -> str:
+        """
+        Returns the name of an id, e.g. get('civ', 13) -> 'Huns'.
+
+        Unknown ids, and all ids while the strings are not loaded yet, return the default.
+        """
+        try:
+            name = self._tables[language][category][id]
+        except (KeyError, IndexError, TypeError):
+            return default
+        return default if name is None else name
+
+    def civ(self, id: int, language: str = 'en') -> str:
+        return self.get('civ', id, language, default=f'civ #{id}')
+
+    def map_type(self, id: int, language: str = 'en') -> str:
+        return self.get('map_type', id, language, default=f'map #{id}')
+
+    def game_type(self, id: int, language: str = 'en') -> str:
+        return self.get('game_type', id, language, default=f'game type #{id}')
+
+    def leaderboard(self, id: int, language: str = 'en') -> str:
+        return self.get('leaderboard', id, language, default=f'leaderboard #{id}')
+
+    @staticmethod
+    def build(strings: dict) -> dict:
+        """Turns an /api/strings response into lists indexed by id."""
+        tables = {}
+        for category, entries in strings.items():
+            if not isinstance(entries, list):
+                continue
+            names = [(entry['id'], entry['string']) for entry in entries
+                     if isinstance(entry.get('id'), int) and entry['id'] >= 0 and isinstance(entry.get('string'), str)]
+            table = [None] * (max((id for id, _ in names), default=-1) + 1)
+            for id, name in names:
+                table[id] = sys.intern(name)
+            tables[sys.intern(category)] = table
+        return tables
+
+    async def load(self, language: str) -> None:
+        response = await self.api.strings(self.game, language)
+        response.raise_for_status()
+        self._tables[language] = self.build(aoe2netModels.loads(response.content))
+        logger.info(f'Loaded {language} strings: {", ".join(sorted(self._tables[language]))}')
+
+    async def run(self) -> None:
+        """Loads the strings and reloads them every refresh_interval. Start this as a background task."""
+        while True:
+            for language in self.languages:
+                try:
+                    await self.load(language)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.warning(f'Loading the {language} strings failed: {e!r}')
+            loaded = all(self.ready(language) for language in self.languages)
+            await asyncio.sleep(self.refresh_interval if loaded else self.retry_interval)
@@ -0,0 +1,142 @@
+# test_aoe2netCache.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+
+import asyncio
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aoe2netAPI import Aoe2netAsyncAPI  # noqa: E402
+from aoe2netCache import ResponseCache  # noqa: E402
+from fakeAoe2net import FakeAoe2net  # noqa: E402
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('aoe2netCache.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = ResponseCache(ttl={'/api/lobbies': 5}, stale_ttl=30, max_entries=2)
+
+    def test_key_ignores_order_and_none(self):
+        self.assertEqual(ResponseCache.key('/api/x', '?b=1&a=2'), ResponseCache.key('/api/x', '?a=2&b=1&c=None'))
+        self.assertNotEqual(ResponseCache.key('/api/x', '?a=1'), ResponseCache.key('/api/x', '?a=2'))
+        self.assertEqual(ResponseCache.key('/api/x'), '/api/x')
+
+    def test_entry_turns_stale_then_unusable(self):
+        self.cache.put('lobbies', 'value', '/api/lobbies')
+        self.now += 4.9
+        self.assertEqual(self.cache.get('lobbies'), ('value', True))
+        self.now += 0.1
+        self.assertEqual(self.cache.get('lobbies'), ('value', False))
+        self.now += 29.9
+        self.assertEqual(self.cache.get('lobbies'), ('value', False))
+        self.now += 0.1
+        self.assertIsNone(self.cache.get('lobbies'))
+        self.assertEqual((self.cache.hits, self.cache.stale_hits, self.cache.misses), (1, 2, 1))
+
+    def test_last_good_outlives_stale_ttl(self):
+        self.cache.put('lobbies', 'value', '/api/lobbies')
+        self.now += 3600
+        self.assertIsNone(self.cache.get('lobbies'))
+        self.assertEqual(self.cache.last_good('lobbies'), 'value')
+        self.assertIsNone(self.cache.last_good('other'))
+
+    def test_endpoints_without_ttl_use_default(self):
+        self.cache.put('players', 'value', '/api/unknown')
+        self.now += ResponseCache.default_ttl - 1
+        self.assertEqual(self.cache.get('players'), ('value', True))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.cache.put('a', 1, '/api/lobbies')
+        self.cache.put('b', 2, '/api/lobbies')
+        self.cache.get('a')
+        self.cache.put('c', 3, '/api/lobbies')
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), (1, True))
+        self.assertEqual((len(self.cache), self.cache.evictions), (2, 1))
+
+    def test_invalidate(self):
+        self.cache.put('a', 1, '/api/lobbies')
+        self.cache.put('b', 2, '/api/lobbies')
+        self.cache.invalidate('a')
+        self.assertIsNone(self.cache.last_good('a'))
+        self.cache.invalidate()
+        self.assertEqual(len(self.cache), 0)
+
+
+class CachedAPITest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.fake = FakeAoe2net(latency=0.05)
+        host = await self.fake.start()
+        self.cache = ResponseCache()
+        self.api = Aoe2netAsyncAPI(cache=self.cache, protocol='http', host=host)
+
+    async def asyncTearDown(self):
+        await self.api.close()
+        await self.fake.stop()
+
+    async def test_concurrent_requests_are_coalesced(self):
+        responses = await asyncio.gather(*[self.api.lobbies() for _ in range(10)])
+        self.assertEqual(self.fake.calls['/api/lobbies'], 1)
+        self.assertEqual({response.content for response in responses}, {responses[0].content})
+
+    async def test_cached_response_answers_repeats(self):
+        first = await self.api.leaderboard(leaderboard_id=3, start=1, count=10)
+        again = await self.api.leaderboard(leaderboard_id=3, count=10, start=1)
+        self.assertEqual(self.fake.calls['/api/leaderboard'], 1)
+        self.assertIs(again, first)
+        await self.api.leaderboard(leaderboard_id=3, start=11, count=10)
+        self.assertEqual(self.fake.calls['/api/leaderboard'], 2)
+
+    async def test_stale_response_is_served_and_refreshed(self):
+        self.cache.ttl['/api/lobbies'] = 0
+        # a 304 would hand back the kept response, a new body is easier to tell apart
+        self.fake.etags = False
+        first = await self.api.lobbies()
+        stale = await self.api.lobbies()
+        self.assertIs(stale, first)
+        # the background refresh replaces the entry
+        await asyncio.sleep(0.2)
+        self.assertEqual(self.fake.calls['/api/lobbies'], 2)
+        self.assertIsNot(self.cache.last_good(self.cache.key('/api/lobbies', self.api.query)), first)
+
+    async def test_fresh_skips_the_cache(self):
+        await self.api.lobbies()
+        await self.api.lobbies(fresh=True)
+        self.assertEqual(self.fake.calls['/api/lobbies'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+# test_deltaSync.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aoe2netModels import LeaderboardRow  # noqa: E402
+from deltaSync import DeltaScheduler  # noqa: E402
+
+NOW = 1000000.0
+
+
+class DeltaSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        # 10 blocks of 10 ranks, someone in block 3 played a minute ago
+        self.scheduler = DeltaScheduler(block_size=10, blocks_per_request=4, hot_interval=30, max_interval=1000,
+                                        active_window=3600)
+        rows = [LeaderboardRow(rank=rank, last_match_time=NOW - 60 if rank == 35 else NOW - 7200)
+                for rank in range(1, 101)]
+        self.scheduler.reset(rows, 100, NOW)
+
+    def test_reset_makes_active_blocks_hot(self):
+        self.assertEqual(self.scheduler.blocks, 10)
+        self.assertEqual(self.scheduler.hot_blocks(), 1)
+        self.assertEqual(self.scheduler.due(NOW + 30, 10), [(3, 3)])
+
+    def test_cold_blocks_are_spread_over_max_interval(self):
+        # three requests of up to four blocks each, a third of the interval apart. The hot block 3
+        # is merged with its due neighbors.
+        self.assertEqual(self.scheduler.due(NOW + 1000 / 3 - 1, 10), [(3, 3)])
+        self.assertEqual(self.scheduler.due(NOW + 1000 / 3, 10), [(0, 3)])
+        self.assertEqual(self.scheduler.due(NOW + 1000, 10), [(0, 3), (4, 7), (8, 9)])
+        self.assertEqual(self.scheduler.due(NOW + 1000, 2), [(0, 3), (4, 7)])
+
+    def test_unchanged_blocks_cool_down(self):
+        intervals = []
+        now = NOW
+        for _ in range(7):
+            now += 30
+            self.scheduler.refreshed(3, 3, set(), 100, now)
+            intervals.append(self.scheduler._interval[3])
+        self.assertEqual(intervals, [60, 120, 240, 480, 960, 1000, 1000])
+        self.assertEqual(self.scheduler.hot_blocks(), 0)
+        self.scheduler.refreshed(3, 3, {3}, 100, now)
+        self.assertEqual(self.scheduler._interval[3], 30)
+
+    def test_touch(self):
+        self.scheduler.touch(75, NOW)
+        self.assertEqual(self.scheduler.due(NOW, 10), [(7, 7)])
+        # ranks past the end are ignored
+        self.scheduler.touch(1000, NOW)
+        self.assertEqual(self.scheduler.blocks, 10)
+
+    def test_resize_adds_cold_blocks(self):
+        self.scheduler.refreshed(0, 0, set(), 125, NOW)
+        self.assertEqual(self.scheduler.blocks, 13)
+        self.assertEqual(self.scheduler._interval[12], 1000)
+        self.assertEqual(self.scheduler._due[12], NOW + 1000)
+        self.assertEqual(self.scheduler.due(NOW + 1000, 10)[-1], (12, 12))
+
+    def test_resize_drops_blocks_past_the_end(self):
+        self.scheduler.touch(95, NOW)
+        self.scheduler.refreshed(6, 9, {6, 9}, 61, NOW)
+        self.assertEqual(self.scheduler.blocks, 7)
+        self.assertEqual(sorted(self.scheduler._due), list(range(7)))
+        self.assertEqual(sorted(self.scheduler._interval), list(range(7)))
+        self.assertEqual(self.scheduler._interval[6], 30)
+        self.assertTrue(all(last < 7 for _, last in self.scheduler.due(NOW + 1000, 10)))
+
+    def test_resize_to_nothing(self):
+        self.scheduler.refreshed(0, 0, set(), None, NOW)
+        self.assertEqual(self.scheduler.blocks, 0)
+        self.assertEqual(self.scheduler.due(NOW + 1000, 10), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
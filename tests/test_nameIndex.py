@@ -0,0 +1,130 @@
+# test_nameIndex.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+
+import os
+import random
+import sys
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nameIndex  # noqa: E402
+from nameIndex import NameIndex  # noqa: E402
+
+
+def row(profile_id, name, last_match_time=0, rating=1000):
+    return {'profile_id': profile_id, 'name': name, 'last_match_time': last_match_time, 'rating': rating}
+
+
+class NameIndexSearchTest(unittest.TestCase):
+
+    def setUp(self):
+        # 'the end' is the most active, so it would win any tie in quality
+        self.index = NameIndex([
+            row(1, '[AoM] The_Viper', last_match_time=100),
+            row(2, 'Theodore', last_match_time=200),
+            row(3, 'the end', last_match_time=300),
+        ])
+
+    def names(self, text, count=20, fuzzy=True):
+        return [hit['name'] for hit in self.index.search(text, count=count, fuzzy=fuzzy)]
+
+    def test_every_word_has_to_match(self):
+        self.assertEqual(self.names('the viper', count=1), ['[AoM] The_Viper'])
+        self.assertEqual(self.names('the viper', fuzzy=False), ['[AoM] The_Viper'])
+
+    def test_words_match_in_any_order(self):
+        self.assertEqual(self.names('viper aom', fuzzy=False), ['[AoM] The_Viper'])
+
+    def test_words_match_prefixes(self):
+        self.assertEqual(self.names('th vi', fuzzy=False), ['[AoM] The_Viper'])
+
+    def test_single_word_matches_word_prefixes(self):
+        self.assertEqual(self.names('the', fuzzy=False), ['the end', 'Theodore', '[AoM] The_Viper'])
+
+    def test_no_word_match(self):
+        self.assertEqual(self.names('the dragon', fuzzy=False), [])
+
+    def test_full_name_ranks_first(self):
+        self.assertEqual(self.names('the end the', count=1), ['the end'])
+        self.index.update(row(4, 'Viper', last_match_time=0))
+        self.assertEqual(self.names('viper')[0], 'Viper')
+
+
+class NameIndexShortPrefixTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        generator = random.Random(1)
+        syllables = ['ka', 'ke', 'ko', 'ti', 'to', 'ra', 'vi', 'per', 'mo', 'x', '[ab] ', '_']
+        cls.rows = [row(profile_id, ''.join(generator.choice(syllables) for _ in range(generator.randint(1, 5))),
+                        last_match_time=generator.randint(0, 10000), rating=generator.randint(500, 2500))
+                    for profile_id in range(50000)]
+        cls.index = NameIndex(cls.rows)
+        # the same index without activity ordered lists, so every search ranks all of its hits
+        with mock.patch.object(nameIndex, 'HOT_PREFIX_SIZE', len(cls.rows)):
+            cls.reference = NameIndex(cls.rows)
+
+    def assertSameHits(self, text):
+        with mock.patch.object(nameIndex, 'HOT_PREFIX_SIZE', len(self.rows)):
+            expected = [hit['profile_id'] for hit in self.reference.search(text)]
+        self.assertEqual([hit['profile_id'] for hit in self.index.search(text)], expected, text)
+
+    def test_short_prefixes_are_fast(self):
+        for text in ('k', 'ka', 'x', 'k t'):
+            # the first search makes the activity ordered lists
+            self.index.search(text)
+            elapsed = []
+            for _ in range(5):
+                start = time.perf_counter()
+                self.index.search(text)
+                elapsed.append(time.perf_counter() - start)
+            self.assertLess(min(elapsed), 0.005, text)
+
+    def test_short_prefixes_rank_like_full_search(self):
+        for text in ('k', 'ka', 'ko', 't', 'x', '[', 'ab', 'ka t', 'vi ab', 'per'):
+            self.assertSameHits(text)
+
+    def test_updates_keep_the_order(self):
+        self.index.search('k')
+        changed = [dict(hit, last_match_time=20000 + n) for n, hit in enumerate(self.index.search('ka')[-3:])]
+        renamed = row(50000, 'kamikaze', last_match_time=30000)
+        for index in (self.index, self.reference):
+            for changed_row in changed:
+                index.update(changed_row)
+            index.update(renamed)
+            index.remove(self.rows[0]['profile_id'])
+        self.assertEqual(self.index.search('k')[0]['name'], 'kamikaze')
+        for text in ('k', 'ka', 'kam', 'ti ka'):
+            self.assertSameHits(text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+# test_ratingIndex.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ratingIndex import RatingIndex  # noqa: E402
+
+
+def row(profile_id, rating):
+    return {'profile_id': profile_id, 'rating': rating}
+
+
+class RatingIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = RatingIndex([row(1, 1500), row(2, 1200), row(3, 1200), row(4, 980), row(5, None)])
+
+    def test_rows_without_rating_are_left_out(self):
+        self.assertEqual(len(self.index), 4)
+        self.assertNotIn(5, self.index)
+        self.assertIsNone(self.index.position(5))
+        self.assertEqual(self.index.neighbors(5), (None, None))
+
+    def test_percentile(self):
+        self.assertEqual(self.index.percentile(1500), 75.0)
+        self.assertEqual(self.index.percentile(1200), 25.0)
+        self.assertEqual(self.index.percentile(1199), 25.0)
+        self.assertEqual(self.index.percentile(100), 0.0)
+        self.assertEqual(self.index.percentile(3000), 100.0)
+        self.assertEqual(RatingIndex().percentile(1000), 0.0)
+
+    def test_equal_ratings_share_the_position(self):
+        self.assertEqual([self.index.position(profile_id) for profile_id in (1, 2, 3, 4)], [1, 2, 2, 4])
+
+    def test_histogram(self):
+        self.assertEqual(self.index.histogram(), [(1500, 1), (1400, 0), (1300, 0), (1200, 2), (1100, 0),
+                                                  (1000, 0), (900, 1)])
+        self.assertEqual(self.index.histogram(500), [(1500, 1), (1000, 2), (500, 1)])
+        self.assertEqual(RatingIndex().histogram(), [])
+
+    def test_neighbors(self):
+        rows, i = self.index.neighbors(1, count=1)
+        self.assertEqual(([r['profile_id'] for r in rows], i), ([1, 2], 0))
+        rows, i = self.index.neighbors(3, count=1)
+        self.assertEqual(([r['profile_id'] for r in rows], i), ([2, 3, 4], 1))
+
+    def test_update_moves_the_player(self):
+        self.index.update(row(4, 1600))
+        self.index.update(row(5, 1300))
+        self.index.update(row(2, None))
+        self.assertEqual([self.index.position(profile_id) for profile_id in (4, 1, 5, 3)], [1, 2, 3, 4])
+        self.assertNotIn(2, self.index)
+        self.index.remove(4)
+        self.index.remove(4)
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.position(1), 1)
+
+    def test_matches_brute_force(self):
+        generator = random.Random(1)
+        ratings = {profile_id: generator.randint(500, 2500) for profile_id in range(2000)}
+        index = RatingIndex(row(profile_id, rating) for profile_id, rating in ratings.items())
+        for _ in range(500):
+            profile_id = generator.randrange(2500)
+            if generator.random() < 0.2:
+                ratings.pop(profile_id, None)
+                index.remove(profile_id)
+            else:
+                ratings[profile_id] = generator.randint(500, 2500)
+                index.update(row(profile_id, ratings[profile_id]))
+
+        self.assertEqual(len(index), len(ratings))
+        for rating in (499, 500, 1234, 2500, 2501):
+            self.assertEqual(index.at_least(rating), sum(r >= rating for r in ratings.values()))
+        for profile_id in generator.sample(sorted(ratings), 50):
+            self.assertEqual(index.position(profile_id), 1 + sum(r > ratings[profile_id] for r in ratings.values()))
+        self.assertEqual(sum(count for _, count in index.histogram()), len(ratings))
+
+
+if __name__ == '__main__':
+    unittest.main()
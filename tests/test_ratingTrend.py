@@ -0,0 +1,113 @@
+# test_ratingTrend.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+
+import os
+import random
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ratingTrend  # noqa: E402
+from aoe2netModels import RatingPoint  # noqa: E402
+from ratingTrend import DAY, RatingHistory, trend  # noqa: E402
+
+
+def points(count, seed=1, start=1600000000):
+    # a random walk of games a few hours apart, with the counters the API reports
+    generator = random.Random(seed)
+    timestamp, rating, wins, losses = start, 1000, 0, 0
+    result = []
+    for _ in range(count):
+        timestamp += generator.randint(600, 20 * 60 * 60)
+        outcome = generator.choice((1, 1, -1, -1, 0))
+        wins += outcome > 0
+        losses += outcome < 0
+        # a game without an outcome in the counters still moves the rating
+        rating += outcome * generator.randint(5, 25) or generator.choice((-3, 3))
+        result.append(RatingPoint(rating=rating, num_wins=wins, num_losses=losses, timestamp=timestamp))
+    return result
+
+
+def python_history(points):
+    # the columns are array.array without numpy
+    with mock.patch.object(ratingTrend, 'numpy', None):
+        history = RatingHistory(1, 3)
+        history.append(points)
+    return history
+
+
+def trend_fields(result):
+    return {field: getattr(result, field) for field in result.__slots__}
+
+
+class RatingTrendTest(unittest.TestCase):
+
+    def test_pure_python_trend(self):
+        history = python_history([RatingPoint(rating=rating, num_wins=wins, num_losses=losses, timestamp=timestamp)
+                                  for timestamp, rating, wins, losses in [(100, 1000, 0, 0), (200, 1010, 1, 0),
+                                                                          (300, 1020, 2, 0), (400, 1005, 2, 1),
+                                                                          (500, 1012, 2, 1)]])
+        with mock.patch.object(ratingTrend, 'numpy', None):
+            result = trend(history, now=500 + DAY, windows=(2,), days=(1, 7))
+        self.assertEqual((result.games, result.rating, result.peak, result.peak_at, result.low, result.low_at),
+                         (5, 1012, 1020, 300, 1000, 100))
+        self.assertEqual(result.averages, {2: 1008.5})
+        self.assertEqual(result.changes, {1: (0, 0), 7: (12, 5)})
+        # the last game has no outcome in the counters, the rating went up
+        self.assertEqual((result.streak, result.longest_win_streak, result.longest_loss_streak), (1, 2, 1))
+
+    def test_appending_skips_old_points(self):
+        history = python_history(points(10))
+        self.assertEqual(history.append(points(12)), 2)
+        self.assertEqual(history.size, 12)
+        self.assertEqual(history.last_timestamp, points(12)[-1].timestamp)
+
+    @unittest.skipIf(ratingTrend.numpy is None, 'numpy is not installed')
+    def test_numpy_and_python_agree(self):
+        for count, seed in ((1, 1), (2, 2), (60, 3), (1000, 4)):
+            history = points(count, seed)
+            now = history[-1].timestamp + DAY
+            numpy_history = RatingHistory(1, 3)
+            # the numpy columns grow in several steps
+            numpy_history.append(history[:count // 2])
+            numpy_history.append(history[count // 2:])
+
+            expected = trend_fields(ratingTrend._trend_python(python_history(history), now, (10, 50), (7, 30), 50))
+            result = trend_fields(ratingTrend._trend_numpy(numpy_history, now, (10, 50), (7, 30), 50))
+            volatility = result.pop('volatility'), expected.pop('volatility')
+            averages = result.pop('averages'), expected.pop('averages')
+            self.assertEqual(result, expected, count)
+            self.assertAlmostEqual(*volatility)
+            for window in (10, 50):
+                self.assertAlmostEqual(averages[0][window], averages[1][window])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,214 @@
+# test_resilience.py
+
+# MIT License
+#
+# Copyright (c) 2020 Heistergand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Project Website:
+# https://github.com/Heistergand/elobot
+
+
+import asyncio
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aoe2netAPI import Aoe2netAsyncAPI  # noqa: E402
+from rateLimit import RateLimiter  # noqa: E402
+from resilience import CircuitBreaker, Resilience  # noqa: E402
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('resilience.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+
+    def fail(self, times):
+        for _ in range(times):
+            self.breaker.failure()
+
+    def test_opens_after_failures_in_a_row(self):
+        self.fail(2)
+        self.breaker.success()
+        self.fail(2)
+        self.assertTrue(self.breaker.allow())
+        self.fail(1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.opened, 1)
+
+    def test_lets_one_probe_through(self):
+        self.fail(3)
+        self.now += 29.9
+        self.assertFalse(self.breaker.allow())
+        self.now += 0.1
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+        # a lost probe is replaced after another reset_timeout
+        self.now += 30
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_probe_opens_again(self):
+        self.fail(3)
+        self.now += 30
+        self.breaker.allow()
+        self.fail(1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.opened, 1)
+
+    def test_successful_probe_closes(self):
+        self.fail(3)
+        self.now += 30
+        self.breaker.allow()
+        self.breaker.success()
+        self.assertEqual((self.breaker.state, self.breaker.failures), (CircuitBreaker.CLOSED, 0))
+        self.assertTrue(self.breaker.allow())
+
+
+class ResilienceTest(unittest.TestCase):
+
+    def test_backoff_grows_up_to_max_backoff(self):
+        resilience = Resilience(backoff=0.25, max_backoff=1)
+        with mock.patch('resilience.random.uniform', lambda low, high: high):
+            self.assertEqual([resilience.backoff_delay(attempt) for attempt in range(4)], [0.25, 0.5, 1, 1])
+
+    def test_deadlines(self):
+        resilience = Resilience(deadlines={'/api/matches': 3}, default_deadline=7)
+        self.assertEqual(resilience.deadline_for('/api/matches'), 3)
+        self.assertEqual(resilience.deadline_for('/api/lobbies'), Resilience.deadlines['/api/lobbies'])
+        self.assertEqual(resilience.deadline_for('/api/other'), 7)
+
+    def test_hedging_needs_enough_samples(self):
+        resilience = Resilience(hedge_percentile=0.9, hedge_min_samples=10)
+        for n in range(9):
+            resilience.latency.add('/api/lobbies', n / 100)
+        self.assertIsNone(resilience.hedge_delay('/api/lobbies'))
+        resilience.latency.add('/api/lobbies', 0.09)
+        self.assertEqual(resilience.hedge_delay('/api/lobbies'), 0.09)
+        self.assertIsNone(Resilience().hedge_delay('/api/lobbies'))
+
+
+class ScriptedServer(object):
+    # answers the requests with the given status codes and delays in turn, then with 200 at once
+
+    def __init__(self, statuses=(), delays=()):
+        self.statuses = list(statuses)
+        self.delays = list(delays)
+        self.calls = 0
+        self._runner = None
+
+    async def handle(self, request):
+        self.calls += 1
+        delay = self.delays.pop(0) if self.delays else 0
+        status = self.statuses.pop(0) if self.statuses else 200
+        if delay:
+            await asyncio.sleep(delay)
+        return web.json_response({}, status=status)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/api/lastmatch', self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', 0).start()
+        address = self._runner.addresses[0]
+        return f'{address[0]}:{address[1]}'
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+class ResilientRequestTest(unittest.IsolatedAsyncioTestCase):
+
+    async def start(self, statuses=(), delays=(), rate_limiter=None, **resilience):
+        self.server = ScriptedServer(statuses, delays)
+        host = await self.server.start()
+        self.resilience = Resilience(backoff=0.01, **resilience)
+        self.api = Aoe2netAsyncAPI(protocol='http', host=host, rate_limiter=rate_limiter, resilience=self.resilience)
+        self.addAsyncCleanup(self.server.stop)
+        self.addAsyncCleanup(self.api.close)
+
+    async def test_retries_until_success(self):
+        await self.start(statuses=[500, 503])
+        response = await self.api.lastmatch(profile_id=1)
+        self.assertEqual((response.status_code, self.server.calls, self.resilience.retried), (200, 3, 2))
+        self.assertEqual(self.resilience.breaker.failures, 0)
+
+    async def test_gives_up_after_retries(self):
+        await self.start(statuses=[500] * 5, retries=2)
+        response = await self.api.lastmatch(profile_id=1)
+        self.assertEqual((response.status_code, self.server.calls), (500, 3))
+        self.assertEqual(self.resilience.breaker.failures, 3)
+
+    async def test_other_statuses_are_not_retried(self):
+        await self.start(statuses=[404])
+        response = await self.api.lastmatch(profile_id=1)
+        self.assertEqual((response.status_code, self.server.calls), (404, 1))
+        self.assertEqual(self.resilience.breaker.failures, 0)
+
+    async def test_deadline_covers_all_attempts(self):
+        await self.start(delays=[5, 5, 5], deadlines={'/api/lastmatch': 0.3})
+        began = time.monotonic()
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.api.lastmatch(profile_id=1)
+        self.assertLess(time.monotonic() - began, 1)
+
+    async def test_open_circuit_fails_fast(self):
+        await self.start(statuses=[500] * 5, retries=0, breaker=CircuitBreaker(failure_threshold=2))
+        for _ in range(2):
+            await self.api.lastmatch(profile_id=1)
+        with self.assertRaises(aiohttp.ClientConnectionError):
+            await self.api.lastmatch(profile_id=1)
+        self.assertEqual(self.server.calls, 2)
+
+    async def test_slow_request_is_hedged(self):
+        await self.start(delays=[5], hedge_percentile=0.9, hedge_min_samples=5)
+        for _ in range(5):
+            self.resilience.latency.add('/api/lastmatch', 0.05)
+        began = time.monotonic()
+        response = await self.api.lastmatch(profile_id=1)
+        self.assertLess(time.monotonic() - began, 1)
+        self.assertEqual((response.status_code, self.server.calls, self.resilience.hedged), (200, 2, 1))
+
+    async def test_rate_limit_wait_is_not_a_failure(self):
+        # the last requests wait for tokens much longer than the deadline, but aoe2.net is fine
+        await self.start(rate_limiter=RateLimiter(rate=10, burst=1), deadlines={'/api/lastmatch': 0.2},
+                         breaker=CircuitBreaker(failure_threshold=1))
+        responses = await asyncio.gather(*[self.api.lastmatch(profile_id=n) for n in range(6)])
+        self.assertEqual([response.status_code for response in responses], [200] * 6)
+        self.assertEqual((self.resilience.breaker.failures, self.resilience.breaker.state), (0, CircuitBreaker.CLOSED))
+
+
+if __name__ == '__main__':
+    unittest.main()